@@ -27,8 +27,8 @@ import math
 
 from pathlib import Path
 import numpy as np
-import nidaqmx
-from nidaqmx.stream_writers import AnalogSingleChannelWriter
+import galvo_daq
+import galvo_display
 from pymmcore_widgets import (
     ShuttersWidget, DeviceWidget, StageWidget,
     ConfigurationWidget, 
@@ -323,23 +323,18 @@ class ImageAndHistogramWidget(QMainWindow):
         self.hist_min = self.slider_min.value()
         self.hist_max = self.slider_max.value()
         
-        # Normalize the image and adjust contrast
-        normalized_image = (self.image - self.hist_min) / (self.hist_max - self.hist_min)
-        adjusted_image = np.clip(normalized_image, 0, 1) * self.max_16bit_value
-        adjusted_image = adjusted_image.astype(np.uint16)
+        # Adjust the contrast and compute the histograms and statistics, without Qt (galvo_display)
+        adjusted_image, hist, raw_hist, adjusted_stats, raw_stats = galvo_display.histogram_display(self.image, self.hist_min, self.hist_max,
+                                                                                                   self.max_16bit_value)
 
         # Update min, max, and mean labels for adjusted image
-        min_val = adjusted_image.min()
-        max_val = adjusted_image.max()
-        mean_val = adjusted_image.mean()
+        min_val, max_val, mean_val = adjusted_stats
         self.min_label.setText(f"Adjusted Min: {min_val}")
         self.max_label.setText(f"Adjusted Max: {max_val}")
         self.mean_label.setText(f"Adjusted Mean: {mean_val:.2f}")
 
         # Update min, max, and mean labels for raw image
-        raw_min_val = self.image.min()
-        raw_max_val = self.image.max()
-        raw_mean_val = self.image.mean()
+        raw_min_val, raw_max_val, raw_mean_val = raw_stats
         self.raw_min_label.setText(f"Raw Min: {raw_min_val}")
         self.raw_max_label.setText(f"Raw Max: {raw_max_val}")
         self.raw_mean_label.setText(f"Raw Mean: {raw_mean_val:.2f}")
@@ -359,7 +354,6 @@ class ImageAndHistogramWidget(QMainWindow):
         self.figure.clear()
         ax = self.figure.add_subplot(111)
         ax.set_facecolor('gray')  # Définir la couleur de fond en gris
-        hist = cv2.calcHist([adjusted_image], [0], None, [self.max_16bit_value + 1], [0, self.max_16bit_value])
         ax.plot(hist, color='white',alpha=0.9)
         ax.set_xlim([0, self.max_16bit_value])
         ax.set_ylim([0, hist.max()])  # Assurer que les données sont tracées dans la plage des axes y
@@ -381,9 +375,6 @@ class ImageAndHistogramWidget(QMainWindow):
         ax.set_xticks([ self.hist_min, self.hist_max])
         ax.set_xticklabels([f'{self.hist_min}', f'{self.hist_max}'])
 
-        # Calculer l'histogramme de l'image brute
-        raw_hist = cv2.calcHist([self.image], [0], None, [self.max_16bit_value + 1], [0, self.max_16bit_value])
-
         # Ajouter une seconde courbe à l'histogramme
         ax.fill_between(np.arange(self.max_16bit_value + 1), raw_hist.flatten(), color='blue', alpha=0.3)  # Ajouter une courbe bleue transparente pour l'histogramme de l'image brute
 
@@ -586,8 +577,7 @@ class FISBAController(QMainWindow):
 class Galvo1Control(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.galvo1_task = nidaqmx.Task()
-        self.galvo1_task.ao_channels.add_ao_voltage_chan('Dev1/ao18')
+        self.galvo1_channel = 'Dev1/ao18'  # Written by the device actor, which owns its task
         self.last_position_degrees = 0  # Last recorded position in degrees
         self.create_layout()
 
@@ -639,7 +629,8 @@ class Galvo1Control(QWidget):
         final_voltage = new_position_degrees * voltage_ratio * (voltage_range / max_scan_angle)
 
         if duration_milliseconds == 0:  # If step
-            self.galvo1_task.write(final_voltage)
+            galvo_daq.get_actor().write(self.galvo1_channel, final_voltage)  # Queued, the GUI does not wait for the driver
+            print(f"Galvo1 moved to {new_position_degrees} degrees.")
         else:
             num_samples = 10000
             sample_rate = num_samples * 1000 / duration_milliseconds
@@ -655,32 +646,17 @@ class Galvo1Control(QWidget):
             # Generate linear movement sequence
             voltages_sequence = np.linspace(initial_voltage, final_voltage, num_samples)
 
-            # Configure task to use clock
-            self.galvo1_task.timing.cfg_samp_clk_timing(
-                rate=min(sample_rate, max_sample_rate),
-                sample_mode=nidaqmx.constants.AcquisitionType.FINITE,
-                samps_per_chan=num_samples
-            )
-
-            # Write sequence to the task
-            writer = AnalogSingleChannelWriter(self.galvo1_task.out_stream)
-            writer.write_many_sample(voltages_sequence)
-
-            # Start the task
-            self.galvo1_task.start()
-            self.galvo1_task.wait_until_done()
-            self.galvo1_task.stop()
+            # Play the sequence from the device actor thread, the GUI does not wait for the move
+            galvo_daq.get_actor().play(self.galvo1_channel, voltages_sequence, min(sample_rate, max_sample_rate),
+                                       done=lambda: print(f"Galvo1 moved to {new_position_degrees} degrees."))
 
         # Update last position
         self.last_position_degrees = new_position_degrees
 
-        print(f"Galvo1 moved to {new_position_degrees} degrees.")
-
 class Galvo2Control(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.galvo2_task = nidaqmx.Task()
-        self.galvo2_task.ao_channels.add_ao_voltage_chan('Dev1/ao18')
+        self.galvo2_channel = 'Dev1/ao18'  # Written by the device actor, which owns its task
         self.last_position_degrees = 0  # Last recorded position in degrees
         self.create_layout()
 
@@ -732,7 +708,8 @@ class Galvo2Control(QWidget):
         final_voltage = new_position_degrees * voltage_ratio * (voltage_range / max_scan_angle)
 
         if duration_milliseconds == 0:  # If step
-            self.galvo2_task.write(final_voltage)
+            galvo_daq.get_actor().write(self.galvo2_channel, final_voltage)  # Queued, the GUI does not wait for the driver
+            print(f"Galvo2 moved to {new_position_degrees} degrees.")
         else:
             num_samples = 10000
             sample_rate = num_samples * 1000 / duration_milliseconds
@@ -748,27 +725,13 @@ class Galvo2Control(QWidget):
             # Generate linear movement sequence
             voltages_sequence = np.linspace(initial_voltage, final_voltage, num_samples)
 
-            # Configure task to use clock
-            self.galvo2_task.timing.cfg_samp_clk_timing(
-                rate=min(sample_rate, max_sample_rate),
-                sample_mode=nidaqmx.constants.AcquisitionType.FINITE,
-                samps_per_chan=num_samples
-            )
-
-            # Write sequence to the task
-            writer = AnalogSingleChannelWriter(self.galvo2_task.out_stream)
-            writer.write_many_sample(voltages_sequence)
-
-            # Start the task
-            self.galvo2_task.start()
-            self.galvo2_task.wait_until_done()
-            self.galvo2_task.stop()
+            # Play the sequence from the device actor thread, the GUI does not wait for the move
+            galvo_daq.get_actor().play(self.galvo2_channel, voltages_sequence, min(sample_rate, max_sample_rate),
+                                       done=lambda: print(f"Galvo2 moved to {new_position_degrees} degrees."))
 
         # Update last position
         self.last_position_degrees = new_position_degrees
 
-        print(f"Galvo2 moved to {new_position_degrees} degrees.")
-
 class FilterWheelWidget(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent=parent)
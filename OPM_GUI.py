@@ -2,22 +2,26 @@
 # RAphael TOSCANO
 
 
-import nidaqmx  
 import numpy as np  
-from nidaqmx.stream_writers import AnalogSingleChannelWriter
-from nidaqmx.constants import Edge, AcquisitionType  
 import sys  
 from PyQt6.QtWidgets import (QApplication, QWidget, QPushButton, QVBoxLayout,
                               QHBoxLayout, QGroupBox, QFileDialog, QLabel, 
                               QSlider, QLineEdit ,QTabWidget,QMessageBox)
 from PyQt6.QtCore import QThread, pyqtSignal, QObject, Qt  
+import time
+from collections import namedtuple
+import galvo_engine
+import galvo_daq
+import galvo_presets
 
 # Galvo DATASHEET
 max_scan_angle = 12.5  # Max degrees (±12.5°)
 voltage_range = 10     # Max voltage output (±10 V)
-sample_rate = 10000    # Hz, same as nidaq
+sample_rate = galvo_engine.sample_rate    # Hz, same as nidaq
 
-ExposureTime = 10  # Default value
+default_exposure_time = 10  # ms, until set in the GUI
+# Immutable settings of the initialization phase, published by VoltageControlWidget
+InitSettings = namedtuple('InitSettings', ['version', 'min_voltage', 'max_voltage', 'galvo1_Value', 'exposure_time'])
 
 class GalvoWorker_initPhase(QObject): 
 
@@ -26,62 +30,60 @@ class GalvoWorker_initPhase(QObject):
 
     Attributes:
         finished (pyqtSignal): Signal emitted when the task is finished.
-        voltage_control_widget (VoltageControlWidget()): Reference to the voltage control widget.
+        settings_mailbox (SettingsMailbox): Settings snapshots published by the voltage control widget.
+        follower (SettingsFollower): Keeps the armed task loaded with the latest settings.
+        max_rate (float): Fastest sample clock of the device in Hz, read once.
         _is_running_init (bool): Flag to control the running state.
 
     Methods:
         run_initialisation(): Runs the Galvo initialization.
+        waveform(): Gives the frame to load for a settings snapshot.
         stop(): Stops the task.
     """
 
     finished = pyqtSignal()  # Signal to emit when the task is finished
 
-    def __init__(self, voltage_control_widget): 
+    def __init__(self, settings_mailbox): 
         super().__init__()
-        self.voltage_control_widget = voltage_control_widget  # Store the voltage control widget instance
+        self.settings_mailbox = settings_mailbox  # Snapshots pushed by the GUI thread
+        output = galvo_daq.RetriggerableOutput([galvo_daq.galvo1_channel], rate=sample_rate)  # Armed once for the whole phase
+        self.follower = galvo_daq.SettingsFollower(settings_mailbox, output, self.waveform, actor=galvo_daq.get_actor())
+        self.max_rate = galvo_daq.max_sample_rate()  # Read once, the model limit if the card cannot be queried
         self._is_running_init = True  # Flag to control the running state
 
     def run_initialisation(self):  # Method to run the galvo 
         """
         Method to run the Galvo initialization.
-        Continuously gets min and max voltage, galvo value, and factor to control the Galvo.
+        Waits for the min and max voltage and galvo value snapshots published by the GUI.
+        One retriggerable task stays armed and is only reloaded when a setting changes.
 
-        Runs until the _is_running_init flag is set to False.
+        Runs until stop() is called, sleeping while nothing changes.
         Emits finished signal when done.
         """
-        while self._is_running_init:  # Continue running while the flag is True
-            min_voltage = self.voltage_control_widget.get_min_voltage()  # Get the minimum voltage
-            max_voltage = self.voltage_control_widget.get_max_voltage()  # Get the maximum voltage
-            galvo1_Value = self.voltage_control_widget.get_galvo1_Value()
-
-            if min_voltage is not None and max_voltage is not None : # Check if min, max voltages and factor are set
-                duration_ms = ExposureTime + 22.937  # Calculate the duration in milliseconds
-                num_samples = int(sample_rate * (duration_ms / 1000))  # Convert duration to number of samples
-
-                voltages_sequence =  [galvo1_Value] * (num_samples+1)
-                data = np.vstack(voltages_sequence)
-
-                try:
-                    with nidaqmx.Task() as task:
-                        task.ao_channels.add_ao_voltage_chan('Dev1/ao17')
-                        task.triggers.start_trigger.cfg_dig_edge_start_trig("/Dev1/PFI1", trigger_edge=Edge.RISING)  # Configure a digital edge start trigger
-                        task.timing.cfg_samp_clk_timing(rate=sample_rate, sample_mode=AcquisitionType.FINITE, samps_per_chan=num_samples)  # Configure sample clock timing
-
-                        writer = AnalogSingleChannelWriter(task.out_stream)  # Create a writer for the task output stream
-                        writer.write_many_sample(data)  # Write the voltage sequence to the output stream
-                        task.start()  # Start the task
-                        task.wait_until_done(timeout=0.5)  # Wait until the task is done
-
-                except nidaqmx.errors.DaqError as e:  # Handle DAQ errors
-                    pass
+        self.follower.run()
+        metrics = self.follower.metrics
+        print(f"Initialization stopped: {metrics['reloads']} reloads, {metrics['errors']} DAQ errors, "
+              f"{metrics['wakeups']} wake-ups, CPU {metrics['cpu_fraction']:.2%} of {metrics['wall_s']:.1f} s.")
         self.finished.emit()  # Emit the finished signal
 
+    def waveform(self, snapshot):
+        """
+        Gives the frame to load for a settings snapshot, None until min and max voltages are set.
+        """
+        if snapshot.min_voltage is None or snapshot.max_voltage is None : # Check if min, max voltages are set
+            return None
+        rate = galvo_engine.pick_sample_rate([snapshot.exposure_time],  # Fewer samples for long exposures
+                                             max_rate=self.max_rate)
+        settings = (snapshot.min_voltage, snapshot.max_voltage, snapshot.galvo1_Value, snapshot.exposure_time, rate)
+        return settings, lambda: galvo_engine.static_waveform(snapshot.galvo1_Value, snapshot.exposure_time, rate), 1, rate
+
     def stop(self):
         """
         Method to stop the task.
-        Sets the _is_running_init flag to False.
+        Sets the _is_running_init flag to False and wakes the worker up.
         """
         self._is_running_init = False  # Set the running flag to False
+        self.follower.stop()
 
 class MainApp(QWidget):
     """
@@ -143,6 +145,9 @@ class VoltageControlWidget(QWidget):
         max_voltage (float): Maximum voltage value.
         factor (float): Factor value.
         galvo1_Value (float): Galvo value.
+        exposure_time (float): Exposure time in ms.
+        settings_version (int): Version of the last published snapshot.
+        settings_mailbox (SettingsMailbox): Latest settings snapshot, read by the worker threads.
 
     Methods:
         init_ui(): Initializes the UI components.
@@ -153,7 +158,9 @@ class VoltageControlWidget(QWidget):
         get_min_voltage(): Returns the minimum voltage.
         get_galvo1_Value(): Returns the Galvo value.
         apply_settings(): Applies exposure settings.
+        publish_settings(): Publishes an immutable snapshot of the settings for the worker threads.
         start_task(): Starts the Galvo task.
+        ensure_task(): Starts the Galvo task if it is not running.
         stop_task(): Stops the Galvo task.
     """
     def __init__(self): 
@@ -162,7 +169,11 @@ class VoltageControlWidget(QWidget):
         self.max_voltage = None  # Initialize maximum voltage
         self.setting_min = True  # Flag to control setting min voltage
         self.galvo1_Value = None
+        self.exposure_time = default_exposure_time
+        self.settings_version = 0
+        self.settings_mailbox = galvo_daq.SettingsMailbox()
         self.init_ui()  # Initialize the UI
+        self.publish_settings()
 
     def init_ui(self):  
         """
@@ -247,6 +258,7 @@ class VoltageControlWidget(QWidget):
         """
         voltage = self.slider.value() / 10.0  # Calculate the voltage from the slider value
         self.galvo1_Value = voltage
+        self.publish_settings()  # The galvo follows the slider
         self.label_voltage.setText(f'Voltage: {voltage:.1f} V')  # Update the voltage label
 
         angle = voltage * (max_scan_angle / voltage_range)  # Calculate the angle from the voltage
@@ -263,49 +275,34 @@ class VoltageControlWidget(QWidget):
     def set_max_voltage(self):     
         """
         Sets the maximum voltage based on the slider value.
-        Updates the max_voltage attribute and label.
+        Updates the max_voltage attribute and label, the device actor writes it to the device.
         """
-        self.stop_task()  # Stop the current task
-
         max_voltage = self.slider.value() / 10.0  # Get the max voltage from the slider
         self.max_voltage = max_voltage  # Set the max voltage
         self.label_max_voltage.setText(f'Max Voltage: {max_voltage:.1f} V')  # Update the max voltage label
         self.setting_min = False  # Set the flag to indicate max voltage is being set
         self.update_voltage_label()  # Update the voltage and angle labels
         print(f"Max voltage : {max_voltage} V ")
-        # Apply max voltage to the device
-        try:
-            with nidaqmx.Task() as task:  # Create a new NI-DAQmx task
-                task.ao_channels.add_ao_voltage_chan('Dev1/ao17')  # Add an analog output channel
-                task.start()  # Start the task
-                task.write(max_voltage)  # Write the max voltage to the channel
-        except nidaqmx.errors.DaqError as e:  # Handle DAQ errors
-            print(f"DAQ Error: {e}")
-
-        self.start_task()  # Restart the task
+        # Apply max voltage to the device, from the device actor thread
+        galvo_daq.get_actor().write(galvo_daq.galvo1_channel, max_voltage)
+        self.publish_settings()
+        self.ensure_task()  # The running worker picks the change up in place
 
     def set_min_voltage(self):  
         """
         Sets the minimum voltage based on the slider value.
-        Updates the min_voltage attribute and label.
+        Updates the min_voltage attribute and label, the device actor writes it to the device.
         """
-        self.stop_task()  # Stop the current task
         min_voltage = self.slider.value() / 10.0  # Get the min voltage from the slider
         self.min_voltage = min_voltage  # Set the min voltage
         self.label_min_voltage.setText(f'Min Voltage: {min_voltage:.1f} V')  # Update the min voltage label
         self.setting_min = True  # Set the flag to indicate min voltage is being set
         self.update_voltage_label()  # Update the voltage and angle labels
         print(f"Min voltage : {min_voltage} V ")
-        # Apply min voltage to the device
-        try:
-            with nidaqmx.Task() as task:  # Create a new NI-DAQmx task
-                task.ao_channels.add_ao_voltage_chan('Dev1/ao17')  # Add an analog output channel
-                task.start()  # Start the task
-                task.write(min_voltage)  # Write the min voltage to the channel
-        except nidaqmx.errors.DaqError as e:  # Handle DAQ errors
-            print(f"DAQ Error: {e}")
-
-        self.start_task()  # Restart the task
+        # Apply min voltage to the device, from the device actor thread
+        galvo_daq.get_actor().write(galvo_daq.galvo1_channel, min_voltage)
+        self.publish_settings()
+        self.ensure_task()  # The running worker picks the change up in place
 
     def get_max_voltage(self):
         """
@@ -325,20 +322,28 @@ class VoltageControlWidget(QWidget):
         """
         return self.galvo1_Value  # Return the galvo value
 
+    def publish_settings(self):
+        """
+        Publishes an immutable snapshot of the settings for the worker threads.
+        Called from the GUI thread each time a setting changes.
+        """
+        self.settings_version += 1
+        self.settings_mailbox.publish(InitSettings(self.settings_version, self.min_voltage, self.max_voltage, self.galvo1_Value,
+                                                   self.exposure_time))
+
     def apply_settings(self):  
         """
         Applies the exposure settings based on the input value.
-        Updates the ExposureTime variable.
+        Publishes the new exposure time with the other settings.
         """
-        self.stop_task()  # Stop the current task
         try:
             exposure_value = float(self.exposure_line_edit.text())  # Get the exposure time from the line edit
-            global ExposureTime  # Access the global variable
-            ExposureTime = exposure_value  # Set the exposure time
-            print(f"Exposure Time : {ExposureTime} ms")  # Print the new exposure time
+            self.exposure_time = exposure_value  # Set the exposure time
+            print(f"Exposure Time : {self.exposure_time} ms")  # Print the new exposure time
+            self.publish_settings()
         except ValueError:  # Handle invalid input
             print("Invalid exposure time entered.")
-        self.start_task()  # Restart the task
+        self.ensure_task()  # The running worker picks the change up in place
 
     def start_task(self):  
         """
@@ -346,7 +351,7 @@ class VoltageControlWidget(QWidget):
         Initializes and starts the GalvoWorker_initPhase.
         """
         self.thread = QThread()  # Create a new thread
-        self.galvo_worker = GalvoWorker_initPhase(self)  # Create a new galvo worker
+        self.galvo_worker = GalvoWorker_initPhase(self.settings_mailbox)  # Create a new galvo worker
         self.galvo_worker.moveToThread(self.thread)  # Move the worker to the new thread
         self.thread.started.connect(self.galvo_worker.run_initialisation)  # Connect the thread start to the worker run method
         self.galvo_worker.finished.connect(self.thread.quit)  # Connect the worker finished signal to the thread quit method
@@ -354,6 +359,14 @@ class VoltageControlWidget(QWidget):
         self.thread.finished.connect(self.thread.deleteLater)  # Connect the thread finished signal to the thread delete method
         self.thread.start()  # Start the thread
 
+    def ensure_task(self):
+        """
+        Starts the Galvo task if it is not running.
+        A running worker follows the published settings by itself, without a new thread.
+        """
+        if getattr(self, 'galvo_worker', None) is None:  # Check if the worker exists
+            self.start_task()
+
     def stop_task(self):  
         """
         Stops the Galvo task.
@@ -362,6 +375,7 @@ class VoltageControlWidget(QWidget):
             self.galvo_worker.stop()  # Stop the worker
             self.thread.quit()  # Quit the thread
             self.thread.wait()  # Wait for the thread to finish
+            self.galvo_worker = None
 
 
 class VoltageIntervalEditor(QWidget):
@@ -537,33 +551,7 @@ class VoltageIntervalEditor(QWidget):
             min_voltage (float): Minimum voltage value.
             max_voltage (float): Maximum voltage value.
         """
-        # Read the file content
-        with open(self.file_path, 'r', encoding='utf-8') as file:
-            lines = file.readlines()
-
-        # Find the position to insert new lines
-        insert_pos = -1
-        for i, line in enumerate(lines):
-            if "# Group: NiAO18_Galvo2" in line:
-                insert_pos = i + 3  # Insert after this line
-                break
-
-        if insert_pos == -1:
-            raise ValueError("The specified group was not found in the file.")
-
-        # Generate the new lines with comments
-        voltage_intervals = [round(min_voltage + i * interval, 4) for i in range(N)]
-        new_lines = []
-        for i, v in enumerate(voltage_intervals):
-            new_lines.append(f"# Preset: Position {i+1}\n")
-            new_lines.append(f"ConfigGroup,NiAO18_Galvo2,position{i+1},NIDAQAO-Dev1/ao18,Voltage,{v:.4f}\n")
-
-        # Insert the new lines
-        lines[insert_pos:insert_pos] = new_lines
-
-        # Write the updated content back to the file
-        with open(self.file_path, 'w', encoding='utf-8') as file:
-            file.writelines(lines)
+        galvo_presets.write_voltage_intervals(self.file_path, N, interval, min_voltage)  # Shared with the benchmarks, without Qt
 
     def erase_voltage_intervals(self):
         """
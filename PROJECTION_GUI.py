@@ -2,22 +2,38 @@
 # RAphael TOSCANO
 
 
-import nidaqmx  
 import numpy as np  
-from nidaqmx.stream_writers import  AnalogMultiChannelWriter
-from nidaqmx.constants import Edge, AcquisitionType  
 import sys  
 from PyQt6.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout, QHBoxLayout, QGroupBox, QTextEdit, QFileDialog, QLabel, QSlider, QLineEdit ,QTabWidget,QMessageBox
 from PyQt6.QtCore import QThread, pyqtSignal, QObject, Qt  
 import json
+import os
+import time
+from collections import namedtuple
+import galvo_engine
+import galvo_daq
+import galvo_timing
 
 # Galvo DATASHEET
 max_scan_angle = 12.5  # Max degrees (±12.5°)
 voltage_range = 10     # Max voltage output (±10 V)
-sample_rate = 10000    # Hz, same as nidaq
+sample_rate = galvo_engine.sample_rate    # Hz, same as nidaq
 
 
-ExposureTime = 10  # Default value
+default_exposure_time = 10  # ms, until set in the GUI
+default_roi_lines = galvo_engine.default_camera.roi_lines  # Full sensor, until set in the GUI
+# Immutable settings of the initialization phase, published by VoltageControlWidget
+InitSettings = namedtuple('InitSettings', ['version', 'min_voltage', 'max_voltage', 'factor', 'Galvo2_Enable', 'galvo2_Value', 'exposure_time',
+                                           'scan_mode', 'flyback', 'roi_lines', 'calibration'])
+calibration_edges = 30  # Trigger intervals timed to calibrate the dead time
+
+
+def snapshot_timing(snapshot):
+    """
+    Returns the source of the frame dead time of a settings snapshot: the calibration if measured, else the camera model.
+    """
+    return snapshot.calibration if snapshot.calibration is not None else galvo_engine.camera_timing(snapshot.roi_lines)
+
 
 class GalvoWorker_initPhase(QObject): 
     """
@@ -25,70 +41,104 @@ class GalvoWorker_initPhase(QObject):
     
     Attributes:
         finished (pyqtSignal): Signal emitted when the task is finished.
-        voltage_control_widget (VoltageControlWidget): Reference to the voltage control widget.
+        settings_mailbox (SettingsMailbox): Settings snapshots published by the voltage control widget.
+        follower (SettingsFollower): Keeps the armed task loaded with the latest settings.
+        max_rate (float): Fastest sample clock of the device in Hz, read once.
         _is_running_init (bool): Flag to control the running state.
         
     Methods:
         run_initialisation(): Runs the initialization process.
+        waveform(): Gives the frame to load for a settings snapshot.
         stop(): Stops the initialization process.
     """
     finished = pyqtSignal()  # Signal to emit when the task is finished
 
-    def __init__(self, voltage_control_widget): 
+    def __init__(self, settings_mailbox): 
         super().__init__()
-        self.voltage_control_widget = voltage_control_widget  # Store the voltage control widget instance
+        self.settings_mailbox = settings_mailbox  # Snapshots pushed by the GUI thread
+        output = galvo_daq.RetriggerableOutput([galvo_daq.galvo1_channel, galvo_daq.galvo2_channel], rate=sample_rate)  # Armed once for the whole phase
+        self.follower = galvo_daq.SettingsFollower(settings_mailbox, output, self.waveform, actor=galvo_daq.get_actor())
+        self.max_rate = galvo_daq.max_sample_rate()  # Read once, the model limit if the card cannot be queried
         self._is_running_init = True  # Flag to control the running state
 
     def run_initialisation(self):
         """
         Method to run the Galvo initialization process.
-        Generates and writes voltage sequences to the Galvo.
+        Keeps one retriggerable task armed and reloads its voltage sequence
+        only when a new settings snapshot is published. The thread sleeps
+        until then, even while the voltages are not set.
         """
-        while self._is_running_init:  # Continue running while the flag is True
-            min_voltage = self.voltage_control_widget.get_min_voltage()  # Get the minimum voltage
-            max_voltage = self.voltage_control_widget.get_max_voltage()  # Get the maximum voltage
-            Galvo2_Enable = self.voltage_control_widget.get_Galvo2_Enable()
-            galvo2_Value = self.voltage_control_widget.get_galvo2_Value()
-            factor = self.voltage_control_widget.get_factor()  # Get the factor
-
-            if min_voltage is not None and max_voltage is not None and factor is not None:  # Check if min, max voltages and factor are set
-                initial_voltage = min_voltage  # Set initial voltage
-                final_voltage = max_voltage  # Set final voltage
-                duration_ms = ExposureTime + 22.937  # Calculate the duration in milliseconds
-                num_samples = int(sample_rate * (duration_ms / 1000))  # Convert duration to number of samples
-
-                voltages_sequence = np.linspace(initial_voltage, final_voltage, num_samples)  # Generate ramp sequence
-                voltages_sequence = np.append(voltages_sequence, initial_voltage)  # Append the initial voltage as the last value
+        self.follower.run()
+        metrics = self.follower.metrics
+        print(f"Initialization stopped: {metrics['reloads']} reloads, {metrics['errors']} DAQ errors, "
+              f"{metrics['wakeups']} wake-ups, CPU {metrics['cpu_fraction']:.2%} of {metrics['wall_s']:.1f} s.")
+        self.finished.emit()  # Emit the finished signal
 
-                if (Galvo2_Enable== True) :
-                    voltages_sequence2 = np.linspace(initial_voltage * factor, final_voltage * factor, num_samples)  # Generate ramp sequence with factor
-                    voltages_sequence2 = np.append(voltages_sequence2, initial_voltage * factor)  # Append the initial voltage as the last value
-                else :
-                    voltages_sequence2 = [galvo2_Value] * (num_samples+1)
+    def waveform(self, snapshot):
+        """
+        Gives the frame to load for a settings snapshot.
 
-                data = np.vstack((voltages_sequence, voltages_sequence2)).astype(np.float64)  # Stack arrays in sequence vertically
+        Args:
+            snapshot (InitSettings): Settings published by the voltage control widget.
 
-                try:
-                    with nidaqmx.Task() as task:
-                        task.ao_channels.add_ao_voltage_chan('Dev1/ao17')
-                        task.ao_channels.add_ao_voltage_chan('Dev1/ao18')
-                        task.triggers.start_trigger.cfg_dig_edge_start_trig("/Dev1/PFI1", trigger_edge=Edge.RISING)  # Configure a digital edge start trigger
-                        task.timing.cfg_samp_clk_timing(rate=sample_rate, sample_mode=AcquisitionType.FINITE, samps_per_chan=num_samples)  # Configure sample clock timing
-
-                        writer = AnalogMultiChannelWriter(task.out_stream)  # Create a writer for the task output stream
-                        writer.write_many_sample(data)  # Write the voltage sequence to the output stream
-                        task.start()  # Start the task
-                        task.wait_until_done(timeout=0.5)  # Wait until the task is done
-
-                except nidaqmx.errors.DaqError as e:  # Handle DAQ errors
-                    pass
-        self.finished.emit()  # Emit the finished signal
+        Returns:
+            tuple or None: (settings, frame builder, frames in the buffer, sample rate), None until min, max voltages and factor are set.
+        """
+        if snapshot.min_voltage is None or snapshot.max_voltage is None or snapshot.factor is None:  # Check if min, max voltages and factor are set
+            return None
+        timing = snapshot_timing(snapshot)
+        rate = galvo_engine.pick_sample_rate([snapshot.exposure_time], timing,  # Fewer samples for long exposures
+                                             max_rate=self.max_rate)
+        settings = (snapshot.min_voltage, snapshot.max_voltage, snapshot.factor, snapshot.Galvo2_Enable, snapshot.galvo2_Value,
+                    snapshot.exposure_time, snapshot.scan_mode, snapshot.flyback, timing, rate)
+        try:
+            frame = galvo_engine.init_phase_waveform(*settings)  # Cached, so only built once per settings
+        except ValueError as e:  # A ramp or return faster than the galvo allows
+            print(f"Invalid scan settings: {e}")
+            return None
+        frames = 2 if snapshot.scan_mode == 'bidirectional' else 1  # Forward and backward sweeps in turn
+        return settings, lambda: frame, frames, rate
 
     def stop(self):  
         """
         Method to stop the Galvo initialization process.
         """
         self._is_running_init = False  # Set the running flag to False
+        self.follower.stop()  # Wakes the worker up
+
+
+class CalibrationWorker(QObject):
+    """
+    Worker class measuring the camera dead time away from the GUI thread.
+
+    Attributes:
+        finished (pyqtSignal): Signal emitted with the new calibration, None if the measurement failed.
+        exposure_time (float): Exposure to calibrate in ms.
+        calibration (DeadTimeCalibration or None): Calibration the exposure is added to.
+        roi_lines (int): ROI height the measurement is made at.
+
+    Methods:
+        run_calibration(): Times the trigger edges and emits the calibration.
+    """
+    finished = pyqtSignal(object)  # Signal to emit with the calibration when the measurement ends
+
+    def __init__(self, exposure_time, calibration, roi_lines):
+        super().__init__()
+        self.exposure_time = exposure_time
+        self.calibration = calibration
+        self.roi_lines = roi_lines
+
+    def run_calibration(self):
+        """
+        Method to time the trigger edges of the free-running camera at the exposure.
+        Blocks for calibration_edges camera frames, which is why it runs in its own thread.
+        """
+        try:
+            calibration = galvo_daq.calibrate_dead_time([self.exposure_time], edges=calibration_edges, calibration=self.calibration)
+        except (galvo_daq.DaqError, ValueError) as e:
+            print(f"Dead time calibration failed: {e}")
+            calibration = None
+        self.finished.emit(calibration)  # Queued to the GUI thread
 
 
 class GalvoWorker_MDA(QObject):  
@@ -100,11 +150,16 @@ class GalvoWorker_MDA(QObject):
         voltage_control_widget (VoltageControlWidget): Reference to the voltage control widget.
         file_explorer_widget (FileExplorerWidget): Reference to the file explorer widget.
         MDA_is_running (bool): Flag to control the running state.
+        player (RetriggerablePlayer or None): Player of the running MDA.
         
     Methods:
         increase_range(): Increases the voltage range using the factor.
+        compile_plan(): Compiles the whole MDA schedule in one batched computation.
+        plan_settings(): Gathers the settings the schedule is built from.
+        stream_plan(): Builds the lazy MDA schedule used by run_MDA.
         generate_voltage_sequences(): Generates voltage sequences based on the acquisition order.
         run_MDA(): Runs the MDA process.
+        frame_done(): Reports a played frame.
         stop(): Stops the MDA process.
     """
     finished = pyqtSignal()  # Signal to emit when the task is finished
@@ -114,6 +169,7 @@ class GalvoWorker_MDA(QObject):
         self.voltage_control_widget = voltage_control_widget  # Store the voltage control widget instance
         self.MDA_is_running = True  # Flag to control the running state
         self.file_explorer_widget = file_explorer_widget  # Store the file explorer widget instance
+        self.player = None
 
     def increase_range(self,factor):
         """
@@ -124,158 +180,139 @@ class GalvoWorker_MDA(QObject):
         """
         min_voltage = self.voltage_control_widget.get_min_voltage()  # Get the minimum voltage
         max_voltage = self.voltage_control_widget.get_max_voltage()  # Get the maximum voltage
-        center = (min_voltage + max_voltage) / 2
-        half_range = (max_voltage - min_voltage) / 2
-        half_range_new = half_range * factor
-        min_new = center - half_range_new
-        max_new = center + half_range_new
-
-        if (min_new<=-10) :
-            min_new =-10 
-        elif (min_new>=10) :
-            min_new =10 
-        else :  
-            min_new = center - half_range_new
-        if (max_new<=-10) :
-            max_new =-10 
-        elif (max_new>=10) :
-            max_new =10 
-        else :  
-            max_new = center + half_range_new
-
-
-        return min_new, max_new
-    
-    def generate_voltage_sequences(self):
+        return galvo_engine.increase_range(min_voltage, max_voltage, factor)
+
+    def compile_plan(self):
         """
-        Generates voltage sequences based on the acquisition order.
+        Compiles the whole MDA schedule from the GUI settings and the MDA sequence file.
 
         Returns:
-            tuple: All sequences, all sequences with factor, and duration list.
+            MDAPlan: galvo1/galvo2 samples of every frame and their durations.
         """
-        factor = self.voltage_control_widget.get_factor()  # Get the minimum factor value
-        Acq_order = self.file_explorer_widget.Acq_order
-        num_frames = self.file_explorer_widget.num_frames
-        num_slices = self.file_explorer_widget.num_slices
-        exposure_times = self.file_explorer_widget.exposure_values
-        FW = self.file_explorer_widget.FW
-        amp = self.file_explorer_widget.amp
-        min_voltage = self.voltage_control_widget.get_min_voltage()  # Get the minimum voltage
-        max_voltage = self.voltage_control_widget.get_max_voltage()  # Get the maximum voltage
-        Galvo2_Enable = self.voltage_control_widget.get_Galvo2_Enable()
-        galvo2_Value = self.voltage_control_widget.get_galvo2_Value()
+        return galvo_engine.compile_mda_plan(**self.plan_settings())
 
-        
+    def plan_settings(self):
+        """
+        Gathers the settings the MDA schedule is built from.
+        The voltages come from the latest snapshot published by the voltage control widget.
 
+        Returns:
+            dict: Keyword arguments of galvo_engine.compile_mda_plan.
+        """
+        snapshot = self.voltage_control_widget.settings_mailbox.latest()
+        timing = snapshot_timing(snapshot)
+        return dict(
+            min_voltage=snapshot.min_voltage,
+            max_voltage=snapshot.max_voltage,
+            factor=snapshot.factor,
+            Galvo2_Enable=snapshot.Galvo2_Enable,
+            galvo2_Value=snapshot.galvo2_Value,
+            exposure_times=self.file_explorer_widget.exposure_values,
+            num_frames=self.file_explorer_widget.num_frames,
+            num_slices=self.file_explorer_widget.num_slices,
+            Acq_order=self.file_explorer_widget.Acq_order,
+            FW=self.file_explorer_widget.FW,
+            amp=self.file_explorer_widget.amp,
+            scan_mode=snapshot.scan_mode,
+            flyback=snapshot.flyback,
+            timing=timing,
+            rate=galvo_engine.channel_rates('adaptive', self.file_explorer_widget.exposure_values, timing,  # Picked from the exposures
+                                            galvo_daq.max_sample_rate()),
+        )
+
+    def stream_plan(self):
+        """
+        Builds the lazy MDA schedule from the GUI settings and the MDA sequence file.
 
-        # Create a unique list of scale factors
-        if factor<=0 :
-            factor_list_unique = np.linspace(factor, -1.0, int(amp)).tolist()
-        else :
-            factor_list_unique = np.linspace(factor, 1.0, int(amp)).tolist()
-        
-        # Flatten the list by repeating factor_list_unique for each filter wheel (FW)
-        factor_list = factor_list_unique * FW
+        Returns:
+            StreamingMDAPlan: Frames produced on demand, constant memory.
+        """
+        return galvo_engine.stream_mda_plan(**self.plan_settings())
 
+    def generate_voltage_sequences(self):
+        """
+        Generates voltage sequences based on the acquisition order.
+
+        Returns:
+            tuple: All sequences, all sequences with factor, and duration list.
+        """
+        plan = self.compile_plan()
         all_sequences = []
         all_sequences2 = []  # With factor
-        duration_list = []
-
-        # print(exposure_times)
-        # print(factor_list)
-
-        if Acq_order == 0:
-            for frame_index in range(num_frames):
-                for slice_index in range(num_slices):                    
-                    for i, exposure_time in enumerate(exposure_times):  # `i` is guaranteed to be an integer
-                        duration_ms = exposure_time + 22.937  # Now `exposure_time` is directly accessed
-                        num_samples = int(sample_rate * (duration_ms / 1000))
-
-                        # Original sequence
-                        voltages_sequence = np.linspace(min_voltage, max_voltage, num_samples)
-                        voltages_sequence = np.append(voltages_sequence, min_voltage)
-                        all_sequences.append(voltages_sequence)
-
-                        # New sequence with scale factor voltage range
-                        factor = factor_list[i]  # Get the correct factor
-                        min_voltage_new, max_voltage_new = self.increase_range(factor)
-
-                        if Galvo2_Enable:
-                            voltages_sequence_new = np.linspace(min_voltage_new, max_voltage_new, num_samples)
-                            voltages_sequence_new = np.append(voltages_sequence_new, min_voltage_new)
-                            all_sequences2.append(voltages_sequence_new)
-                        else:
-                            voltages_sequence_new = np.linspace(galvo2_Value, galvo2_Value, num_samples)
-                            voltages_sequence_new = np.append(voltages_sequence_new, galvo2_Value)
-                            all_sequences2.append(voltages_sequence_new)
-
-                        duration_list.append(duration_ms)
-        elif Acq_order == 1:
-            for frame_index in range(num_frames):
-                for i, exposure_time in enumerate(exposure_times):
-                    for slice_index in range(num_slices):
-
-                        duration_ms = exposure_time + 22.937
-                        num_samples = int(sample_rate * (duration_ms / 1000))
-
-                        # Original sequence
-                        voltages_sequence = np.linspace(min_voltage, max_voltage, num_samples)
-                        voltages_sequence = np.append(voltages_sequence, min_voltage)
-                        all_sequences.append(voltages_sequence)
-                        factor = factor_list[i]  # Get the correct factor
-                        min_voltage_new, max_voltage_new = self.increase_range(factor)
-
-                        # New sequence with enlarged voltage range
-                        if Galvo2_Enable:
-                            voltages_sequence_new = np.linspace(min_voltage_new, max_voltage_new, num_samples)
-                            voltages_sequence_new = np.append(voltages_sequence_new, min_voltage_new)
-                            all_sequences2.append(voltages_sequence_new)
-                        else:
-                            voltages_sequence_new = np.linspace(galvo2_Value, galvo2_Value, num_samples)
-                            voltages_sequence_new = np.append(voltages_sequence_new, galvo2_Value)
-                            all_sequences2.append(voltages_sequence_new)
-                        
-                        duration_list.append(duration_ms)
+        for i in range(len(plan)):
+            voltages_sequence, voltages_sequence_new = plan.frame(i)  # Views on the compiled plan
+            all_sequences.append(voltages_sequence)
+            all_sequences2.append(voltages_sequence_new)
+        duration_list = plan.durations_ms.tolist()
 
         return all_sequences, all_sequences2, duration_list
     
     def run_MDA(self):  
         """
         Method to run the Galvo MDA task.
-        Generates and writes voltage sequences to the Galvo.
+        Streams the plan through a single retriggerable task, each camera trigger
+        advancing to the next frame. Frames are produced on demand, so the memory
+        does not grow with the number of time points.
+        The per-frame timestamps are written to a CSV file next to the sequence file at the end of the run.
+        stop() aborts the run and parks the galvos within galvo_daq.cancel_deadline.
         """
-        all_sequences,all_sequences2,duration_list = self.generate_voltage_sequences()  # Generate voltage sequences
-
+        timeline = galvo_timing.FrameTimeline()
         try:
-            for i in range(len(all_sequences)):
-                with nidaqmx.Task() as task:
-                    task.ao_channels.add_ao_voltage_chan('Dev1/ao17')
-                    task.ao_channels.add_ao_voltage_chan('Dev1/ao18')
-                    task.timing.cfg_samp_clk_timing(rate=sample_rate, sample_mode=AcquisitionType.FINITE, samps_per_chan=int(sample_rate * (duration_list[i] / 1000)) + 1)
-                    task.triggers.start_trigger.cfg_dig_edge_start_trig("/Dev1/PFI1", trigger_edge=Edge.RISING)
+            plan = self.stream_plan()  # Lazy MDA schedule
+        except ValueError as e:  # A ramp or return faster than the galvo allows
+            print(f"MDA not started: {e}")
+            self.finished.emit()
+            return
+        rates = ', '.join(f'{rate:.0f}' for rate in sorted(set(plan.channel_rates.tolist())))  # One per exposure
+        print(f"Sample clock {rates} Hz, {plan.transfer_bytes() / 1e6:.2f} MB to transfer for {len(plan)} frames.")
+        player = galvo_daq.RetriggerablePlayer(plan, frame_done=self.frame_done, raw=True,  # int16 DAC codes, at the rate of the plan
+                                             pipeline_depth=8,  # Next frames prepared while the current one plays
+                                             ping_pong=True,  # Next block verified on a spare task
+                                             timeline=timeline)
+        self.player = player
+        if not self.MDA_is_running:  # Stopped while the plan was built
+            player.cancel()
 
-                    data = np.vstack((all_sequences[i], all_sequences2[i]))   #Stack arrays in sequence vertically
-
-                    writer = AnalogMultiChannelWriter(task.out_stream)
-                    writer.write_many_sample(data)
-                    task.start()
-                    task.wait_until_done(timeout=10000)
-                    task.stop()
-
-                    print(f"Frame {i + 1} completed.")
-                    i += 1
-
-            print("All sequences completed.")
-
-        except nidaqmx.errors.DaqError :
-            pass
+        try:
+            stats = player.play(timeout=10000)
+            if stats['cancelled']:
+                print(f"MDA cancelled after {stats['frames']} frames, galvos parked in {stats['cancel_latency_ms']:.1f} ms.")
+                if stats['cancel_deadline_missed']:
+                    print(f"Galvos parked later than the {galvo_daq.cancel_deadline * 1e3:.0f} ms deadline.")
+            else:
+                print("All sequences completed.")
+            print(f"{stats['coalesced_frames']} frames coalesced, {stats['overruns']} overruns, {stats['round_trips_saved']} driver round-trips saved, "
+                  f"{stats['bytes_written'] / 1e6:.2f} MB transferred.")
+
+        except (galvo_daq.DaqError, TimeoutError, galvo_daq.FrameOverrun) as e:
+            timeline.error(e)
+            print(f"MDA stopped: {e}")
+        finally:
+            print(timeline.format_summary())
+            sequence_file = self.file_explorer_widget.file_path
+            if sequence_file is not None:  # Next to the sequence, not in the directory the GUI was started from
+                timing_file = os.path.splitext(sequence_file)[0] + time.strftime('_timing_%Y%m%d_%H%M%S.csv')
+                try:
+                    timeline.save_csv(timing_file)
+                    print(f"Frame timings saved to {timing_file}")
+                except OSError as e:  # Read-only sequence directory
+                    print(f"Error saving the frame timings: {e}")
         self.finished.emit()
 
+    def frame_done(self, i):
+        """
+        Called by the player each time a frame has been played.
+        """
+        print(f"Frame {i + 1} completed.")
+
     def stop(self):  
         """
         Method to stop the Galvo MDA task.
+        Can be called from the GUI thread: the player aborts on its next poll of the device.
         """
-        self._is_running_init = False  # Set the running flag to False
+        self.MDA_is_running = False  # Set the running flag to False
+        if self.player is not None:
+            self.player.cancel()
 
 class MainApp(QWidget):
     """
@@ -285,12 +322,15 @@ class MainApp(QWidget):
         voltage_control_widget (VoltageControlWidget): Reference to the voltage control widget.
         file_explorer_widget (FileExplorerWidget): Reference to the file explorer widget.
         btn_start_MDA (QPushButton): Button to start the MDA process.
+        btn_stop_MDA (QPushButton): Button to cancel the running MDA.
         thread (QThread): Thread for running the Galvo MDA task.
         galvo_worker_MDA (GalvoWorker_MDA): Worker instance for running the Galvo MDA task.
         
     Methods:
         init_ui(): Initializes the UI components.
         start_MDA(): Starts the MDA process.
+        stop_MDA(): Cancels the running MDA and parks the galvos.
+        MDA_finished(): Updates the buttons at the end of the MDA.
     """
     def __init__(self):
         super().__init__()
@@ -323,6 +363,10 @@ class MainApp(QWidget):
         self.btn_start_MDA.clicked.connect(self.voltage_control_widget.stop_task)
         self.btn_start_MDA.clicked.connect(self.start_MDA)
         middle_panel_mda.addWidget(self.btn_start_MDA)
+        self.btn_stop_MDA = QPushButton('Stop MDA')
+        self.btn_stop_MDA.setEnabled(False)
+        self.btn_stop_MDA.clicked.connect(self.stop_MDA)
+        middle_panel_mda.addWidget(self.btn_stop_MDA)
         layout_mda_tab.addLayout(middle_panel_mda)  # Add right panel to the MDA tab layout
         tab_widget.addTab(mda_tab, 'MDA projection')
 
@@ -334,17 +378,32 @@ class MainApp(QWidget):
         Method to start the MDA process.
         """
         self.btn_start_MDA.setEnabled(False)
+        self.btn_stop_MDA.setEnabled(True)
 
         print("MDA started")  # Print a message
         self.thread = QThread()  # Create a new thread
         self.galvo_worker_MDA = GalvoWorker_MDA(self.voltage_control_widget, self.file_explorer_widget)  # Pass both widgets
         self.galvo_worker_MDA.moveToThread(self.thread)  # Move the worker to the new thread
         self.thread.started.connect(self.galvo_worker_MDA.run_MDA)  # Connect the thread start to the worker run method
+        self.galvo_worker_MDA.finished.connect(self.MDA_finished)  # Runs in the GUI thread
         self.galvo_worker_MDA.finished.connect(self.thread.quit)  # Connect the worker finished signal to the thread quit method
         self.galvo_worker_MDA.finished.connect(self.galvo_worker_MDA.deleteLater)  # Connect the worker finished signal to the worker delete method
         self.thread.finished.connect(self.thread.deleteLater)  # Connect the thread finished signal to the thread delete method
         self.thread.start()  # Start the thread
 
+    def stop_MDA(self):
+        """
+        Method to cancel the running MDA process.
+        """
+        self.btn_stop_MDA.setEnabled(False)
+        self.galvo_worker_MDA.stop()  # Direct call: the worker thread is busy playing
+
+    def MDA_finished(self):
+        """
+        Method called when the MDA process ends, completed or cancelled.
+        """
+        self.btn_stop_MDA.setEnabled(False)
+
 
 class VoltageControlWidget(QWidget): 
     """
@@ -357,10 +416,19 @@ class VoltageControlWidget(QWidget):
         setting_min (bool): Indique si la tension minimale est en cours de définition.
         Galvo2_Enable (bool): Indique si le Galvo2 est activé ou non.
         galvo2_Value (float or None): Valeur de tension pour le Galvo2.
+        exposure_time (float): Temps d'exposition en ms.
+        scan_mode (str): 'unidirectional' (retour au début après chaque image) ou 'bidirectional' (balayages alternés).
+        flyback (str): Retour du balayage unidirectionnel, 'step' (saut en un échantillon) ou 'shaped' (retour lisse en temps minimal).
+        roi_lines (int): Hauteur de la ROI de la caméra en lignes, qui fixe le temps mort de chaque image.
+        calibration (DeadTimeCalibration or None): Temps mort mesuré sur la caméra par exposition, remplace le modèle s'il existe.
+        settings_version (int): Version du dernier instantané publié.
+        settings_mailbox (SettingsMailbox): Dernier instantané des paramètres, lu par les threads de travail.
         
     Méthodes:
         init_ui(): Initialise les composants de l'interface utilisateur.
         toggle_slider(): Active ou désactive le contrôle du Galvo2.
+        toggle_scan_mode(): Bascule entre balayage unidirectionnel et bidirectionnel.
+        toggle_flyback(): Bascule entre retour en un saut et retour lisse.
         get_Galvo2_Enable(): Retourne l'état d'activation du Galvo2.
         update_voltage_label(): Met à jour les étiquettes de tension et d'angle pour le Galvo principal.
         update_galvo2_position_label(): Met à jour les étiquettes de tension et d'angle pour le Galvo2.
@@ -374,7 +442,11 @@ class VoltageControlWidget(QWidget):
         set_factor_value(): Définit le facteur de multiplication et l'applique.
         get_factor(): Retourne le facteur de multiplication défini.
         apply_settings(): Applique les paramètres d'exposition.
+        calibrate_dead_time(): Lance dans un thread de travail la mesure du temps mort de la caméra en libre cours à l'exposition actuelle.
+        calibration_done(): Utilise la calibration mesurée par le thread de travail et la publie.
+        publish_settings(): Publie un instantané immuable des paramètres pour les threads de travail.
         start_task(): Démarre le processus de tâche dans un nouveau thread.
+        ensure_task(): Démarre le thread de travail s'il ne tourne pas déjà.
         stop_task(): Arrête le processus de tâche en cours.
     """
     def __init__(self): 
@@ -386,6 +458,14 @@ class VoltageControlWidget(QWidget):
         self.init_ui()  # Initialize the UI
         self.Galvo2_Enable = True
         self.galvo2_Value = None
+        self.exposure_time = default_exposure_time
+        self.scan_mode = 'unidirectional'
+        self.flyback = 'step'
+        self.roi_lines = default_roi_lines
+        self.calibration = None
+        self.settings_version = 0
+        self.settings_mailbox = galvo_daq.SettingsMailbox()
+        self.publish_settings()
 
     def init_ui(self):  # Method to initialize the UI
         main_layout = QVBoxLayout()  # Create the main vertical layout
@@ -398,10 +478,18 @@ class VoltageControlWidget(QWidget):
         self.exposure_line_edit.setPlaceholderText('Enter Exposure Time (ms) (same as MM)')  # Set placeholder text
         exposure_layout.addWidget(self.exposure_line_edit)  # Add the line edit to the layout
 
+        self.roi_line_edit = QLineEdit()  # Create a line edit for the ROI height
+        self.roi_line_edit.setPlaceholderText(f'Enter ROI Height (lines) (full sensor: {default_roi_lines})')  # Set placeholder text
+        exposure_layout.addWidget(self.roi_line_edit)  # Add the line edit to the layout
+
         self.btn_apply = QPushButton('Set Exposure')  # Create a button to set exposure
         self.btn_apply.clicked.connect(self.apply_settings)  # Connect the button click to the apply settings method
         exposure_layout.addWidget(self.btn_apply)  # Add the button to the layout
 
+        self.btn_calibrate = QPushButton('Calibrate Dead Time')  # Create a button to measure the dead time
+        self.btn_calibrate.clicked.connect(self.calibrate_dead_time)  # Connect the button click to the calibration method
+        exposure_layout.addWidget(self.btn_calibrate)  # Add the button to the layout
+
         exposure_group.setLayout(exposure_layout)  # Set the layout for the group box
         main_layout.addWidget(exposure_group)  # Add the exposure group to the main layout
 
@@ -454,6 +542,13 @@ class VoltageControlWidget(QWidget):
         hbox_ranges.addWidget(self.group_box_min_max_degrees)  # Add the group box to the ranges layout
 
         min_max_layout.addLayout(hbox_ranges)  # Add the ranges layout to the min_max_layout
+
+        self.btn_scan_mode = QPushButton('Bidirectional Scan')  # Create a button to switch the scan mode
+        self.btn_scan_mode.clicked.connect(self.toggle_scan_mode)  # Connect the button click to the toggle method
+        min_max_layout.addWidget(self.btn_scan_mode)  # Add the button to the layout
+        self.btn_flyback = QPushButton('Shaped Flyback')  # Create a button to switch the return of the scan
+        self.btn_flyback.clicked.connect(self.toggle_flyback)  # Connect the button click to the toggle method
+        min_max_layout.addWidget(self.btn_flyback)  # Add the button to the layout
         min_max_group.setLayout(min_max_layout)  # Set the layout for the group box
         main_layout.addWidget(min_max_group)  # Add the min_max group to the main layout
         # Factor and Galvo2 Block
@@ -536,6 +631,7 @@ class VoltageControlWidget(QWidget):
             self.slider3.setEnabled(True)
             self.Galvo2_Enable = False
             self.btn_toggle_slider.setText('2nd Galvo with Ramp')
+            self.publish_settings()
         else:
             self.slider2.setEnabled(True)
             self.btn_set_factor.setEnabled(True)
@@ -545,6 +641,35 @@ class VoltageControlWidget(QWidget):
 
             self.Galvo2_Enable = True
             self.btn_toggle_slider.setText(' Static 2nd Galvo')
+            self.publish_settings()
+
+    def toggle_scan_mode(self):
+        """
+        Switches between the unidirectional scan, flying back after every frame, and the
+        bidirectional scan, alternate frames sweeping back from max to min.
+        """
+        if self.scan_mode == 'unidirectional':
+            self.scan_mode = 'bidirectional'
+            self.btn_scan_mode.setText('Unidirectional Scan')
+        else:
+            self.scan_mode = 'unidirectional'
+            self.btn_scan_mode.setText('Bidirectional Scan')
+        print(f"Scan mode : {self.scan_mode}")
+        self.publish_settings()
+
+    def toggle_flyback(self):
+        """
+        Switches the return of the unidirectional scan between the one sample step and the
+        smooth minimum-time return, whose time pads the frames instead of the settle time.
+        """
+        if self.flyback == 'step':
+            self.flyback = 'shaped'
+            self.btn_flyback.setText('Step Flyback')
+        else:
+            self.flyback = 'step'
+            self.btn_flyback.setText('Shaped Flyback')
+        print(f"Flyback : {self.flyback}")
+        self.publish_settings()
 
     def get_Galvo2_Enable(self) :
         """
@@ -601,79 +726,56 @@ class VoltageControlWidget(QWidget):
         """
         Sets the maximum voltage based on the current slider value.
 
-        This method stops the current task, updates the maximum voltage, and writes the
-        value to the device. It also updates the max voltage label and restarts the task.
+        This method updates the maximum voltage and the max voltage label, and has the
+        device actor write the value and the running worker follow the new settings.
         """
-
-        self.stop_task()  # Stop the current task
-
         max_voltage = self.slider.value() / 10.0  # Get the max voltage from the slider
         self.max_voltage = max_voltage  # Set the max voltage
         self.label_max_voltage.setText(f'Max Voltage: {max_voltage:.1f} V')  # Update the max voltage label
         self.setting_min = False  # Set the flag to indicate max voltage is being set
         self.update_voltage_label()  # Update the voltage and angle labels
         print(f"Max voltage : {max_voltage} V ")
-        # Apply max voltage to the device
-        try:
-            with nidaqmx.Task() as task:  # Create a new NI-DAQmx task
-                task.ao_channels.add_ao_voltage_chan('Dev1/ao17')  # Add an analog output channel
-                task.start()  # Start the task
-                task.write(max_voltage)  # Write the max voltage to the channel
-        except nidaqmx.errors.DaqError as e:  # Handle DAQ errors
-            print(f"DAQ Error: {e}")
-
-        self.start_task()  # Restart the task
+        # Apply max voltage to the device, from the device actor thread
+        galvo_daq.get_actor().write(galvo_daq.galvo1_channel, max_voltage)
+        self.publish_settings()
+        self.ensure_task()  # The running worker picks the change up in place
 
     def set_galvo2_voltage(self):  
         """
         Sets the galvo2 voltage based on the current slider value.
 
-        This method stops the current task, updates the galvo2 voltage, and writes the
-        value to the device. It also updates the galvo2 voltage label and restarts the task.
+        This method updates the galvo2 voltage and the galvo2 voltage label, and has the
+        device actor write the value and the running worker follow the new settings.
         """
-        self.stop_task()  # Stop the current task
         galvo2_Value = self.slider3.value() / 10.0  # Get the min voltage from the slider
         self.galvo2_Value = galvo2_Value
         self.label_voltage_galvo2.setText(f'Min Voltage: {galvo2_Value:.1f} V')  # Update the min voltage label
         self.setting_min = True  # Set the flag to indicate min voltage is being set
         self.update_galvo2_position_label()  # Update the voltage and angle labels
         print(f"Min voltage : {galvo2_Value} V ")
-        # Apply min voltage to the device
-        try:
-            with nidaqmx.Task() as task:  # Create a new NI-DAQmx task
-                task.ao_channels.add_ao_voltage_chan('Dev1/ao18')  # Add an analog output channel
-                task.start()  # Start the task
-                task.write(galvo2_Value)  # Write the min voltage to the channel
-        except nidaqmx.errors.DaqError as e:  # Handle DAQ errors
-            print(f"DAQ Error: {e}")
-
-        self.start_task()  # Restart the task
+        # Apply galvo2 voltage to the device, from the device actor thread
+        galvo_daq.get_actor().write(galvo_daq.galvo2_channel, galvo2_Value)
+        self.publish_settings()
+        self.ensure_task()  # The running worker picks the change up in place
 
 
     def set_min_voltage(self):  
         """
         Sets the minimum voltage based on the current slider value.
 
-        This method stops the current task, updates the minimum voltage, and writes the
-        value to the device. It also updates the min voltage label and restarts the task.
+        This method updates the minimum voltage and the min voltage label, and has the
+        device actor write the value and the running worker follow the new settings.
         """
-        self.stop_task()  # Stop the current task
         min_voltage = self.slider.value() / 10.0  # Get the min voltage from the slider
         self.min_voltage = min_voltage  # Set the min voltage
         self.label_min_voltage.setText(f'Min Voltage: {min_voltage:.1f} V')  # Update the min voltage label
         self.setting_min = True  # Set the flag to indicate min voltage is being set
         self.update_voltage_label()  # Update the voltage and angle labels
         print(f"Min voltage : {min_voltage} V ")
-        # Apply min voltage to the device
-        try:
-            with nidaqmx.Task() as task:  # Create a new NI-DAQmx task
-                task.ao_channels.add_ao_voltage_chan('Dev1/ao17')  # Add an analog output channel
-                task.start()  # Start the task
-                task.write(min_voltage)  # Write the min voltage to the channel
-        except nidaqmx.errors.DaqError as e:  # Handle DAQ errors
-            print(f"DAQ Error: {e}")
-
-        self.start_task()  # Restart the task
+        # Apply min voltage to the device, from the device actor thread
+        galvo_daq.get_actor().write(galvo_daq.galvo1_channel, min_voltage)
+        self.publish_settings()
+        self.ensure_task()  # The running worker picks the change up in place
 
 
 
@@ -710,12 +812,11 @@ class VoltageControlWidget(QWidget):
         """
         Sets the factor value based on the current slider value.
 
-        This method stops the current task, updates the factor value, and writes the
-        value to the device based on whether the second galvo is enabled. It also updates
-        the factor label and restarts the task.
+        This method updates the factor value and the factor label, queues the galvo2 value
+        on the device actor, based on whether the second galvo is enabled, and has the
+        running worker follow the new settings.
 
         """
-        self.stop_task()  # Stop the current task
         factor = self.slider2.value() / 100.0  # Get the factor from the slider
         min_voltage=self.get_min_voltage()
         max_voltage=self.get_max_voltage()
@@ -727,41 +828,26 @@ class VoltageControlWidget(QWidget):
         self.update_factor_label()  # Update the factor label
         print(f"Factor : x {factor} ")
 
+        actor = galvo_daq.get_actor()  # Queued writes, the GUI never waits for the driver
         if (Galvo2_Enable == True) :
-            try:
-                with nidaqmx.Task() as task:  # Create a new NI-DAQmx task
-                    task.ao_channels.add_ao_voltage_chan('Dev1/ao18')  # Add an analog output channel
-                    task.start()  # Start the task
-                    if (factor*min_voltage<=-10) :
-                        task.write(-10)  # Write the factor to the channel
-                    elif (factor*min_voltage>=10) :
-                        task.write(10)  # Write the factor to the channel
-                    else :  
-                        task.write(factor*min_voltage)  # Write the factor to the channel
-
-                    if (factor*max_voltage<=-10) :
-                        task.write(-10)  # Write the factor to the channel
-                    elif (factor*max_voltage>=10) :
-                        task.write(10)  # Write the factor to the channel
-                    else :  
-                        task.write(factor*max_voltage)  # Write the factor to the channel
-
-                    
-            except nidaqmx.errors.DaqError as e:  # Handle DAQ errors
-                print(f"DAQ Error with factor value: {e}")
-
+            if (factor*min_voltage<=-10) :
+                actor.write(galvo_daq.galvo2_channel, -10)  # Write the factor to the channel
+            elif (factor*min_voltage>=10) :
+                actor.write(galvo_daq.galvo2_channel, 10)  # Write the factor to the channel
+            else :  
+                actor.write(galvo_daq.galvo2_channel, factor*min_voltage)  # Write the factor to the channel
+
+            if (factor*max_voltage<=-10) :
+                actor.write(galvo_daq.galvo2_channel, -10)  # Write the factor to the channel
+            elif (factor*max_voltage>=10) :
+                actor.write(galvo_daq.galvo2_channel, 10)  # Write the factor to the channel
+            else :  
+                actor.write(galvo_daq.galvo2_channel, factor*max_voltage)  # Write the factor to the channel
         else :
-            try:
-                with nidaqmx.Task() as task:  # Create a new NI-DAQmx task
-                    task.ao_channels.add_ao_voltage_chan('Dev1/ao18')  # Add an analog output channel
-                    task.start()  # Start the task
-                    task.write(galvo2_Value)  # Write the factor to the channel
-                
-            except nidaqmx.errors.DaqError as e:  # Handle DAQ errors
-                print(f"DAQ Error with factor value: {e}")            
-
+            actor.write(galvo_daq.galvo2_channel, galvo2_Value)  # Write the factor to the channel
 
-        self.start_task()  # Restart the task
+        self.publish_settings()
+        self.ensure_task()  # The running worker picks the change up in place
 
     def get_factor(self):  
         """
@@ -804,25 +890,85 @@ class VoltageControlWidget(QWidget):
         """
         return self.step_factor_value
 
+    def publish_settings(self):
+        """
+        Publishes an immutable snapshot of the settings for the worker threads.
+
+        Called from the GUI thread each time a setting changes, so the workers never
+        read the widgets from their own thread.
+        """
+        self.settings_version += 1
+        self.settings_mailbox.publish(InitSettings(self.settings_version, self.min_voltage, self.max_voltage, self.get_factor(),
+                                                   self.Galvo2_Enable, self.galvo2_Value, self.exposure_time, self.scan_mode,
+                                                   self.flyback, self.roi_lines, self.calibration))
+
     def apply_settings(self):  
         """
         Applies the exposure settings from the user input.
 
-        This method retrieves the exposure time from the line edit, updates the global exposure
-        time variable, and restarts the task. It handles invalid input by printing an error message.
+        This method retrieves the exposure time and the ROI height from the line edits and publishes them
+        with the other settings to the running worker. An empty ROI height keeps the full sensor.
+        It handles invalid input by printing an error message.
 
         Raises:
         ValueError: If the text in the line edit cannot be converted to a float.
         """
-        self.stop_task()  # Stop the current task
         try:
             exposure_value = float(self.exposure_line_edit.text())  # Get the exposure time from the line edit
-            global ExposureTime  # Access the global variable
-            ExposureTime = exposure_value  # Set the exposure time
-            print(f"Exposure Time : {ExposureTime} ms")  # Print the new exposure time
+            self.exposure_time = exposure_value  # Set the exposure time
+            print(f"Exposure Time : {self.exposure_time} ms")  # Print the new exposure time
+            roi_text = self.roi_line_edit.text().strip()
+            roi_lines = int(roi_text) if roi_text else default_roi_lines
+            if roi_lines != self.roi_lines and self.calibration is not None:
+                self.calibration = None  # Measured for another ROI
+                print("ROI changed, dead time calibration cleared.")
+            self.roi_lines = roi_lines  # Set the ROI height
+            dead_time = galvo_engine.camera_timing(self.roi_lines).dead_time_ms()
+            print(f"ROI Height : {self.roi_lines} lines, frame dead time {dead_time:.3f} ms")  # Print the new frame dead time
+            self.publish_settings()
         except ValueError:  # Handle invalid input
             print("Invalid exposure time entered.")
-        self.start_task()  # Restart the task
+        self.ensure_task()  # The running worker picks the change up in place
+
+    def calibrate_dead_time(self):
+        """
+        Starts measuring the dead time of the camera at the current exposure, in a separate thread.
+
+        The camera must be free-running at the exposure (live mode in Micro-Manager). The
+        intervals between its PFI1 trigger edges are timed with a counter, and the minimum
+        overhead is added to the calibration of the other exposures by calibration_done.
+        """
+        self.btn_calibrate.setEnabled(False)  # One measurement at a time
+        self.calibration_request = (self.exposure_time, self.roi_lines)  # Settings the result belongs to
+        self.calibration_thread = QThread()  # Create a new thread
+        self.calibration_worker = CalibrationWorker(self.exposure_time, self.calibration, self.roi_lines)
+        self.calibration_worker.moveToThread(self.calibration_thread)  # Move the worker to the new thread
+        self.calibration_thread.started.connect(self.calibration_worker.run_calibration)  # Connect the thread start to the worker run method
+        self.calibration_worker.finished.connect(self.calibration_done)  # Runs in the GUI thread
+        self.calibration_worker.finished.connect(self.calibration_thread.quit)  # Connect the worker finished signal to the thread quit method
+        self.calibration_worker.finished.connect(self.calibration_worker.deleteLater)  # Connect the worker finished signal to the worker delete method
+        self.calibration_thread.finished.connect(self.calibration_thread.deleteLater)  # Connect the thread finished signal to the thread delete method
+        self.calibration_thread.start()  # Start the thread
+
+    def calibration_done(self, calibration):
+        """
+        Uses the dead time measured by the calibration worker in place of the model.
+
+        Args:
+            calibration (DeadTimeCalibration or None): Measured calibration, None if the measurement failed.
+        """
+        self.btn_calibrate.setEnabled(True)
+        exposure_time, roi_lines = self.calibration_request
+        if calibration is None:
+            return
+        if roi_lines != self.roi_lines:  # The ROI changed during the measurement
+            print("ROI changed during the calibration, dead time calibration discarded.")
+            return
+        self.calibration = calibration
+        print(f"Dead time at {exposure_time} ms : {self.calibration.dead_time_ms(exposure_time):.3f} ms "
+              f"({len(self.calibration.exposures)} exposures calibrated)")
+        self.publish_settings()
+        self.ensure_task()
 
     def start_task(self):  
         """
@@ -834,7 +980,7 @@ class VoltageControlWidget(QWidget):
         The thread is started, and upon completion, it is cleaned up.
         """
         self.thread = QThread()  # Create a new thread
-        self.galvo_worker = GalvoWorker_initPhase(self)  # Create a new galvo worker
+        self.galvo_worker = GalvoWorker_initPhase(self.settings_mailbox)  # Create a new galvo worker
         self.galvo_worker.moveToThread(self.thread)  # Move the worker to the new thread
         self.thread.started.connect(self.galvo_worker.run_initialisation)  # Connect the thread start to the worker run method
         self.galvo_worker.finished.connect(self.thread.quit)  # Connect the worker finished signal to the thread quit method
@@ -842,6 +988,16 @@ class VoltageControlWidget(QWidget):
         self.thread.finished.connect(self.thread.deleteLater)  # Connect the thread finished signal to the thread delete method
         self.thread.start()  # Start the thread
 
+    def ensure_task(self):
+        """
+        Starts the worker thread if it is not running.
+
+        A running worker follows the published settings by itself, so a setting change
+        neither waits for the thread to end nor creates a new one.
+        """
+        if getattr(self, 'galvo_worker', None) is None:  # Check if the worker exists
+            self.start_task()
+
     def stop_task(self):  
         """
         Stops the currently running task and cleans up resources.
@@ -855,6 +1011,7 @@ class VoltageControlWidget(QWidget):
             self.galvo_worker.stop()  # Stop the worker
             self.thread.quit()  # Quit the thread
             self.thread.wait()  # Wait for the thread to finish
+            self.galvo_worker = None
 
 
 class FileExplorerWidget(QWidget):
@@ -869,9 +1026,11 @@ class FileExplorerWidget(QWidget):
         num_slices (int): Number of slices extracted from the file.
         num_frames (int): Number of frames extracted from the file.
         Acq_order (int): Acquisition order mode extracted from the file.
+        file_path (str or None): Path of the loaded MDA sequence file, None until a file is read.
     """
     def __init__(self):
         super().__init__()
+        self.file_path = None
         self.exposure_values = []  # List to store exposure values for each channel
         self.num_slices = 0
         self.num_frames = 0
@@ -931,6 +1090,7 @@ class FileExplorerWidget(QWidget):
             with open(file_path, 'r') as f:
                 data = json.load(f)
                 self.extract_data(data)
+            self.file_path = file_path  # The timings of the runs are saved next to it
         except IOError as e:
             print(f"Error reading file: {e}")
 
@@ -944,44 +1104,14 @@ class FileExplorerWidget(QWidget):
         Args:
             data (dict): Parsed JSON data containing exposure values, slices, frames, and acquisition order.
         """
-        # Extract the list of channels from the data
-        channels = data.get('channels', [])
-        
-        # Extract exposure values for each channel
-        self.exposure_values = [channel.get('exposure', 0.0) for channel in channels]
-
-        # Extract the number of slices from the data
-        self.num_slices = len(data.get('slices', []))
-        
-        # Extract the number of frames from the data
-        self.num_frames = data.get('numFrames', 0)
-        
-        # Extract the acquisition order mode from the data
-        self.Acq_order = data.get('acqOrderMode', 0)
-
-        # Dictionary to store exposure values grouped by filter wheel ID
-        filter_wheel_exposures = {}
-
-        # Populate the dictionary with exposure values grouped by filter wheel configuration
-        for channel in channels:
-            config = channel.get('config', '')
-            exposure = channel.get('exposure', 0.0)
-            if config.startswith('fw'):
-                filter_wheel_id = config.split()[0]  # Extract 'fw1', 'fw2', etc.
-                
-                if filter_wheel_id not in filter_wheel_exposures:
-                    filter_wheel_exposures[filter_wheel_id] = []
-                    
-                filter_wheel_exposures[filter_wheel_id].append(exposure)
-
-        # Convert dictionary to a list of lists
-        self.channels_by_filter_wheel = [filter_wheel_exposures[fw_id] for fw_id in sorted(filter_wheel_exposures)]
-
-        # Calculate the number of unique filter wheel configurations
-        self.FW = len(filter_wheel_exposures)
-        
-        # Calculate the total number of amplifiers
-        self.amp = sum(len(exposures) for exposures in filter_wheel_exposures.values()) / max(len(filter_wheel_exposures), 1)
+        sequence = galvo_engine.parse_mda_sequence(data)  # Shared with the command-line runner
+        self.exposure_values = sequence['exposure_times']  # Exposure values for each channel
+        self.num_slices = sequence['num_slices']
+        self.num_frames = sequence['num_frames']
+        self.Acq_order = sequence['Acq_order']  # Acquisition order mode
+        self.channels_by_filter_wheel = sequence['channels_by_filter_wheel']  # Exposure values grouped by filter wheel
+        self.FW = sequence['FW']  # Number of unique filter wheel configurations
+        self.amp = sequence['amp']  # Number of amplitudes per filter wheel
 
         # Display extracted information (method assumed to be implemented elsewhere)
         self.display_extracted_info()
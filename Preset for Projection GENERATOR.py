@@ -2,6 +2,7 @@
 # RAphael TOSCANO
 
 import sys
+import galvo_presets
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout, QCheckBox, QSpinBox, QPushButton, QTextEdit, QLabel, QMessageBox, QFileDialog
 )
@@ -113,12 +114,7 @@ class PresetGenerator(QWidget):
             QMessageBox.warning(self, 'Error', 'Please select at least 1 filter.')
             return
 
-        result = f"# Group: FW AMP\n"
-        for fw in selected_filters:
-            for amp in range(num_amp, 0, -1):
-                result += f"# Preset: {fw} amp{amp}\n"
-                result += f"ConfigGroup,FW AMP,{fw} amp{amp},Filter wheel 1,Label,Filter-{fw[-1]}\n"
-                result += f"ConfigGroup,FW AMP,{fw} amp{amp},NIDAQAO-Dev1/ao1,Voltage,0.000{amp}\n\n"
+        result = galvo_presets.fw_amp_presets(selected_filters, num_amp)  # Shared with the benchmarks, without Qt
 
         self.result_text.setText(result)
 
@@ -136,28 +132,8 @@ class PresetGenerator(QWidget):
             self.generate_presets()
 
         try:
-            with open(self.file_path, 'r+', encoding='utf-8') as file:
-                lines = file.readlines()
-
-                # Find the position to insert new lines
-                insert_pos = -1
-                for i, line in enumerate(lines):
-                    if "# Configuration presets" in line:
-                        insert_pos = i + 1  # Insert 1 line after finding the group
-                        break
-
-                if insert_pos == -1:
-                    raise ValueError("The specified group was not found in the file.")
-
-                # Get the generated presets
-                new_lines = self.result_text.toPlainText().splitlines(True)
-
-                # Insert the new presets into the file content
-                lines[insert_pos:insert_pos] = new_lines
-
-                # Write the updated content back to the file
-                file.seek(0)
-                file.writelines(lines)
+            # Insert the generated presets after the "# Configuration presets" line
+            galvo_presets.write_fw_amp_presets(self.file_path, self.result_text.toPlainText())
 
             QMessageBox.information(self, 'Success', 'Presets written to the file successfully.')
 
@@ -0,0 +1,792 @@
+# Benchmarks for the galvo waveform engine
+# RAphael TOSCANO
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+import galvo_daq
+import galvo_display
+import galvo_engine
+import galvo_presets
+
+
+def legacy_generate_voltage_sequences(min_voltage, max_voltage, factor, Galvo2_Enable, galvo2_Value,
+                                      exposure_times, num_frames, num_slices, Acq_order, FW, amp):
+    """
+    Reference copy of the nested loop generate_voltage_sequences used before the plan compiler.
+
+    The frames are sized with frame_samples, to end before the next trigger edge, instead
+    of the exposure plus 22.937 ms which missed every other trigger of the camera.
+
+    Returns:
+        tuple: All sequences, all sequences with factor, and duration list.
+    """
+    sample_rate = galvo_engine.sample_rate
+    if factor <= 0:
+        factor_list_unique = np.linspace(factor, -1.0, int(amp)).tolist()
+    else:
+        factor_list_unique = np.linspace(factor, 1.0, int(amp)).tolist()
+    factor_list = factor_list_unique * FW
+
+    all_sequences = []
+    all_sequences2 = []
+    duration_list = []
+
+    if Acq_order == 0:
+        order = ((i, exposure_time) for _ in range(num_frames) for _ in range(num_slices)
+                 for i, exposure_time in enumerate(exposure_times))
+    else:
+        order = ((i, exposure_time) for _ in range(num_frames) for i, exposure_time in enumerate(exposure_times)
+                 for _ in range(num_slices))
+
+    for i, exposure_time in order:
+        duration_ms = exposure_time + 22.937
+        num_samples = galvo_engine.frame_samples(exposure_time, sample_rate)
+
+        voltages_sequence = np.linspace(min_voltage, max_voltage, num_samples)
+        voltages_sequence = np.append(voltages_sequence, min_voltage)
+        all_sequences.append(voltages_sequence)
+
+        min_voltage_new, max_voltage_new = galvo_engine.increase_range(min_voltage, max_voltage, factor_list[i])
+        if Galvo2_Enable:
+            voltages_sequence_new = np.linspace(min_voltage_new, max_voltage_new, num_samples)
+            voltages_sequence_new = np.append(voltages_sequence_new, min_voltage_new)
+        else:
+            voltages_sequence_new = np.linspace(galvo2_Value, galvo2_Value, num_samples)
+            voltages_sequence_new = np.append(voltages_sequence_new, galvo2_Value)
+        all_sequences2.append(voltages_sequence_new)
+        duration_list.append(duration_ms)
+
+    return all_sequences, all_sequences2, duration_list
+
+
+def mda_settings(num_frames, num_slices, num_channels, Acq_order=0):
+    """
+    Builds realistic MDA settings: two filter wheels, exposures from 10 to 200 ms.
+    """
+    FW = 2 if num_channels % 2 == 0 else 1
+    return dict(min_voltage=-2.0, max_voltage=3.0, factor=0.4, Galvo2_Enable=True, galvo2_Value=0.0,
+                exposure_times=np.linspace(10, 200, num_channels).tolist(),
+                num_frames=num_frames, num_slices=num_slices, Acq_order=Acq_order,
+                FW=FW, amp=num_channels / FW)
+
+
+def best_time(function, settings, repeat):
+    """
+    Returns the best wall time of several calls, in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(**settings)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def check_equivalence():
+    """
+    Checks that the plan compiler reproduces the legacy sequences sample for sample.
+    """
+    for Acq_order, Galvo2_Enable in itertools.product((0, 1), (True, False)):
+        settings = mda_settings(3, 4, 4, Acq_order)
+        settings['Galvo2_Enable'] = Galvo2_Enable
+        all_sequences, all_sequences2, duration_list = legacy_generate_voltage_sequences(**settings)
+        plan = galvo_engine.compile_mda_plan(**settings)
+        assert len(plan) == len(all_sequences)
+        for i in range(len(plan)):
+            galvo1, galvo2 = plan.frame(i)
+            np.testing.assert_allclose(galvo1, all_sequences[i], rtol=0, atol=1e-12)
+            np.testing.assert_allclose(galvo2, all_sequences2[i], rtol=0, atol=1e-12)
+        np.testing.assert_allclose(plan.durations_ms, duration_list)
+
+
+def benchmark_plan_compiler(sizes, repeat):
+    """
+    Prints the legacy loop and plan compiler times for each (frames, slices, channels) size.
+    """
+    print(f"{'frames':>7} {'slices':>7} {'channels':>9} {'legacy (s)':>11} {'compiler (s)':>13} {'speedup':>8}")
+    for num_frames, num_slices, num_channels in sizes:
+        settings = mda_settings(num_frames, num_slices, num_channels)
+        legacy = best_time(legacy_generate_voltage_sequences, settings, repeat)
+        compiled = best_time(galvo_engine.compile_mda_plan, settings, repeat)
+        print(f"{num_frames:>7} {num_slices:>7} {num_channels:>9} {legacy:>11.4f} {compiled:>13.4f} {legacy / compiled:>7.1f}x")
+    print(f"Waveform cache: {galvo_engine.waveform_cache.info()}")
+
+
+def peak_memory(function):
+    """
+    Returns the peak traced memory of a call, in MB.
+    """
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1e6
+
+
+def benchmark_plan_memory(sizes):
+    """
+    Prints the peak memory of the compiled plan and of the lazy plan walked frame by frame.
+    """
+    def walk(plan):
+        for start, stop in plan.runs():
+            for first in range(start, stop, 64):
+                plan.block(first, min(stop, first + 64))  # Same chunks as the player
+
+    print(f"{'frames':>7} {'slices':>7} {'channels':>9} {'compiled (MB)':>14} {'streaming (MB)':>15}")
+    for num_frames, num_slices, num_channels in sizes:
+        settings = mda_settings(num_frames, num_slices, num_channels, Acq_order=1)
+        galvo_engine.waveform_cache.clear()
+        compiled = peak_memory(lambda: galvo_engine.compile_mda_plan(**settings))
+        galvo_engine.waveform_cache.clear()
+        streaming = peak_memory(lambda: walk(galvo_engine.stream_mda_plan(**settings)))
+        print(f"{num_frames:>7} {num_slices:>7} {num_channels:>9} {compiled:>14.1f} {streaming:>15.1f}")
+
+
+def benchmark_plan_footprint(sizes):
+    """
+    Prints the memory footprint of the compiled plan and of the flyweight plan.
+    """
+    print(f"{'frames':>7} {'slices':>7} {'channels':>9} {'compiled (MB)':>14} {'flyweight (MB)':>15} {'ratio':>8}")
+    for num_frames, num_slices, num_channels in sizes:
+        settings = mda_settings(num_frames, num_slices, num_channels)
+        compiled = galvo_engine.compile_mda_plan(**settings).nbytes() / 1e6
+        flyweight = galvo_engine.compact_mda_plan(**settings).nbytes() / 1e6
+        print(f"{num_frames:>7} {num_slices:>7} {num_channels:>9} {compiled:>14.2f} {flyweight:>15.3f} {compiled / flyweight:>7.0f}x")
+
+
+def legacy_play(plan, backend, timeout=10):
+    """
+    Reference copy of the run_MDA loop used before the retriggerable player: one task per frame.
+    """
+    for i in range(len(plan)):
+        galvo1, galvo2 = plan.frame(i)
+        with backend.create_task() as task:
+            task.add_ao_channel(galvo_daq.galvo1_channel)
+            task.add_ao_channel(galvo_daq.galvo2_channel)
+            task.cfg_timing(galvo_engine.sample_rate, len(galvo1))
+            task.cfg_trigger(galvo_daq.trigger_source)
+            task.write(np.vstack((galvo1, galvo2)))
+            task.start()
+            task.wait_until_done(timeout=timeout)
+            task.stop()
+
+
+def playback_rate(play, plan, trigger_rate):
+    """
+    Plays a plan on a fresh simulated backend and returns the frame rate and the trigger usage.
+    """
+    backend = galvo_daq.SimulatedBackend(trigger_rate=trigger_rate)
+    start = time.perf_counter()
+    play(plan, backend)
+    elapsed = time.perf_counter() - start
+    edges = elapsed * trigger_rate
+    return len(plan) / elapsed, len(plan) / edges
+
+
+def benchmark_playback(trigger_rates, num_frames):
+    """
+    Prints the sustained frame rate of the legacy loop and of the retriggerable player.
+    """
+    plan = galvo_engine.compile_mda_plan(**mda_settings(num_frames, 1, 1))  # 10 ms exposure, 33 ms frames
+    player = lambda plan, backend: galvo_daq.RetriggerablePlayer(plan, backend=backend).play(timeout=10)
+    print(f"{'trigger (Hz)':>13} {'legacy (fps)':>13} {'used':>6} {'player (fps)':>13} {'used':>6}")
+    for trigger_rate in trigger_rates:
+        legacy_fps, legacy_used = playback_rate(legacy_play, plan, trigger_rate)
+        player_fps, player_used = playback_rate(player, plan, trigger_rate)
+        print(f"{trigger_rate:>13.0f} {legacy_fps:>13.1f} {legacy_used:>6.0%} {player_fps:>13.1f} {player_used:>6.0%}")
+
+
+def benchmark_coalescing(trigger_rate, num_frames, num_slices):
+    """
+    Prints the driver usage of the player with and without coalescing of identical frames.
+
+    Frames of the plan end just before the next trigger of the camera they were sized
+    for, so the player streams them one by one ('on'). 'forced' coalesces them anyway
+    (no stop margin), which only works as the simulated camera triggers slower.
+    """
+    plan = galvo_engine.stream_mda_plan(**mda_settings(num_frames, num_slices, 2, Acq_order=1))  # Time/Channel/Slice
+    print(f"{'coalescing':>11} {'frames':>7} {'coalesced':>10} {'cycles':>7} {'writes':>7} {'samples':>9} {'calls':>6} {'saved':>6} {'overruns':>9}")
+    for label, min_repeat, margin in (('off', None, galvo_daq.stop_margin), ('on', 2, galvo_daq.stop_margin), ('forced', 2, 0.0)):
+        backend = galvo_daq.SimulatedBackend(trigger_rate=trigger_rate, record=False)
+        player = galvo_daq.RetriggerablePlayer(plan, backend=backend, min_repeat=min_repeat, stop_margin=margin)
+        try:
+            stats = player.play(timeout=10)
+        except galvo_daq.FrameOverrun as e:
+            print(f"{label:>11} {e}")
+            continue
+        print(f"{label:>11} {stats['frames']:>7} {stats['coalesced_frames']:>10} {stats['task_cycles']:>7} {stats['writes']:>7} "
+              f"{stats['samples_written']:>9} {stats['driver_calls']:>6} {stats['round_trips_saved']:>6} {stats['overruns']:>9}")
+
+
+def benchmark_raw_writes(trigger_rate, num_frames):
+    """
+    Prints the transfer volume of float64 writes and of unscaled int16 writes.
+    """
+    plan = galvo_engine.stream_mda_plan(**mda_settings(num_frames, 1, 2))
+    print(f"{'writes':>8} {'samples':>9} {'bytes':>10} {'max error (V)':>14}")
+    for raw in (False, True):
+        backend = galvo_daq.SimulatedBackend(trigger_rate=trigger_rate)
+        stats = galvo_daq.RetriggerablePlayer(plan, backend=backend, min_repeat=None, raw=raw).play(timeout=10)
+        written = np.hstack(backend.tasks[0].writes).astype(np.float64)
+        if raw:
+            written /= galvo_daq.SimulatedBackend.dac_coefficients[1]  # Back to volts
+        error = np.abs(written - plan.block(0, len(plan))).max()
+        print(f"{'int16' if raw else 'float64':>8} {stats['samples_written']:>9} {stats['bytes_written']:>10} {error:>14.2e}")
+
+
+def benchmark_pipeline(trigger_rate, num_frames, num_channels):
+    """
+    Prints the host time spent preparing frames on the playback thread, with and without the pipeline.
+    """
+    settings = mda_settings(num_frames, 1, num_channels)
+    settings['exposure_times'] = [10.0] * num_channels  # Same length, different frames: one long streamed run
+    plan = galvo_engine.compact_mda_plan(**settings)
+    print(f"{'pipeline':>9} {'frames':>7} {'prepare (ms)':>13} {'consumer wait (ms)':>19} {'mean depth':>11}")
+    for depth in (None, 8):
+        backend = galvo_daq.SimulatedBackend(trigger_rate=trigger_rate, record=False)
+        stats = galvo_daq.RetriggerablePlayer(plan, backend=backend, buffer_frames=4, pipeline_depth=depth).play(timeout=10)
+        metrics = stats.get('pipeline', {'consumer_wait_s': 0.0, 'mean_depth': 0.0})
+        print(f"{depth or 'off':>9} {stats['frames']:>7} {stats['prepare_s'] * 1e3:>13.2f} "
+              f"{metrics['consumer_wait_s'] * 1e3:>19.2f} {metrics['mean_depth']:>11.1f}")
+
+
+def benchmark_ping_pong(trigger_rates, num_frames):
+    """
+    Prints the sustained frame rate with a single task and with the ping-pong task pair.
+
+    Two channels of different exposures make every frame a block boundary, the worst case.
+    """
+    settings = mda_settings(num_frames, 1, 2)
+    settings['exposure_times'] = [10.0, 11.0]
+    plan = galvo_engine.stream_mda_plan(**settings)
+    print(f"{'trigger (Hz)':>13} {'single (fps)':>13} {'used':>6} {'ping-pong (fps)':>16} {'used':>6}")
+    for trigger_rate in trigger_rates:
+        rates = [playback_rate(lambda plan, backend: galvo_daq.RetriggerablePlayer(plan, backend=backend, ping_pong=ping_pong).play(timeout=10),
+                               plan, trigger_rate) for ping_pong in (False, True)]
+        (single_fps, single_used), (pair_fps, pair_used) = rates
+        print(f"{trigger_rate:>13.0f} {single_fps:>13.1f} {single_used:>6.0%} {pair_fps:>16.1f} {pair_used:>6.0%}")
+
+
+class FailingBackend:
+    """
+    Backend whose every task creation fails, as with the device unplugged.
+    """
+    def create_task(self):
+        raise galvo_daq.DaqError("Device not found.", -200220)
+
+
+def legacy_init_loop(get_settings, seconds):
+    """
+    Reference copy of the init loop used before the settings snapshots: polls the settings, no wait while they are unset.
+
+    Returns:
+        float: Fraction of one core used.
+    """
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    while time.perf_counter() - wall_start < seconds:
+        min_voltage, max_voltage = get_settings()
+        if min_voltage is not None and max_voltage is not None:
+            time.sleep(0.01)
+    return (time.thread_time() - cpu_start) / (time.perf_counter() - wall_start)
+
+
+def idle_follower_cpu(snapshot, backend, seconds):
+    """
+    Runs a settings follower on one snapshot for a while and returns its metrics.
+    """
+    mailbox = galvo_daq.SettingsMailbox()
+    mailbox.publish(snapshot)
+    output = galvo_daq.RetriggerableOutput([galvo_daq.galvo1_channel], backend=backend)
+    waveform = lambda s: None if s.min_voltage is None else ((s.min_voltage, s.max_voltage), lambda: galvo_engine.static_waveform(s.max_voltage, 10))
+    follower = galvo_daq.SettingsFollower(mailbox, output, waveform)
+    thread = threading.Thread(target=follower.run)
+    thread.start()
+    time.sleep(seconds)
+    follower.stop()
+    thread.join()
+    return follower.metrics
+
+
+def benchmark_idle_cpu(seconds):
+    """
+    Prints the CPU used by the initialization worker while idle: settings unset, armed, and device failing.
+    """
+    Settings = collections.namedtuple('Settings', ['version', 'min_voltage', 'max_voltage'])
+    print(f"{'state':>14} {'legacy CPU':>11} {'follower CPU':>13} {'wake-ups':>9} {'reloads':>8} {'errors':>7}")
+    cases = [('unset', Settings(1, None, None), galvo_daq.SimulatedBackend(record=False)),
+             ('armed', Settings(1, -1.0, 1.0), galvo_daq.SimulatedBackend(record=False)),
+             ('device error', Settings(1, -1.0, 1.0), FailingBackend())]
+    for state, snapshot, backend in cases:
+        legacy = f"{legacy_init_loop(lambda: (snapshot.min_voltage, snapshot.max_voltage), seconds):.1%}" if state == 'unset' else '-'
+        metrics = idle_follower_cpu(snapshot, backend, seconds)
+        print(f"{state:>14} {legacy:>11} {metrics['cpu_fraction']:>13.2%} {metrics['wakeups']:>9} {metrics['reloads']:>8} {metrics['errors']:>7}")
+
+
+def benchmark_cancellation(trials, trigger_rate):
+    """
+    Prints the time from the cancel request to the galvos parked, the request landing at random times of an MDA.
+    """
+    plan = galvo_engine.stream_mda_plan(**mda_settings(50, 5, 2))
+    rng = np.random.default_rng(0)
+    latencies = []
+    for delay in rng.uniform(0.05, 1.0, trials):
+        player = galvo_daq.RetriggerablePlayer(plan, backend=galvo_daq.SimulatedBackend(trigger_rate=trigger_rate, record=False),
+                                               raw=True, pipeline_depth=8, ping_pong=True)
+        timer = threading.Timer(delay, player.cancel)
+        timer.start()
+        stats = player.play(timeout=10)
+        timer.join()
+        latencies.append(stats['cancel_latency_ms'])
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(f"{'trials':>7} {'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9} {'deadline (ms)':>14}")
+    print(f"{trials:>7} {p50:>9.2f} {p99:>9.2f} {max(latencies):>9.2f} {galvo_daq.cancel_deadline * 1e3:>14.0f}")
+
+
+def benchmark_setting_change(changes):
+    """
+    Prints the GUI thread time of a setting change: restarting the worker thread, as before, or publishing to the running one.
+    """
+    Settings = collections.namedtuple('Settings', ['version', 'min_voltage', 'max_voltage'])
+    waveform = lambda s: ((s.min_voltage, s.max_voltage), lambda: galvo_engine.static_waveform(s.max_voltage, 10))
+    backend = galvo_daq.SimulatedBackend(record=False)
+    actor = galvo_daq.DeviceActor(backend)
+    mailbox = galvo_daq.SettingsMailbox()
+    version = itertools.count(1)
+
+    def start():
+        output = galvo_daq.RetriggerableOutput([galvo_daq.galvo1_channel], backend=backend)
+        follower = galvo_daq.SettingsFollower(mailbox, output, waveform, actor=actor)
+        thread = threading.Thread(target=follower.run)
+        thread.start()
+        return follower, thread
+
+    def change(i):
+        actor.write(galvo_daq.galvo1_channel, 0.1 * i)
+        mailbox.publish(Settings(next(version), -1.0, 0.1 * i))
+
+    print(f"{'mode':>9} {'changes':>8} {'GUI thread (ms/change)':>23}")
+    follower, thread = start()
+    begin = time.perf_counter()
+    for i in range(changes):
+        follower.stop()  # stop_task: the GUI thread waits for the worker
+        thread.join()
+        change(i)
+        follower, thread = start()  # start_task: a new thread per change
+    restart = (time.perf_counter() - begin) / changes
+    begin = time.perf_counter()
+    for i in range(changes):
+        change(i)
+    in_place = (time.perf_counter() - begin) / changes
+    follower.stop()
+    thread.join()
+    actor.stop()
+    print(f"{'restart':>9} {changes:>8} {restart * 1e3:>23.3f}")
+    print(f"{'in place':>9} {changes:>8} {in_place * 1e3:>23.3f}")
+
+
+def benchmark_on_demand_writes(writes):
+    """
+    Prints the caller time of a burst of on-demand writes: one task per write on the caller thread, or queued on the device actor.
+    """
+    values = np.linspace(-1.0, 1.0, writes)
+    backend = galvo_daq.SimulatedBackend(record=False)
+    begin = time.perf_counter()
+    for value in values:
+        galvo_daq.write_value(galvo_daq.galvo1_channel, value, backend)  # As the widgets did on the GUI thread
+    legacy = time.perf_counter() - begin
+    legacy_tasks = backend.calls['create']
+
+    backend = galvo_daq.SimulatedBackend(record=False)
+    actor = galvo_daq.DeviceActor(backend)
+    begin = time.perf_counter()
+    for value in values:
+        actor.write(galvo_daq.galvo1_channel, value)
+    submitted = time.perf_counter() - begin
+    actor.flush()
+    drained = time.perf_counter() - begin
+    actor.stop()
+    print(f"{'mode':>9} {'writes':>7} {'caller (ms)':>12} {'done (ms)':>10} {'device writes':>14} {'tasks':>6}")
+    print(f"{'one-shot':>9} {writes:>7} {legacy * 1e3:>12.2f} {legacy * 1e3:>10.2f} {writes:>14} {legacy_tasks:>6}")
+    print(f"{'actor':>9} {writes:>7} {submitted * 1e3:>12.2f} {drained * 1e3:>10.2f} {actor.metrics['written']:>14} {actor.metrics['tasks_created']:>6}")
+
+
+def tracked_fraction(command, rate, slew, tolerance):
+    """
+    Returns the fraction of samples a slew-rate limited galvo follows within tolerance.
+
+    Args:
+        command (np.ndarray): Commanded voltages.
+        rate (float): Sample clock rate in Hz.
+        slew (float): Largest voltage change of the galvo in V/ms.
+        tolerance (float): Largest tracking error in V still usable for imaging.
+    """
+    step = slew * 1e3 / rate  # V per sample
+    position = np.empty_like(command)
+    current = command[0]
+    for n, target in enumerate(command.tolist()):
+        current += min(step, max(-step, target - current))
+        position[n] = current
+    return np.count_nonzero(np.abs(position - command) <= tolerance) / len(command)
+
+
+def benchmark_scan_duty(exposures, amplitude, slew, tolerance=0.01):
+    """
+    Prints the usable duty cycle of unidirectional and bidirectional scans with a slew-limited galvo.
+
+    After every unidirectional frame the galvo flies back over the whole amplitude and
+    lags the start of the next ramp; the bidirectional scan never jumps.
+    """
+    print(f"{'exposure (ms)':>14} {'frame (ms)':>11} {'flyback (ms)':>13} {'unidirectional':>15} {'bidirectional':>14}")
+    for exposure in exposures:
+        settings = mda_settings(6, 1, 1)
+        settings.update(min_voltage=-amplitude / 2, max_voltage=amplitude / 2, exposure_times=[exposure])
+        duty = [tracked_fraction(galvo_engine.compact_mda_plan(**settings, scan_mode=scan_mode).block(0, 6)[0],
+                                 galvo_engine.sample_rate, slew, tolerance) for scan_mode in galvo_engine.scan_modes]
+        print(f"{exposure:>14.0f} {exposure + galvo_engine.readout_time_ms:>11.1f} {amplitude / slew:>13.1f} {duty[0]:>15.1%} {duty[1]:>14.1%}")
+
+
+def benchmark_flyback(amplitudes, exposure, tolerance=0.01):
+    """
+    Prints the return time the galvo needs, the padding of step and shaped frames, and the tracking of step and shaped returns.
+
+    A step frame keeps the settle time of the camera model, a shaped frame is padded
+    with its return instead (padding_ms).
+    """
+    print(f"Slew limit {galvo_engine.slew_limit} V/ms, acceleration limit {galvo_engine.acceleration_limit} V/ms², {exposure} ms exposure")
+    print(f"{'amplitude (V)':>14} {'return (ms)':>12} {'step pad (ms)':>14} {'shaped pad (ms)':>16} {'step':>7} {'shaped':>7}")
+    for amplitude in amplitudes:
+        settings = mda_settings(6, 1, 1)
+        settings.update(min_voltage=-amplitude / 2, max_voltage=amplitude / 2, exposure_times=[exposure], Galvo2_Enable=False)
+        plans = [galvo_engine.compact_mda_plan(**settings, flyback=flyback) for flyback in galvo_engine.flyback_modes]
+        tracked = [tracked_fraction(plan.block(0, 6)[0], galvo_engine.sample_rate, galvo_engine.slew_limit, tolerance) for plan in plans]
+        needed = galvo_engine.flyback_time_ms(-amplitude / 2, amplitude / 2, exposure)
+        padding = [plan.duration_ms(0) - exposure for plan in plans]
+        print(f"{amplitude:>14.2f} {needed:>12.1f} {padding[0]:>14.1f} {padding[1]:>16.1f} {tracked[0]:>7.1%} {tracked[1]:>7.1%}")
+
+
+def benchmark_frame_period(roi_heights, exposures, num_frames=30):
+    """
+    Prints the frame rate of the camera timing model against the fixed 22.937 ms readout, per ROI height.
+
+    Each plan is played on a simulated camera triggering at the model period, the frame
+    rate played (median trigger gap of the run) has to match the camera rate for the
+    speedup to be real.
+    """
+    print(f"{'ROI (lines)':>12} {'dead time (ms)':>15}" + ''.join(f" {f'{e} ms: played/camera fps':>27}" for e in exposures))
+    for roi_lines in roi_heights:
+        timing = galvo_engine.camera_timing(roi_lines)
+        periods = galvo_engine.frame_durations_ms(exposures, timing)
+        fixed = galvo_engine.frame_durations_ms(exposures)
+        cells = ''
+        for exposure, period, fast in zip(exposures, periods, fixed):
+            settings = mda_settings(num_frames, 1, 1)
+            settings['exposure_times'] = [exposure]
+            backend = galvo_daq.SimulatedBackend(trigger_rate=1000 / period)
+            stats = galvo_daq.RetriggerablePlayer(galvo_engine.compile_mda_plan(**settings, timing=timing), backend=backend).play(timeout=10)
+            played = 1000 / stats['timing']['gap_p50_ms']
+            cells += f" {f'{played:.1f}/{1000 / period:.1f} {fast / period:.2f}x':>27}"
+        print(f"{roi_lines:>12} {timing.dead_time_ms():>15.3f}{cells}")
+
+
+def benchmark_calibration(roi_lines, exposures, num_frames=30, edges=30, jitter=20e-6):
+    """
+    Prints the dead time calibrated on a simulated free-running camera and the frame rate played with it.
+
+    The camera triggers as fast as its ROI allows; frames sized with the fixed 22.937 ms
+    margin outlast the trigger period and miss every other edge.
+    """
+    camera = galvo_engine.camera_timing(roi_lines)
+    backend = galvo_daq.SimulatedBackend(camera=camera, trigger_jitter=jitter)
+    calibration = galvo_daq.calibrate_dead_time(exposures, edges=edges, backend=backend)
+    print(f"Camera ROI {roi_lines} lines, true overhead {camera.dead_time_ms():.3f} ms, {jitter * 1e6:.0f} us trigger jitter")
+    print(f"{'exposure (ms)':>14} {'fitted (ms)':>12} {'camera (fps)':>13} {'fixed (fps)':>12} {'calibrated (fps)':>17}")
+    for exposure, overhead in zip(calibration.exposures, calibration.overheads):
+        settings = mda_settings(num_frames, 1, 1)
+        settings['exposure_times'] = [exposure]
+        trigger_rate = 1000.0 / (exposure + camera.dead_time_ms(exposure))
+        player = lambda plan, backend: galvo_daq.RetriggerablePlayer(plan, backend=backend).play(timeout=10)
+        fps = [playback_rate(player, galvo_engine.compile_mda_plan(**settings, timing=timing), trigger_rate)[0]
+               for timing in (galvo_engine.default_camera, calibration)]
+        print(f"{exposure:>14.0f} {overhead:>12.3f} {trigger_rate:>13.1f} {fps[0]:>12.1f} {fps[1]:>17.1f}")
+
+
+def benchmark_sample_rate(exposure_sets, num_frames=100, num_slices=10):
+    """
+    Prints the samples per frame and the transfer volume of an MDA at the fixed and at the adaptive sample rate.
+    """
+    print(f"Target {galvo_engine.target_frame_samples} samples per frame, device limit {galvo_engine.max_ao_rate} Hz, "
+          f"{num_frames} time points x {num_slices} slices, int16 codes")
+    print(f"{'exposures (ms)':>16} {'fixed samples':>14} {'fixed (MB)':>11} {'adaptive (Hz)':>16} {'samples':>12} {'adaptive (MB)':>14}")
+    for exposures in exposure_sets:
+        settings = mda_settings(num_frames, num_slices, len(exposures))
+        settings['exposure_times'] = exposures
+        plans = [galvo_engine.compact_mda_plan(**settings, rate=rate) for rate in (galvo_engine.sample_rate, 'adaptive')]
+        lengths = [sorted(set(plan.waveform_lengths.tolist())) for plan in plans]
+        rates = '/'.join(f'{rate / 1e3:g}k' for rate in plans[1].waveform_rates.tolist())
+        print(f"{'/'.join(f'{e:g}' for e in exposures):>16} {'/'.join(map(str, lengths[0])):>14} {plans[0].transfer_bytes() / 1e6:>11.1f} "
+              f"{rates:>16} {'/'.join(map(str, lengths[1])):>12} {plans[1].transfer_bytes() / 1e6:>14.1f}")
+
+
+def benchmark_continuous(durations, refill_latencies):
+    """
+    Prints the host memory of a looping continuous run against its length, then the underflows when refills slow down.
+    """
+    plan = galvo_engine.stream_mda_plan(**mda_settings(5, 3, 2))
+    print(f"{'run (s)':>8} {'frames':>7} {'refills':>8} {'peak (MB)':>10} {'underflows':>11}")
+    for seconds in durations:
+        player = galvo_daq.ContinuousPlayer(plan, backend=galvo_daq.SimulatedBackend(trigger_rate=30, record=False), loop=True)
+        timer = threading.Timer(seconds, player.cancel)
+        timer.start()
+        tracemalloc.start()
+        stats = player.play(timeout=10)
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+        timer.join()
+        print(f"{seconds:>8.0f} {stats['frames']:>7} {stats['refills']:>8} {peak:>10.2f} {stats['underflows']:>11}")
+
+    print(f"{'refill (ms)':>12} {'chunk (ms)':>11} {'late':>5} {'underflows':>11} {'replayed (ms)':>14} {'min lead (ms)':>14}")
+    for latency in refill_latencies:
+        latencies = dict(galvo_daq.SimulatedBackend.default_latency, write=latency)  # Slow host: every refill takes this long
+        backend = galvo_daq.SimulatedBackend(trigger_rate=30, latency=latencies, record=False)
+        player = galvo_daq.ContinuousPlayer(plan, backend=backend, buffer_samples=2000, chunk_samples=500)
+        timer = threading.Timer(2, player.cancel)
+        timer.start()
+        stats = player.play(timeout=10)
+        timer.join()
+        print(f"{latency * 1e3:>12.0f} {500 / galvo_engine.sample_rate * 1e3:>11.0f} {stats['late_refills']:>5} {stats['underflows']:>11} "
+              f"{stats['underflow_samples'] / galvo_engine.sample_rate * 1e3:>14.0f} {stats['min_lead_ms']:>14.1f}")
+
+
+def micro_manager_cfg(num_lines):
+    """
+    Builds the text of a Micro-Manager configuration file with the groups the preset writers look for.
+    """
+    lines = [f"Property,Core,Setting{i},{i}\n" for i in range(num_lines)]
+    lines += ["# Configuration presets\n", "# Group: NiAO18_Galvo2\n", "# Preset: Position 0\n",
+              "ConfigGroup,NiAO18_Galvo2,position0,NIDAQAO-Dev1/ao18,Voltage,0.0000\n"]
+    return ''.join(lines)
+
+
+def mda_sequence(num_frames, num_slices, num_channels):
+    """
+    Builds an MDA sequence file (Micro-Manager JSON) matching mda_settings.
+    """
+    settings = mda_settings(num_frames, num_slices, num_channels)
+    channels = [{'config': f"fw{i % settings['FW'] + 1} amp{i // settings['FW'] + 1}", 'exposure': exposure,
+                 'group': 'FW AMP', 'doZStack': True, 'zOffset': 0.0, 'useChannel': True}
+                for i, exposure in enumerate(settings['exposure_times'])]
+    return json.dumps({'numFrames': num_frames, 'intervalMs': 0.0, 'acqOrderMode': 1, 'channels': channels,
+                       'slices': np.linspace(-10, 10, num_slices).tolist(), 'usePositionList': False})
+
+
+def generate_voltage_sequences(settings):
+    """
+    Same work as GalvoWorker_MDA.generate_voltage_sequences: the compiled plan split into per-frame views.
+    """
+    plan = galvo_engine.compile_mda_plan(**settings)
+    return [plan.frame(i) for i in range(len(plan))], plan.durations_ms.tolist()
+
+
+def walk_streaming_plan(settings):
+    """
+    Produces every frame of the lazy plan in the chunks of the player, as run_MDA does.
+    """
+    plan = galvo_engine.stream_mda_plan(**settings)
+    for start, stop in plan.runs():
+        for first in range(start, stop, 64):
+            plan.block(first, min(stop, first + 64))
+
+
+def init_rebuilds(changes, cached):
+    """
+    Rebuilds the initialization frame as the init worker does on every setting change, the slider going back and forth over 20 positions.
+    """
+    for max_voltage in np.tile(np.linspace(1.0, 3.0, 20), changes // 20):
+        if not cached:
+            galvo_engine.waveform_cache.clear()
+        galvo_engine.init_phase_waveform(-1.0, float(max_voltage), 0.5, True, 0.0, 20.0)
+
+
+def measure(function, repeat, setup=None):
+    """
+    Measures a call: best wall time, then peak memory and allocations in a separate traced call.
+
+    Args:
+        function (callable): Call to measure.
+        repeat (int): Number of timed calls, the best one kept.
+        setup (callable or None): Called before every call, outside the measure.
+
+    Returns:
+        dict: wall_s, peak_mb (peak traced memory during the call) and allocations
+        (memory blocks allocated by the call and still alive when it returns, result included).
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    result = function()  # Kept alive for the snapshot
+    peak = tracemalloc.get_traced_memory()[1]
+    allocations = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    del result
+    return {'wall_s': min(times), 'peak_mb': peak / 1e6, 'allocations': allocations}
+
+
+def suite_cases(directory):
+    """
+    Lists the suite cases, at realistic sizes and at the extremes the GUIs accept.
+
+    Returns:
+        list: (name, parameters, function, setup) for every case.
+    """
+    cases = []
+    for label, size in (('realistic', (100, 10, 4)), ('extreme', (300, 20, 4))):
+        settings = mda_settings(*size, Acq_order=1)
+        params = dict(zip(('frames', 'slices', 'channels'), size))
+        cases.append((f'generate_voltage_sequences/{label}', params, lambda s=settings: generate_voltage_sequences(s),
+                      galvo_engine.waveform_cache.clear))
+        cases.append((f'stream_mda_plan/{label}', params, lambda s=settings: walk_streaming_plan(s), galvo_engine.waveform_cache.clear))
+    cases.append(('init_rebuild/cold', {'changes': 200}, lambda: init_rebuilds(200, cached=False), None))
+    cases.append(('init_rebuild/cached', {'changes': 200}, lambda: init_rebuilds(200, cached=True), None))
+
+    cfg = os.path.join(directory, 'benchmark.cfg')
+    for label, lines in (('realistic', 300), ('extreme', 30000)):
+        reset = lambda lines=lines: open(cfg, 'w', encoding='utf-8').write(micro_manager_cfg(lines))
+        cases.append((f'cfg_presets/{label}', {'cfg_lines': lines, 'filters': 6, 'amplitudes': 10},
+                      lambda: galvo_presets.write_fw_amp_presets(cfg, galvo_presets.fw_amp_presets([f'fw{i}' for i in range(1, 7)], 10)), reset))
+        cases.append((f'cfg_voltage_intervals/{label}', {'cfg_lines': lines, 'positions': 200},
+                      lambda: galvo_presets.write_voltage_intervals(cfg, 200, 0.01, -1.0), reset))
+
+    for label, size in (('realistic', (10, 10, 4)), ('extreme', (1000, 500, 64))):
+        text = mda_sequence(*size)
+        cases.append((f'parse_mda_sequence/{label}', {'json_bytes': len(text)},
+                      lambda text=text: galvo_engine.parse_mda_sequence(json.loads(text)), None))
+
+    rng = np.random.default_rng(0)
+    for label, side in (('realistic', 512), ('extreme', 2304)):
+        image = rng.integers(100, 4000, (side, side), dtype=np.uint16)  # Camera frame, 12-bit range
+        cases.append((f'histogram_display/{label}', {'pixels': side * side},
+                      lambda image=image: galvo_display.histogram_display(image, 200, 3000), None))
+    return cases
+
+
+def run_suite(repeat, only=None):
+    """
+    Runs the benchmark suite and prints every case.
+
+    Args:
+        repeat (int): Number of timed calls per case.
+        only (str or None): Runs only the cases whose name contains it.
+
+    Returns:
+        dict: Environment and per-case results, ready for JSON.
+    """
+    results = {'commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+               'platform': platform.platform(), 'repeat': repeat, 'cases': {}}
+    print(f"{'case':<36} {'wall (ms)':>10} {'peak (MB)':>10} {'allocations':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, params, function, setup in suite_cases(directory):
+            if only and only not in name:
+                continue
+            result = measure(function, repeat, setup)
+            results['cases'][name] = dict(params=params, **result)
+            print(f"{name:<36} {result['wall_s'] * 1e3:>10.2f} {result['peak_mb']:>10.2f} {result['allocations']:>12}")
+    return results
+
+
+def git_commit():
+    """
+    Returns the short hash of the checked out commit, None outside a git repository.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Prints the change of every case against a baseline results file.
+
+    A case regresses when its wall time or peak memory grows by more than the tolerance.
+
+    Returns:
+        int: Number of regressions.
+    """
+    regressions = 0
+    print(f"Against {baseline.get('commit')}:")
+    print(f"{'case':<36} {'wall':>8} {'peak':>8}")
+    for name, result in results['cases'].items():
+        reference = baseline['cases'].get(name)
+        if reference is None:
+            print(f"{name:<36} {'new':>8}")
+            continue
+        wall = result['wall_s'] / reference['wall_s']
+        peak = result['peak_mb'] / reference['peak_mb'] if reference['peak_mb'] else 1.0
+        regressed = wall > 1 + tolerance or peak > 1 + tolerance
+        regressions += regressed
+        print(f"{name:<36} {wall:>7.2f}x {peak:>7.2f}x{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the galvo waveform engine.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs kept for the best time')
+    parser.add_argument('--suite', action='store_true', help='Run the regression suite instead of the comparisons')
+    parser.add_argument('--only', default=None, help='Suite cases whose name contains this text')
+    parser.add_argument('--results', default=None, help='Suite results output (JSON)')
+    parser.add_argument('--baseline', default=None, help='Suite results of a previous version to compare with (JSON)')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Growth of wall time or peak memory counted as a regression')
+    args = parser.parse_args()
+
+    if args.suite:
+        results = run_suite(args.repeat, args.only)
+        if args.results:
+            with open(args.results, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"Results saved to {args.results}")
+        regressions = 0
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_results(results, json.load(f), args.tolerance)
+        sys.exit(1 if regressions else 0)
+
+    check_equivalence()
+    benchmark_plan_compiler([(10, 10, 2), (100, 10, 2), (100, 50, 4), (1000, 20, 4)], args.repeat)
+    benchmark_plan_footprint([(10, 10, 2), (100, 10, 2), (1000, 20, 4)])
+    benchmark_plan_memory([(100, 10, 2), (1000, 10, 2), (2000, 20, 2)])
+    benchmark_playback([10, 20, 28], num_frames=40)
+    benchmark_coalescing(trigger_rate=20, num_frames=3, num_slices=10)
+    benchmark_raw_writes(trigger_rate=20, num_frames=10)
+    benchmark_pipeline(trigger_rate=28, num_frames=20, num_channels=4)
+    benchmark_ping_pong([20, 24, 26, 28], num_frames=15)
+    benchmark_idle_cpu(seconds=2)
+    benchmark_cancellation(trials=20, trigger_rate=25)
+    benchmark_setting_change(changes=50)
+    benchmark_on_demand_writes(writes=200)
+    benchmark_continuous([2, 6], [0.0, 0.04, 0.08])
+    benchmark_scan_duty([1, 10, 50, 200], amplitude=8.0, slew=1.0)
+    benchmark_flyback([0.25, 0.5, 1.0, 4.0, 8.0, 16.0], exposure=10)
+    benchmark_frame_period([2048, 1024, 512, 128], exposures=[1, 10, 50])
+    benchmark_calibration(512, exposures=[1, 10, 50])
+    benchmark_sample_rate([[1], [10], [100], [2000], [1, 2000]])
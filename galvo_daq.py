@@ -0,0 +1,1920 @@
+# Hardware playback of compiled galvo plans
+# RAphael TOSCANO
+
+import collections
+import math
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+import galvo_engine
+import galvo_timing
+
+try:
+    import nidaqmx
+    import nidaqmx.system
+    from nidaqmx.stream_writers import AnalogMultiChannelWriter, AnalogUnscaledWriter
+    from nidaqmx.constants import Edge, AcquisitionType, RegenerationMode, TaskMode, TimeUnits
+    DaqError = nidaqmx.errors.DaqError
+except ImportError:  # No NI driver: only the simulated backend is available
+    nidaqmx = None
+
+    class DaqError(Exception):
+        """
+        Stand-in for nidaqmx.errors.DaqError when nidaqmx is not installed.
+        """
+        def __init__(self, message, error_code=0, task_name=''):
+            super().__init__(message)
+            self.error_code = error_code
+
+# DAQ wiring
+galvo1_channel = 'Dev1/ao17'    # Main galvo
+galvo2_channel = 'Dev1/ao18'    # Second galvo
+trigger_source = '/Dev1/PFI1'   # Camera trigger output
+trigger_counter = 'Dev1/ctr0'   # Counter timing the camera trigger edges
+camera_trigger_channel = 'Dev1/ao19'  # Default AO channel wired to the camera external trigger input, driven by the continuous generation
+camera_trigger_voltage = 5.0    # V, TTL level of the camera trigger pulse
+camera_trigger_width = 0.0001   # s, shortest camera trigger pulse, at least one sample
+poll_interval = 0.001           # s, between two reads of the generated sample count
+park_voltage = 0.0              # V, safe position of both galvos after a cancelled MDA
+cancel_deadline = 0.05          # s, from the cancel request to the galvos parked
+stop_margin = 0.005             # s, shortest gap after a frame for a repeat block to be stopped before the next trigger
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a player when its run is cancelled from another thread.
+    """
+
+
+class FrameOverrun(Exception):
+    """
+    Raised when a repeat block played its frame more times than planned, every later frame being shifted.
+    """
+
+
+class NidaqTask:
+    """
+    AO task on a real NI card, wrapping nidaqmx.Task.
+
+    All the players and widgets go through this small interface so the simulated
+    backend can take its place.
+    """
+    def __init__(self):
+        self.task = nidaqmx.Task()
+        self.writer = None
+        self.raw_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_ao_channel(self, channel):
+        self.task.ao_channels.add_ao_voltage_chan(channel)
+
+    def cfg_trigger(self, source, retriggerable=False):
+        self.task.triggers.start_trigger.cfg_dig_edge_start_trig(source, trigger_edge=Edge.RISING)
+        if retriggerable:
+            self.task.triggers.start_trigger.retriggerable = True
+
+    def cfg_timing(self, rate, samps_per_chan):
+        self.task.timing.cfg_samp_clk_timing(rate=rate, sample_mode=AcquisitionType.FINITE, samps_per_chan=samps_per_chan)
+
+    def cfg_continuous(self, rate, buffer_samples):
+        """
+        Generates without end at the sample rate from a buffer of buffer_samples samples per channel.
+        """
+        self.task.timing.cfg_samp_clk_timing(rate=rate, sample_mode=AcquisitionType.CONTINUOUS, samps_per_chan=buffer_samples)
+        self.task.out_stream.output_buf_size = buffer_samples
+
+    def register_every_n_samples(self, n, callback):
+        """
+        Calls callback() from a driver thread every time n samples per channel left the buffer for the device.
+        """
+        def event(task_handle, event_type, number_of_samples, callback_data):
+            callback()
+            return 0  # Required by DAQmx
+        self.task.register_every_n_samples_transferred_from_buffer_event(n, event)
+
+    def add_ci_period_channel(self, counter, source, min_period, max_period):
+        """
+        Measures the time in seconds between consecutive rising edges of source.
+        """
+        channel = self.task.ci_channels.add_ci_period_chan(counter, min_val=min_period, max_val=max_period,
+                                                           units=TimeUnits.SECONDS, edge=Edge.RISING)
+        channel.ci_period_term = source
+
+    def cfg_implicit_timing(self, samps_per_chan):
+        self.task.timing.cfg_implicit_timing(sample_mode=AcquisitionType.FINITE, samps_per_chan=samps_per_chan)
+
+    def read_periods(self, count, timeout):
+        """
+        Reads count edge intervals in seconds, the task starts by itself.
+        """
+        return np.asarray(self.task.read(number_of_samples_per_channel=count, timeout=timeout), dtype=np.float64)
+
+    def set_regeneration(self, allow):
+        self.task.out_stream.regen_mode = RegenerationMode.ALLOW_REGENERATION if allow else RegenerationMode.DONT_ALLOW_REGENERATION
+
+    def set_buffer_size(self, samps_per_chan):
+        self.task.out_stream.output_buf_size = samps_per_chan
+
+    def write(self, data):
+        """
+        Writes a 2D array (channels, samples) to the buffer.
+        """
+        if self.writer is None:
+            self.writer = AnalogMultiChannelWriter(self.task.out_stream)
+        self.writer.write_many_sample(np.ascontiguousarray(data, dtype=np.float64))
+
+    def write_value(self, value):
+        """
+        Writes one on-demand value, the task starts by itself.
+        """
+        self.task.write(value)
+
+    def write_raw(self, data):
+        """
+        Writes a 2D int16 array (channels, samples) of DAC codes, without scaling.
+        """
+        if self.raw_writer is None:
+            self.raw_writer = AnalogUnscaledWriter(self.task.out_stream)
+        self.raw_writer.write_int16(np.ascontiguousarray(data, dtype=np.int16))
+
+    def dac_coefficients(self):
+        """
+        Returns the volts to DAC code calibration polynomial of every channel.
+        """
+        return [list(channel.ao_dev_scaling_coeff) for channel in self.task.ao_channels]
+
+    def verify(self):
+        self.task.control(TaskMode.TASK_VERIFY)
+
+    def commit(self):
+        self.task.control(TaskMode.TASK_COMMIT)
+
+    def start(self):
+        self.task.start()
+
+    def stop(self):
+        self.task.stop()
+
+    def abort(self):
+        """
+        Stops the generation at once, without waiting for the current frame to end.
+        """
+        self.task.control(TaskMode.TASK_ABORT)
+
+    def wait_until_done(self, timeout):
+        self.task.wait_until_done(timeout=timeout)
+
+    def samples_generated(self):
+        return self.task.out_stream.total_samp_per_chan_generated
+
+    def close(self):
+        self.task.close()
+
+
+class NidaqBackend:
+    """
+    Backend driving the real NI card through nidaqmx.
+    """
+    name = 'nidaqmx'
+
+    def __init__(self):
+        self.max_rate = None
+
+    def create_task(self):
+        if nidaqmx is None:
+            raise DaqError("nidaqmx is not installed, use the simulated backend.", -200220)
+        return NidaqTask()
+
+    def ao_max_rate(self):
+        """
+        Returns the fastest AO sample clock of the card in Hz, read from the device once.
+        """
+        if self.max_rate is None:
+            if nidaqmx is None:
+                raise DaqError("nidaqmx is not installed, use the simulated backend.", -200220)
+            self.max_rate = float(nidaqmx.system.Device(galvo1_channel.split('/')[0]).ao_max_rate)
+        return self.max_rate
+
+
+class SimulatedTask:
+    """
+    In-process AO task recording everything written to it.
+
+    The generation is modelled analytically from the trigger edges of the backend: a
+    (re)triggered task plays samps_per_chan samples at the sample rate, and edges arriving
+    while a frame is still playing are missed, exactly like on the card.
+
+    A continuous task starts on the first trigger edge, or at once without a trigger, and
+    then generates at the sample rate until stopped. Its every-N-samples events are raised from a thread of the
+    backend, as DAQmx raises them from a driver thread. An abort does not wait for
+    them: like DAQmx Abort, it interrupts a write in progress, which raises DaqError.
+
+    A counter-input task times the trigger edges of the backend, read as they arrive.
+
+    The task follows the DAQmx states: any configuration makes it unverified, starting it
+    verifies and commits it as needed, writing commits it, and a committed task reserves
+    its channels so a second task committing them fails.
+
+    Attributes:
+        channels (list of str): AO channels and counters added to the task.
+        period (dict or None): Counter, edge source and period range of a counter-input task.
+        trigger (dict or None): Trigger source and retriggerable flag.
+        timing (dict or None): Sample rate, samples per channel and continuous flag.
+        regeneration (bool): True if the buffer is replayed on every trigger.
+        writes (list of np.ndarray): Copies of every block written, volts or int16 codes.
+        values (list of float): On-demand values written.
+        starts (list of float): Start time of every run of the task.
+        state (str): 'unverified', 'verified', 'committed' or 'running'.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.channels = []
+        self.period = None
+        self.trigger = None
+        self.timing = None
+        self.regeneration = True
+        self.buffer_size = None
+        self.writes = []
+        self.values = []
+        self.starts = []
+        self.buffered = 0       # Samples per channel written since the last start
+        self.start_time = None  # None when the task is stopped
+        self.stopped_samples = 0  # Samples per channel generated by the last run, kept after it stopped
+        self.closed = False
+        self.state = 'unverified'
+        self.every_n = None     # (n, callback) of the every-N-samples event
+        self.event_thread = None
+        self.aborts = 0         # Aborts so far, for the writes they interrupt
+        backend.tasks.append(self)
+        backend.call('create')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _check_open(self):
+        if self.closed:
+            raise DaqError("The task has been closed.", -200088)
+
+    def _configure(self):
+        self._check_open()
+        if self.state == 'running':
+            raise DaqError("Specified property cannot be set while the task is running.", -200557)
+        self.state = 'unverified'
+        self.backend.call('configure')
+
+    def verify(self):
+        """
+        Validates the configuration without reserving the channels.
+        """
+        self._check_open()
+        if self.state == 'unverified':
+            self.backend.call('verify')
+            self.state = 'verified'
+
+    def commit(self):
+        """
+        Reserves the channels and programs the device.
+        """
+        self.verify()
+        if self.state == 'verified':
+            for other in self.backend.tasks:
+                if other is not self and other.state in ('committed', 'running') and set(other.channels) & set(self.channels):
+                    raise DaqError("The specified resource is reserved.", -50103)
+            self.backend.call('commit')
+            self.state = 'committed'
+
+    def add_ao_channel(self, channel):
+        self._configure()
+        self.channels.append(channel)
+
+    def cfg_trigger(self, source, retriggerable=False):
+        self._configure()
+        self.trigger = {'source': source, 'retriggerable': retriggerable}
+
+    def cfg_timing(self, rate, samps_per_chan):
+        self._configure()
+        self.timing = {'rate': rate, 'samps_per_chan': int(samps_per_chan), 'continuous': False}
+
+    def cfg_continuous(self, rate, buffer_samples):
+        self._configure()
+        self.timing = {'rate': rate, 'samps_per_chan': int(buffer_samples), 'continuous': True}
+        self.buffer_size = int(buffer_samples)
+
+    def register_every_n_samples(self, n, callback):
+        self._configure()
+        self.every_n = (int(n), callback)
+
+    def add_ci_period_channel(self, counter, source, min_period, max_period):
+        self._configure()
+        self.channels.append(counter)
+        self.period = {'source': source, 'min': min_period, 'max': max_period}
+
+    def cfg_implicit_timing(self, samps_per_chan):
+        self._configure()
+        self.timing = {'rate': None, 'samps_per_chan': int(samps_per_chan), 'continuous': False}
+
+    def read_periods(self, count, timeout):
+        """
+        Waits for count + 1 trigger edges and returns the count intervals between them, in seconds.
+        """
+        self._check_open()
+        if self.period is None:
+            raise DaqError("The task has no counter-input channel.", -200478)
+        self.commit()
+        self.backend.call('start')
+        edges = self.backend.trigger_edges(time.perf_counter(), count + 1)
+        if edges[-1] - time.perf_counter() > timeout:
+            time.sleep(timeout)
+            raise DaqError("Some or all of the samples requested have not yet been acquired.", -200284)
+        time.sleep(max(0.0, edges[-1] - time.perf_counter()))  # The intervals are only known once the edges arrived
+        self.backend.call('stop')
+        self.state = 'verified'
+        return np.diff(edges)
+
+    def set_regeneration(self, allow):
+        self._configure()
+        self.regeneration = allow
+
+    def set_buffer_size(self, samps_per_chan):
+        self._configure()
+        self.buffer_size = int(samps_per_chan)
+
+    def write(self, data):
+        self._check_open()
+        self._record(np.atleast_2d(np.asarray(data, dtype=np.float64)))
+
+    def _record(self, data):
+        aborts = self.aborts
+        self.commit()  # Writing commits the task, like DAQmx Write
+        if data.shape[0] != len(self.channels):
+            raise DaqError(f"Write of {data.shape[0]} channels to a task with {len(self.channels)} channels.", -200524)
+        if self.backend.record:
+            self.writes.append(data.copy())
+        self.buffered += data.shape[1]
+        self.backend.written_samples += data.size
+        self.backend.written_bytes += data.nbytes
+        self.backend.call('write', data.nbytes)
+        if self.aborts != aborts:
+            raise DaqError("The write was interrupted by an abort of the task.", -88709)
+
+    def write_raw(self, data):
+        self._check_open()
+        data = np.atleast_2d(np.asarray(data))
+        if data.dtype != np.int16:
+            raise DaqError(f"Unscaled writes expect int16 codes, got {data.dtype}.", -200524)
+        self._record(data)
+
+    def dac_coefficients(self):
+        return [list(self.backend.dac_coefficients) for _ in self.channels]
+
+    def write_value(self, value):
+        self.commit()
+        self.values.append(value)
+        self.backend.written_samples += 1
+        self.backend.written_bytes += 8
+        self.backend.call('write', 8)
+
+    def start(self):
+        self.commit()
+        self._join_events()  # Left running by an abort
+        self.state = 'running'
+        self.backend.call('start')
+        self.start_time = time.perf_counter()
+        self.starts.append(self.start_time)
+        if self.every_n is not None:
+            self.event_thread = threading.Thread(target=self._raise_events, args=(self.start_time,), name='simulated DAQ events', daemon=True)
+            self.event_thread.start()
+
+    def _raise_events(self, start_time):
+        """
+        Calls the every-N-samples callback as the generation moves on, until the task is stopped.
+        """
+        n, callback = self.every_n
+        transferred = n
+        while self.start_time == start_time:
+            if self._generated(time.perf_counter()) >= transferred:
+                callback()
+                transferred += n
+            else:
+                time.sleep(poll_interval)
+
+    def _halt(self, wait=True):
+        """
+        Ends the generation and, unless wait is False, waits for the event thread.
+        """
+        self.stopped_samples = self._generated(time.perf_counter())
+        self.start_time = None
+        self.buffered = 0
+        if wait:
+            self._join_events()
+
+    def _join_events(self):
+        """
+        Waits for the event thread to end, unless called from it.
+        """
+        if self.event_thread is not None and self.event_thread is not threading.current_thread():
+            self.event_thread.join()
+        self.event_thread = None
+
+    def stop(self):
+        self._check_open()
+        self.backend.call('stop')
+        self.state = 'verified'  # Back to the state before the implicit commit, channels released
+        self._halt()
+
+    def abort(self):
+        self._check_open()
+        self.backend.call('abort')
+        self.aborts += 1
+        self.state = 'verified'  # Aborting also releases the channels
+        self._halt(wait=False)  # A callback being run ends on its own
+
+    def close(self):
+        if not self.closed:
+            self.backend.call('close')
+            self._halt()
+            self.state = 'unverified'
+            self.closed = True
+
+    def frames_capacity(self):
+        """
+        Returns how many frames the task can play before its buffer runs out.
+        """
+        samps_per_chan = self.timing['samps_per_chan']
+        if self.timing['continuous'] or (self.trigger is not None and self.trigger['retriggerable'] and self.regeneration):
+            return math.inf
+        if self.trigger is not None and self.trigger['retriggerable']:
+            return self.buffered // samps_per_chan
+        return 1
+
+    def frame_times(self, now):
+        """
+        Returns the start times of the frames played since the task started, up to now.
+        """
+        if self.start_time is None or self.timing is None:
+            return np.empty(0)
+        frame_s = self.timing['samps_per_chan'] / self.timing['rate']
+        if self.trigger is None:
+            first = self.start_time  # No trigger: plays as soon as it starts
+            period = frame_s
+        else:
+            first = self.backend.next_trigger(self.start_time)
+            edges_per_frame = max(1, math.ceil(frame_s * self.backend.trigger_rate - 1e-9))  # Edges during a frame are missed
+            period = edges_per_frame / self.backend.trigger_rate
+        if now < first:
+            return np.empty(0)
+        count = min(int((now - first) // period) + 1, self.frames_capacity())
+        return first + period * np.arange(count)
+
+    def samples_generated(self):
+        self._check_open()
+        if self.start_time is None:
+            return self.stopped_samples  # Like DAQmx, the count of the last run stays readable until the next start
+        return self._generated(time.perf_counter())
+
+    def _generated(self, now):
+        """
+        Returns the samples per channel generated from the start of the task to now.
+        """
+        start_time = self.start_time
+        if start_time is None or self.timing is None:
+            return 0
+        if self.timing['continuous']:  # Back to back from the start trigger
+            first = start_time if self.trigger is None else self.backend.next_trigger(start_time)
+            return max(0, int((now - first) * self.timing['rate']))
+        starts = self.frame_times(now)
+        if len(starts) == 0:
+            return 0
+        samps_per_chan = self.timing['samps_per_chan']
+        current = min(samps_per_chan, int((now - starts[-1]) * self.timing['rate']))
+        return (len(starts) - 1) * samps_per_chan + current
+
+    def missed_triggers(self):
+        """
+        Returns how many trigger edges arrived while a frame was still playing.
+        """
+        if self.trigger is None or self.timing is None or not self.trigger['retriggerable']:
+            return 0
+        frame_s = self.timing['samps_per_chan'] / self.timing['rate']
+        edges_per_frame = max(1, math.ceil(frame_s * self.backend.trigger_rate - 1e-9))
+        return (edges_per_frame - 1) * len(self.frame_times(time.perf_counter()))
+
+    def wait_until_done(self, timeout):
+        self._check_open()
+        if self.frames_capacity() == math.inf:
+            raise DaqError("A continuous or regenerating retriggerable task never finishes.", -200560)
+        frame_s = self.timing['samps_per_chan'] / self.timing['rate']
+        deadline = time.perf_counter() + timeout
+        while True:
+            starts = self.frame_times(time.perf_counter())
+            if len(starts) == self.frames_capacity() and time.perf_counter() >= starts[-1] + frame_s:
+                return
+            if time.perf_counter() > deadline:
+                raise DaqError("Wait Until Done did not indicate that the task is done within the timeout.", -200560)
+            time.sleep(poll_interval)
+
+
+class SimulatedBackend:
+    """
+    In-process simulated DAQ with a free-running camera trigger on PFI1.
+
+    Every task, sample and configuration is recorded so playback can be checked and
+    benchmarked without a card. Driver calls cost a configurable time, which is what
+    makes the number of task setups show up in the measured frame rate.
+
+    Attributes:
+        trigger_rate (float): Camera trigger frequency in Hz.
+        camera (CameraTiming or None): Dead time of the simulated camera, for free-runs at a given exposure.
+        trigger_jitter (float): Standard deviation of the trigger edge times in seconds, seen by the counter.
+        latency (dict): Cost in seconds of each kind of driver call.
+        record (bool): False to only count the samples of long runs instead of keeping them.
+        tasks (list of SimulatedTask): Every task created.
+        written_samples (int): Total number of samples written, all channels.
+        written_bytes (int): Total host to device transfer in bytes.
+        calls (dict): Number of driver calls of each kind.
+    """
+    name = 'simulated'
+    default_latency = {'create': 0.002, 'configure': 0.0002, 'verify': 0.003, 'commit': 0.001, 'write': 0.0005,
+                       'start': 0.0005, 'stop': 0.0005, 'abort': 0.0002, 'close': 0.001}
+    write_latency_per_byte = 2.5e-10  # s, host to device transfer
+    dac_coefficients = (0.0, 32767 / 10)  # Ideal 16 bit DAC over ±10 V, volts to code
+
+    def __init__(self, trigger_rate=50.0, latency=None, record=True, camera=None, trigger_jitter=0.0):
+        self.trigger_rate = trigger_rate
+        self.camera = camera
+        self.trigger_jitter = trigger_jitter
+        self.rng = np.random.default_rng(0)
+        self.record = record
+        self.latency = dict(self.default_latency if latency is None else latency)
+        self.t0 = time.perf_counter()  # Time of the first trigger edge
+        self.tasks = []
+        self.written_samples = 0
+        self.written_bytes = 0
+        self.calls = {}
+
+    def create_task(self):
+        return SimulatedTask(self)
+
+    def ao_max_rate(self):
+        """
+        Returns the fastest AO sample clock of the simulated card in Hz.
+        """
+        return float(galvo_engine.max_ao_rate)
+
+    def call(self, kind, nbytes=0):
+        """
+        Counts a driver call and spends its simulated cost.
+        """
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        cost = self.latency.get(kind, 0.0) + nbytes * self.write_latency_per_byte
+        if cost > 0:
+            time.sleep(cost)
+
+    def next_trigger(self, t):
+        """
+        Returns the time of the first trigger edge at or after t.
+        """
+        period = 1.0 / self.trigger_rate
+        return self.t0 + math.ceil((t - self.t0) / period - 1e-9) * period
+
+    def trigger_edges(self, t, count):
+        """
+        Returns the times of count trigger edges from t on, with the trigger jitter.
+        """
+        edges = self.next_trigger(t) + np.arange(count) / self.trigger_rate
+        if self.trigger_jitter > 0:
+            edges = edges + self.rng.normal(0.0, self.trigger_jitter, count)
+        return edges
+
+    def free_run(self, exposure_ms):
+        """
+        Sets the camera free-running at an exposure: it triggers as fast as its dead time allows.
+        """
+        if self.camera is None:
+            raise DaqError("The simulated backend has no camera model to free-run.", -200220)
+        self.trigger_rate = 1000.0 / (exposure_ms + self.camera.dead_time_ms(exposure_ms))
+        self.t0 = time.perf_counter()
+
+
+_backend = None
+
+
+def max_sample_rate(backend=None):
+    """
+    Returns the fastest AO sample clock of the device in Hz, galvo_engine.max_ao_rate if it cannot be read.
+
+    Args:
+        backend (NidaqBackend or SimulatedBackend): Device, the current backend by default.
+    """
+    backend = get_backend() if backend is None else backend
+    try:
+        return backend.ao_max_rate()
+    except DaqError as e:  # No driver, or card absent or busy: the tasks report it later
+        print(f"DAQ Error: {e}, sample clock limited to {galvo_engine.max_ao_rate} Hz")
+        return float(galvo_engine.max_ao_rate)
+
+
+def get_backend():
+    """
+    Returns the backend used by every task, chosen by GALVO_BACKEND ('nidaqmx' or 'simulated').
+    """
+    global _backend
+    if _backend is None:
+        if os.environ.get('GALVO_BACKEND', 'nidaqmx') == 'simulated':
+            _backend = SimulatedBackend(trigger_rate=float(os.environ.get('GALVO_TRIGGER_RATE', 50.0)))
+        else:
+            _backend = NidaqBackend()
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Replaces the backend used by every task.
+
+    Args:
+        backend (NidaqBackend or SimulatedBackend): New backend.
+    """
+    global _backend
+    _backend = backend
+
+
+class CountedTask:
+    """
+    Wraps a task to count the driver calls made through it.
+
+    Reads of the generated sample count are polls, not round-trips, and are not counted.
+    """
+    def __init__(self, task, stats):
+        self.task = task
+        self.stats = stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.task, name)
+        if not callable(attribute) or name == 'samples_generated':
+            return attribute
+
+        def call(*args, **kwargs):
+            self.stats['driver_calls'] += 1
+            return attribute(*args, **kwargs)
+        return call
+
+
+class SettingsMailbox:
+    """
+    Holds the latest immutable settings snapshot published by the GUI thread.
+
+    Snapshots carry an increasing version. Publishing replaces the previous snapshot, so a
+    worker that falls behind only sees the latest one, and waits on a condition instead of
+    reading the widgets from its own thread.
+
+    Attributes:
+        snapshot (tuple or None): Latest snapshot, with a version attribute.
+    """
+    def __init__(self):
+        self.snapshot = None
+        self.condition = threading.Condition()
+
+    def publish(self, snapshot):
+        """
+        Replaces the current snapshot and wakes up the waiting workers.
+        """
+        with self.condition:
+            if self.snapshot is not None and snapshot.version <= self.snapshot.version:
+                raise ValueError(f"Settings version {snapshot.version} is not newer than {self.snapshot.version}.")
+            self.snapshot = snapshot
+            self.condition.notify_all()
+
+    def latest(self):
+        """
+        Returns the current snapshot, None if nothing was published yet.
+        """
+        with self.condition:
+            return self.snapshot
+
+    def wait_newer(self, version, timeout=None, cancelled=None):
+        """
+        Waits for a snapshot newer than version.
+
+        Args:
+            version (int or None): Version already handled, None if none.
+            timeout (float or None): Maximum wait in seconds, None to wait forever.
+            cancelled (callable or None): Checked on every wake-up, stops the wait when it returns True.
+
+        Returns:
+            tuple or None: The newer snapshot, None on timeout or cancellation.
+        """
+        newer = lambda: self.snapshot is not None and (version is None or self.snapshot.version > version)
+        with self.condition:
+            self.condition.wait_for(lambda: newer() or (cancelled is not None and cancelled()), timeout)
+            return self.snapshot if newer() else None
+
+    def wake(self):
+        """
+        Wakes up the waiting workers without publishing, so they check their cancellation.
+        """
+        with self.condition:
+            self.condition.notify_all()
+
+
+class SettingsFollower:
+    """
+    Keeps a RetriggerableOutput loaded with the frame of the latest settings snapshot.
+
+    The worker thread sleeps on the mailbox until the GUI publishes, so it uses no CPU while
+    the settings are incomplete or unchanged. After a device error the task is rebuilt with
+    an exponential back-off, a newer snapshot being tried at once.
+
+    With a device actor, every device call of the output runs in the actor thread, and an
+    on-demand write to one of its channels closes the output, which is then armed again.
+
+    Attributes:
+        mailbox (SettingsMailbox): Snapshots published by the GUI thread.
+        output (RetriggerableOutput): Armed task replaying the frame.
+        waveform (callable): Returns (key, frame builder), optionally followed by the frames in the buffer and their
+            sample rate, for a snapshot. None if the snapshot is incomplete.
+        actor (DeviceActor or None): Thread the device calls are made from, None for the calling thread.
+        min_backoff (float): Wait in seconds after the first device error.
+        max_backoff (float): Longest wait in seconds between two attempts.
+        running (bool): False once stop() is called.
+        metrics (dict): Wake-ups, reloads, errors, and the CPU and wall time of the last run.
+    """
+    def __init__(self, mailbox, output, waveform, min_backoff=0.01, max_backoff=1.0, actor=None):
+        self.mailbox = mailbox
+        self.output = output
+        self.waveform = waveform
+        self.actor = actor
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.running = True
+        self.rearm = False  # Set when the actor closed the output to write on its channels
+        self.metrics = {'wakeups': 0, 'reloads': 0, 'rearms': 0, 'errors': 0, 'cpu_s': 0.0, 'wall_s': 0.0, 'cpu_fraction': 0.0}
+
+    def backoff(self, failures):
+        """
+        Returns the wait in seconds after the given number of consecutive device errors.
+        """
+        return min(self.max_backoff, self.min_backoff * 2 ** (failures - 1))
+
+    def run(self):
+        """
+        Follows the published snapshots until stop() is called, then closes the output.
+        """
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        version = None  # Version of the last snapshot handled
+        failures = 0  # Consecutive device errors
+        if self.actor is not None:
+            self.actor.claim(self.output.channels, self._release)
+        try:
+            while self.running:
+                timeout = self.backoff(failures) if failures else None
+                snapshot = self.mailbox.wait_newer(version, timeout, cancelled=lambda: not self.running or self.rearm)
+                if not self.running:
+                    break
+                self.metrics['wakeups'] += 1
+                if self.rearm:
+                    self.rearm = False
+                    self.metrics['rearms'] += 1
+                if snapshot is None:  # Back-off elapsed or output released: load the latest snapshot again
+                    snapshot = self.mailbox.latest()
+                    if snapshot is None:
+                        continue
+                version = snapshot.version
+                try:
+                    waveform = self.waveform(snapshot)  # May query the device, so retried like a reload
+                    if waveform is None:  # Incomplete settings, wait for the next snapshot
+                        failures = 0
+                        continue
+                    # Reload the buffer only if a setting changed, the task stays armed otherwise
+                    self.metrics['reloads'] += self._device(lambda: self.output.load(*waveform))
+                    failures = 0
+                except DaqError as e:  # Rebuild the task after the back-off
+                    self._device(self.output.close)
+                    failures += 1
+                    self.metrics['errors'] += 1
+                    print(f"DAQ Error: {e}, retrying in {self.backoff(failures) * 1e3:.0f} ms")
+        finally:
+            if self.actor is not None:
+                self.actor.unclaim(self.output.channels)
+            self._device(self.output.close)
+            self.metrics['wall_s'] = time.perf_counter() - wall_start
+            self.metrics['cpu_s'] = time.thread_time() - cpu_start
+            self.metrics['cpu_fraction'] = self.metrics['cpu_s'] / max(self.metrics['wall_s'], 1e-9)
+
+    def _device(self, function):
+        """
+        Runs a device call of the output, in the actor thread if there is one.
+        """
+        if self.actor is None:
+            return function()
+        return self.actor.call(function, self.output.channels)
+
+    def _release(self):
+        """
+        Closes the output for an on-demand write, in the actor thread, and asks for it to be armed again.
+        """
+        self.output.close()
+        self.rearm = True
+        self.mailbox.wake()
+
+    def stop(self):
+        """
+        Ends run() from any thread, without waiting for a new snapshot.
+        """
+        self.running = False
+        self.mailbox.wake()
+
+
+class DeviceActor:
+    """
+    Single thread making every on-demand write to the galvos.
+
+    GUI handlers submit commands and return at once. A write to a channel whose previous
+    write is still queued replaces its value, so a burst of moves only writes the last
+    one. Each channel keeps one persistent on-demand task, closed only when another
+    task needs the channel: a call() made for these channels, or a timed play().
+
+    Tasks armed by other threads register a release function with claim(). The actor
+    calls it before taking one of their channels, and those threads make their own
+    device calls through call(), so two tasks never reserve a channel at the same time.
+
+    Attributes:
+        backend (NidaqBackend or SimulatedBackend): Device the tasks are created on.
+        tasks (dict): On-demand task of each channel.
+        owners (dict): Release function of the task armed on each claimed channel.
+        metrics (dict): Writes submitted, written and coalesced, calls, tasks created and errors.
+    """
+    def __init__(self, backend=None):
+        self.backend = get_backend() if backend is None else backend
+        self.tasks = {}
+        self.owners = {}
+        self.queue = collections.deque()
+        self.pending_writes = {}  # Queued write of each channel, updated in place
+        self.busy = False
+        self.running = True
+        self.condition = threading.Condition()
+        self.metrics = {'submitted': 0, 'written': 0, 'coalesced': 0, 'calls': 0, 'tasks_created': 0, 'errors': 0}
+        self.thread = threading.Thread(target=self._run, name='galvo device actor', daemon=True)
+        self.thread.start()
+
+    def write(self, channel, value):
+        """
+        Queues an on-demand write, merged with a write to the same channel still queued.
+        """
+        with self.condition:
+            self.metrics['submitted'] += 1
+            entry = self.pending_writes.get(channel)
+            if entry is not None:
+                entry[2] = value  # Not written yet: only the latest value matters
+                self.metrics['coalesced'] += 1
+            else:
+                entry = ['write', channel, value]
+                self.pending_writes[channel] = entry
+                self.queue.append(entry)
+            self.condition.notify_all()
+
+    def call(self, function, channels=(), wait=True, timeout=None):
+        """
+        Runs a function in the actor thread, after closing the on-demand tasks of the channels.
+
+        Args:
+            function (callable): Function without arguments.
+            channels (iterable of str): Channels the function creates tasks on.
+            wait (bool): True to wait for the result, False to return at once.
+            timeout (float or None): Maximum wait in seconds.
+
+        Returns:
+            The result of the function if wait is True.
+
+        Raises:
+            Exception: Raised again from the function if wait is True.
+        """
+        channels = tuple(channels)
+        if threading.current_thread() is self.thread:  # Already in the actor
+            self._free(channels)
+            return function()
+        entry = ['call', channels, function, {}, threading.Event(), wait]
+        with self.condition:
+            for channel in channels:
+                self.pending_writes.pop(channel, None)  # Later writes go after the call
+            self.queue.append(entry)
+            self.condition.notify_all()
+        if not wait:
+            return None
+        if not entry[4].wait(timeout):
+            raise TimeoutError("The device actor did not run the call in time.")
+        result = entry[3]
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+
+    def play(self, channel, samples, rate, done=None):
+        """
+        Plays a timed sequence on one channel, such as a slow galvo move, without blocking the caller.
+
+        Args:
+            channel (str): AO channel.
+            samples (np.ndarray): 1D voltages.
+            rate (float): Sample clock rate in Hz.
+            done (callable or None): Called in the actor thread once the sequence is played.
+        """
+        def play():
+            self._take((channel,))
+            with self.backend.create_task() as task:
+                task.add_ao_channel(channel)
+                task.cfg_timing(rate, len(samples))
+                task.write(np.asarray(samples)[np.newaxis, :])
+                task.start()
+                task.wait_until_done(timeout=len(samples) / rate + 10)
+                task.stop()
+            if done is not None:
+                done()
+        self.call(play, (channel,), wait=False)
+
+    def claim(self, channels, release):
+        """
+        Registers the release function of a task armed on the channels by another thread.
+        """
+        with self.condition:
+            for channel in channels:
+                self.owners[channel] = release
+
+    def unclaim(self, channels):
+        """
+        Forgets the release function of the channels.
+        """
+        with self.condition:
+            for channel in channels:
+                self.owners.pop(channel, None)
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued command has run.
+
+        Returns:
+            bool: False on timeout.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queue and not self.busy, timeout)
+
+    def stop(self):
+        """
+        Runs the queued commands, closes the on-demand tasks and ends the thread.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue or not self.running)
+                if not self.queue:
+                    break
+                entry = self.queue.popleft()
+                if entry[0] == 'write' and self.pending_writes.get(entry[1]) is entry:
+                    del self.pending_writes[entry[1]]  # From now on a new write is queued after this one
+                self.busy = True
+            try:
+                self._execute(entry)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+        self._free(tuple(self.tasks))
+
+    def _execute(self, entry):
+        if entry[0] == 'write':
+            _, channel, value = entry
+            try:
+                self._task(channel).write_value(value)
+                self.metrics['written'] += 1
+            except DaqError as e:  # Handle DAQ errors
+                self._free((channel,))  # Created again on the next write
+                self.metrics['errors'] += 1
+                print(f"DAQ Error: {e}")
+            return
+        _, channels, function, result, done, wait = entry
+        self.metrics['calls'] += 1
+        try:
+            self._free(channels)
+            result['value'] = function()
+        except Exception as e:  # Raised again in the waiting thread
+            self.metrics['errors'] += 1
+            result['error'] = e
+            if not wait:
+                print(f"DAQ Error: {e}")
+        finally:
+            done.set()
+
+    def _task(self, channel):
+        """
+        Returns the on-demand task of a channel, created once the channel is free.
+        """
+        task = self.tasks.get(channel)
+        if task is None:
+            self._take((channel,))
+            task = self.backend.create_task()
+            task.add_ao_channel(channel)
+            task.start()
+            self.tasks[channel] = task
+            self.metrics['tasks_created'] += 1
+        return task
+
+    def _take(self, channels):
+        """
+        Has the tasks armed on the channels by other threads released.
+        """
+        with self.condition:
+            releases = {self.owners[channel] for channel in channels if channel in self.owners}
+        for release in releases:
+            release()
+
+    def _free(self, channels):
+        """
+        Closes the on-demand tasks of the channels.
+        """
+        for channel in channels:
+            task = self.tasks.pop(channel, None)
+            if task is not None:
+                task.close()
+
+
+_actor = None
+_actor_lock = threading.Lock()
+
+
+def get_actor():
+    """
+    Returns the device actor of the current backend, started on first use.
+    """
+    global _actor
+    with _actor_lock:
+        if _actor is None or _actor.backend is not get_backend():
+            if _actor is not None:
+                _actor.stop()
+            _actor = DeviceActor(get_backend())
+        return _actor
+
+
+def release_on_demand(channels):
+    """
+    Closes the on-demand tasks the device actor keeps on the channels, if it is running.
+    """
+    actor = _actor
+    if actor is not None:
+        actor.call(lambda: None, channels)
+
+
+class FramePipeline:
+    """
+    Producer thread preparing the next frames in a bounded queue while the current ones play.
+
+    Attributes:
+        depth (int): Maximum number of frames prepared ahead.
+        metrics (dict): Queue depth seen by the consumer and time each side spent waiting.
+    """
+    done = object()  # Sentinel put after the last frame
+
+    def __init__(self, frames, depth=8):
+        self.depth = depth
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopping = threading.Event()
+        self.metrics = {'frames': 0, 'max_depth': 0, 'mean_depth': 0.0, 'consumer_wait_s': 0.0, 'producer_wait_s': 0.0}
+        self.thread = threading.Thread(target=self._produce, args=(frames,), daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _put(self, item):
+        start = time.perf_counter()
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.metrics['producer_wait_s'] += time.perf_counter() - start
+
+    def _produce(self, frames):
+        try:
+            for item in frames:
+                if self.stopping.is_set():
+                    return
+                self._put(item)
+        except Exception as e:  # Raised again on the consumer side
+            self._put(e)
+        self._put(self.done)
+
+    def get(self, cancel_event=None):
+        """
+        Returns the next prepared item, waiting for the producer if the queue is empty.
+
+        Args:
+            cancel_event (threading.Event or None): Checked on every poll_interval of the wait.
+
+        Raises:
+            Cancelled: If cancel_event is set while waiting.
+        """
+        depth = self.queue.qsize()
+        start = time.perf_counter()
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                self.metrics['consumer_wait_s'] += time.perf_counter() - start
+                raise Cancelled()
+            try:
+                item = self.queue.get(timeout=poll_interval)
+                break
+            except queue.Empty:
+                continue
+        self.metrics['consumer_wait_s'] += time.perf_counter() - start
+        if isinstance(item, Exception):
+            raise item
+        if item is self.done:
+            raise IndexError("The pipeline has no more frames.")
+        self.metrics['frames'] += 1
+        self.metrics['max_depth'] = max(self.metrics['max_depth'], depth)
+        self.metrics['mean_depth'] += (depth - self.metrics['mean_depth']) / self.metrics['frames']
+        return item
+
+    def close(self):
+        """
+        Stops the producer thread.
+        """
+        self.stopping.set()
+        self.thread.join()
+
+
+class RetriggerablePlayer:
+    """
+    Plays a whole MDA plan with a single retriggerable AO task.
+
+    Both channels and the PFI1 trigger are configured once. Every run of frames with the
+    same length is streamed through the buffer with regeneration disabled, so each camera
+    trigger simply outputs the next frame. At most buffer_frames frames are on the device
+    at once, and the plan may be lazy, so the memory does not grow with the MDA length.
+
+    Runs of at least min_repeat identical frames (the slices of acquisition order 1) are
+    coalesced: the frame is uploaded once with regeneration allowed and replays on the
+    next N triggers, the task being stopped as soon as the N-th frame is generated. The
+    stop has to land between the end of that frame and the next trigger, so frames
+    leaving less than stop_margin before it are streamed one by one instead. A stop that
+    still comes too late raises FrameOverrun.
+
+    In ping-pong mode a second task is configured and verified for the next block while
+    the current block plays, so a block change only costs a stop, a write and a start.
+    The spare task is not committed ahead: a committed task reserves the AO channels.
+
+    Attributes:
+        plan (MDAPlan, FlyweightMDAPlan or StreamingMDAPlan): Schedule to play.
+        rate (float or None): Sample clock rate in Hz, None to play every run at the rate of its frames.
+        frame_done (callable or None): Called with the frame index when a frame is played.
+        backend (NidaqBackend or SimulatedBackend): Device the plan is played on.
+        buffer_frames (int): Maximum number of frames written ahead of the trigger.
+        min_repeat (int or None): Shortest run of identical frames to coalesce, None to never coalesce.
+        stop_margin (float): Shortest time in seconds between the end of a frame and the next trigger for it to be coalesced.
+        raw (bool): True to convert the plan once to int16 DAC codes and write them unscaled.
+        pipeline_depth (int or None): Frames prepared ahead by a producer thread, None to prepare them inline.
+        ping_pong (bool): True to configure and verify the next block on a second task while the current one plays.
+        timeline (FrameTimeline): Per-frame timestamps of the last play.
+        cancel_event (threading.Event): Set by cancel(), checked on every poll of the device.
+        stats (dict): Frames, task cycles, writes and driver calls of the last play.
+    """
+    legacy_calls_per_frame = 10  # Create, 2 channels, timing, trigger, write, start, wait, stop, close
+
+    def __init__(self, plan, rate=None, frame_done=None, backend=None, buffer_frames=64, min_repeat=2, raw=False,
+                 pipeline_depth=None, ping_pong=False, timeline=None, stop_margin=stop_margin):
+        self.plan = plan
+        self.timeline = galvo_timing.FrameTimeline() if timeline is None else timeline
+        self.ping_pong = ping_pong
+        self.raw = raw
+        self.pipeline_depth = pipeline_depth
+        self.pipeline = None
+        self.samples = plan  # Plan whose blocks are written, volts or DAC codes
+        self.rate = rate
+        self.frame_done = frame_done
+        self.backend = get_backend() if backend is None else backend
+        self.buffer_frames = buffer_frames
+        self.min_repeat = min_repeat
+        self.stop_margin = stop_margin
+        self.cancel_event = threading.Event()
+        self.cancel_time = None
+        self.stats = {}
+
+    def cancel(self):
+        """
+        Asks the player to abort, from any thread.
+
+        The running task is aborted on the next poll of the device, or of the frame
+        pipeline, and both galvos are parked at park_voltage by a task verified before the
+        play. play() then returns with stats['cancelled'] set.
+        """
+        self.cancel_time = time.perf_counter()
+        self.cancel_event.set()
+
+    def _check_cancelled(self, task):
+        """
+        Aborts the task and raises Cancelled if cancel() was called.
+        """
+        if self.cancel_event.is_set():
+            task.abort()
+            raise Cancelled()
+
+    def _create_park_task(self):
+        """
+        Creates and verifies the on-demand task parking the galvos, before the play so a cancel only starts it.
+
+        The task is not committed: a committed task reserves the AO channels.
+        """
+        task = CountedTask(self.backend.create_task(), self.stats)
+        self.stats['driver_calls'] += 1  # Task creation
+        task.add_ao_channel(galvo1_channel)
+        task.add_ao_channel(galvo2_channel)
+        task.verify()
+        return task
+
+    def _park(self, task):
+        """
+        Parks both galvos at the safe voltage with the parking task and records the cancellation latency.
+
+        stats['cancel_deadline_missed'] is set if the galvos were parked later than cancel_deadline.
+        """
+        try:
+            task.start()  # Commits the channels released by the abort
+            task.write_value([park_voltage, park_voltage])
+        finally:
+            latency = time.perf_counter() - self.cancel_time
+            self.stats['cancel_latency_ms'] = latency * 1e3
+            self.stats['cancel_deadline_missed'] = latency > cancel_deadline
+            self.timeline.cancel_latency_ms = latency * 1e3
+
+    def play(self, timeout=10000):
+        """
+        Plays every frame of the plan, one frame per camera trigger.
+
+        Args:
+            timeout (float): Maximum time in seconds to wait for the next trigger.
+
+        Returns:
+            dict: Statistics of the run, with the timeline summary under 'timing'.
+        """
+        self.stats = {'frames': 0, 'task_cycles': 0, 'writes': 0, 'samples_written': 0, 'bytes_written': 0, 'prepare_s': 0.0, 'coalesced_frames': 0,
+                      'overruns': 0, 'driver_calls': 0, 'round_trips_saved': 0, 'cancelled': False, 'cancel_latency_ms': None,
+                      'cancel_deadline_missed': False}
+        release_on_demand((galvo1_channel, galvo2_channel))  # The player reserves both channels
+        tasks = [self._create_task() for _ in range(2 if self.ping_pong else 1)]
+        park_task = self._create_park_task()
+        try:
+            if self.raw:
+                self.samples = self.plan.to_dac_codes(tasks[0].dac_coefficients())  # A quarter of the float64 transfer
+            if self.pipeline_depth:
+                self.pipeline = FramePipeline(self._frames_to_write(), self.pipeline_depth)
+                self.pipeline.start()
+
+            blocks = ((first, last, repeat) for start, stop in self.plan.runs() for first, last, repeat in self._blocks(start, stop))
+            block = next(blocks, None)
+            if block is not None:
+                self._configure(tasks[0], *block)
+            while block is not None:
+                task = tasks[0]
+                self._check_cancelled(task)
+                written = self._start(task, *block)
+                following = next(blocks, None)
+                if self.ping_pong and following is not None:
+                    self._configure(tasks[1], *following)  # While this block plays
+                    tasks[1].verify()  # Channels stay free for the current task
+                if block[2]:
+                    self._wait_repeat(task, *block[:2], timeout)
+                else:
+                    self._wait_run(task, *block[:2], written, timeout)
+                if self.ping_pong:
+                    tasks.reverse()
+                elif following is not None:
+                    self._configure(task, *following)
+                block = following
+        except Cancelled:
+            self.stats['cancelled'] = True
+            self._park(park_task)  # Before anything slower, the aborted tasks already released the channels
+        finally:
+            if self.pipeline is not None:
+                self.pipeline.close()
+                self.stats['pipeline'] = self.pipeline.metrics
+                self.pipeline = None
+            for task in tasks:
+                task.close()
+            park_task.close()
+        self.stats['round_trips_saved'] = self.legacy_calls_per_frame * self.stats['frames'] - self.stats['driver_calls']
+        self.stats['timing'] = self.timeline.summary()
+        return self.stats
+
+    def _create_task(self):
+        """
+        Creates a task with both galvo channels and the retriggerable PFI1 trigger.
+        """
+        task = CountedTask(self.backend.create_task(), self.stats)
+        self.stats['driver_calls'] += 1  # Task creation
+        task.add_ao_channel(galvo1_channel)
+        task.add_ao_channel(galvo2_channel)
+        task.cfg_trigger(trigger_source, retriggerable=True)  # Every trigger plays one frame
+        return task
+
+    def _blocks(self, start, stop):
+        """
+        Splits a run into repeat blocks of identical frames and streamed blocks.
+
+        Yields:
+            tuple: (first frame, last frame + 1, True for a repeat block).
+        """
+        block_start = start
+        i = start
+        while i < stop:
+            key = self.plan.frame_key(i)
+            j = i + 1
+            while j < stop and self.plan.frame_key(j) == key:
+                j += 1
+            if self.min_repeat is not None and j - i >= self.min_repeat and self._stop_gap(i) >= self.stop_margin:
+                if block_start < i:
+                    yield block_start, i, False
+                yield i, j, True
+                block_start = j
+            i = j
+        if block_start < stop:
+            yield block_start, stop, False
+
+    def _stop_gap(self, i):
+        """
+        Returns the time in seconds from the end of frame i to the next trigger, from the frame duration of the plan.
+        """
+        rate = self.plan.frame_rate(i) if self.rate is None else self.rate
+        return self.plan.duration_ms(i) / 1e3 - self.plan.frame_length(i) / rate
+
+    def _frames_to_write(self):
+        """
+        Yields (frame index, samples) of every frame written, in the order of the writes.
+
+        Repeat blocks only upload their first frame.
+        """
+        for start, stop in self.plan.runs():
+            for first, last, repeat in self._blocks(start, stop):
+                for i in range(first, first + 1 if repeat else last):
+                    yield i, self.samples.block(i, i + 1)
+
+    def _started(self, first, started, samples, samples_per_frame, count):
+        """
+        Time-stamps the frames whose generation began since the last poll and returns the new count.
+        """
+        now = min(count, -(-samples // samples_per_frame))  # Frames with at least one sample out
+        if now > started:
+            t = self.timeline.now()
+            for i in range(first + started, first + now):
+                self.timeline.frame_started(i, t)
+        return max(started, now)
+
+    def _report(self, first, played, generated):
+        """
+        Reports the frames first + played to first + generated - 1 and returns the new count.
+        """
+        t = self.timeline.now()
+        for i in range(first + played, first + generated):
+            self.timeline.frame_done(i, t)
+            if self.frame_done is not None:
+                self.frame_done(i)
+        self.stats['frames'] += generated - played
+        return generated
+
+    def _write(self, task, start, stop, served=None):
+        """
+        Writes frames start to stop - 1 to the task buffer.
+
+        Args:
+            served (int or None): Last frame + 1 played from this write, stop if None.
+        """
+        served = stop if served is None else served
+        prepare_start = time.perf_counter()
+        if self.pipeline is None:
+            data = self.samples.block(start, stop)
+        else:
+            frames = []
+            for i in range(start, stop):
+                try:
+                    index, frame = self.pipeline.get(self.cancel_event)  # Prepared while the previous frames played
+                except Cancelled:
+                    task.abort()
+                    raise
+                if index != i:
+                    raise RuntimeError(f"Pipeline gave frame {index + 1} instead of {i + 1}.")
+                frames.append(frame)
+            data = frames[0] if len(frames) == 1 else np.hstack(frames)
+        self.stats['prepare_s'] += time.perf_counter() - prepare_start  # Host time spent before the write
+        self.timeline.stage('fetch', start, served)
+        if data.dtype == np.int16:
+            task.write_raw(data)
+        else:
+            task.write(data)
+        self.timeline.stage('write', start, served)
+        self.stats['writes'] += 1
+        self.stats['samples_written'] += data.size
+        self.stats['bytes_written'] += data.nbytes
+
+    def _configure(self, task, start, stop, repeat):
+        """
+        Configures a task for a block: regeneration, frame length and buffer size.
+        """
+        samples_per_frame = self.plan.frame_length(start)
+        task.set_regeneration(repeat)  # Repeat blocks replay their frame on every trigger
+        task.cfg_timing(self.plan.frame_rate(start) if self.rate is None else self.rate, samples_per_frame)
+        task.set_buffer_size(samples_per_frame * (1 if repeat else min(stop - start, self.buffer_frames)))
+        self.timeline.stage('configure', start, stop)
+
+    def _start(self, task, start, stop, repeat):
+        """
+        Writes the first frames of a block and starts the task.
+
+        Returns:
+            int: First frame not written yet.
+        """
+        written = start + (1 if repeat else min(stop - start, self.buffer_frames))
+        self._write(task, start, written, stop if repeat else written)  # A repeat block plays its only frame N times
+        task.start()
+        self.timeline.stage('start', start, stop)
+        self.stats['task_cycles'] += 1
+        return written
+
+    def _wait_repeat(self, task, start, stop, timeout):
+        """
+        Waits for the N identical frames of a repeat block, then stops the task.
+
+        Raises:
+            FrameOverrun: If the next trigger replayed the frame before the task stopped.
+        """
+        samples_per_frame = self.plan.frame_length(start)
+        played = started = 0
+        last_progress = time.perf_counter()
+        while played < stop - start:
+            self._check_cancelled(task)
+            samples = task.samples_generated()
+            started = self._started(start, started, samples, samples_per_frame, stop - start)
+            generated = samples // samples_per_frame
+            if generated >= stop - start:
+                task.stop()  # Before the next trigger replays the frame once more
+                samples = task.samples_generated()  # Counted when the stop took effect
+                overruns = -(-samples // samples_per_frame) - (stop - start)  # Frames started after the last one
+                self.stats['overruns'] += overruns
+                played = self._report(start, played, stop - start)
+                if overruns:
+                    raise FrameOverrun(f"Frame {stop} played {overruns} extra time(s) before the task stopped, the following frames "
+                                       f"would be shifted.")
+                break
+            if generated > played:
+                played = self._report(start, played, generated)
+                last_progress = time.perf_counter()
+            elif time.perf_counter() - last_progress > timeout:
+                raise TimeoutError(f"No trigger received for frame {start + played + 1}.")
+            elif played < stop - start - 1:
+                time.sleep(poll_interval)
+            else:
+                time.sleep(0)  # Last frame: stop as close to its end as possible
+        self.stats['coalesced_frames'] += stop - start
+
+    def _wait_run(self, task, start, stop, written, timeout):
+        """
+        Waits for the frames of a streamed block, refilling the buffer as they are played.
+        """
+        samples_per_frame = self.plan.frame_length(start)
+        ahead = written - start
+        played = started = 0
+        last_progress = time.perf_counter()
+        while played < stop - start:
+            self._check_cancelled(task)
+            samples = task.samples_generated()
+            started = self._started(start, started, samples, samples_per_frame, stop - start)
+            generated = samples // samples_per_frame
+            if generated > played:
+                played = self._report(start, played, generated)
+                last_progress = time.perf_counter()
+                refill = min(stop, start + played + ahead)  # Keep the buffer full
+                if refill > written:
+                    self._write(task, written, refill)
+                    written = refill
+            elif time.perf_counter() - last_progress > timeout:
+                raise TimeoutError(f"No trigger received for frame {start + played + 1}.")
+            elif played < stop - start - 1:
+                time.sleep(poll_interval)
+            else:
+                time.sleep(0)  # Last frame: hand over to the next block as soon as it ends
+        task.stop()
+
+
+class ContinuousPlayer(RetriggerablePlayer):
+    """
+    Plays a plan as one continuous generation triggering the camera, for time-lapses of any length.
+
+    The task is started by software and drives the camera: a third AO channel,
+    trigger_channel, wired to the external trigger input of a camera in external trigger
+    mode, outputs a camera_trigger_voltage pulse at the start of every frame, instead of
+    the camera triggering the DAQ on PFI1. Each frame holds its parking sample up to its whole
+    duration, rounded up to the next sample, so the camera period always fits and the
+    galvos cannot drift from the exposures. A time point lasts at least interval_ms,
+    counted from the start of the run so the rounding does not add up.
+
+    The task keeps a fixed ring buffer of buffer_samples samples. Every chunk_samples
+    samples sent to the device, an event refills the space freed from the plan, so the
+    host memory stays the same however long the run is. With loop=True the plan starts
+    over at its end until cancel() is called.
+
+    Regeneration stays allowed, so a refill that comes too late replays old samples
+    instead of stopping the generation. Such an underflow is counted, with the samples
+    replayed. A refill is late when less than one chunk was left ahead of the generation.
+
+    The sample clock never changes during the generation, so every frame of the plan
+    must use the same rate.
+
+    Cancellation and parking are the same as RetriggerablePlayer. A refill stops taking
+    frames from the plan once cancel() is called, and the abort interrupts a refill being
+    written, so the galvos are parked without waiting for the driver thread.
+
+    Attributes:
+        trigger_channel (str): AO channel wired to the camera external trigger input.
+        buffer_samples (int): Size of the ring buffer, in samples per channel.
+        chunk_samples (int): Samples per channel written by every refill.
+        loop (bool): True to play the plan again and again until cancelled.
+        interval_ms (float): Shortest time between the starts of two time points, intervalMs of the sequence.
+        time_point_frames (int or None): Frames per time point, None to ignore interval_ms.
+        written (int): Samples per channel written since the start.
+        end_sample (int or None): Sample at which the last frame ends, None while the plan is not exhausted.
+        error (Exception or None): Error raised by a refill in the driver thread.
+    """
+    def __init__(self, plan, rate=None, frame_done=None, backend=None, buffer_samples=None, chunk_samples=None,
+                 loop=False, raw=False, timeline=None, interval_ms=0.0, time_point_frames=None, trigger_channel=camera_trigger_channel):
+        if not trigger_channel:
+            raise ValueError("A continuous generation triggers the camera: give the AO channel wired to its external trigger input.")
+        rate = plan.rate if rate is None else rate
+        if rate is None:
+            raise ValueError("A continuous generation has one sample clock: build the plan with a single rate.")
+        super().__init__(plan, rate=rate, frame_done=frame_done, backend=backend, raw=raw, timeline=timeline)
+        self.chunk_samples = int(chunk_samples or self.rate * 0.1)  # 100 ms refills by default
+        self.buffer_samples = int(buffer_samples or 8 * self.chunk_samples)
+        if self.buffer_samples < 2 * self.chunk_samples:
+            raise ValueError(f"The buffer ({self.buffer_samples} samples) must hold at least two chunks of {self.chunk_samples} samples.")
+        self.loop = loop
+        self.interval_ms = interval_ms
+        self.time_point_frames = time_point_frames
+        self.trigger_channel = trigger_channel
+        self.task = None
+        self.error = None
+
+    def play(self, timeout=10000):
+        """
+        Plays the plan until its last frame, or until cancel() with loop=True.
+
+        Args:
+            timeout (float): Maximum time in seconds to wait for the generation to start.
+
+        Returns:
+            dict: Statistics of the run, with underflows and late refills, and the timeline summary under 'timing'.
+        """
+        self.stats = {'frames': 0, 'refills': 0, 'writes': 0, 'samples_written': 0, 'bytes_written': 0, 'driver_calls': 0,
+                      'underflows': 0, 'underflow_samples': 0, 'late_refills': 0, 'min_lead_ms': math.inf,
+                      'buffer_samples': self.buffer_samples, 'chunk_samples': self.chunk_samples, 'cancelled': False, 'cancel_latency_ms': None,
+                      'cancel_deadline_missed': False}
+        self.written = 0
+        self.end_sample = None
+        self.error = None
+        self.queued = 0  # Samples per channel taken from the plan
+        self.pending = collections.deque()  # Samples taken from the plan and not written yet
+        self.boundaries = collections.deque()  # (frame, first sample, last sample + 1) of the frames not reported yet
+        if len(self.plan) == 0:
+            self.stats['timing'] = self.timeline.summary()
+            return self.stats
+        release_on_demand((galvo1_channel, galvo2_channel))
+        task = self.task = self._create_task()
+        park_task = self._create_park_task()
+        try:
+            self.trigger_levels = np.array([0.0, camera_trigger_voltage])
+            if self.raw:
+                coefficients = task.dac_coefficients()
+                self.samples = self.plan.to_dac_codes(coefficients[:2])
+                self.trigger_levels = galvo_engine.dac_codes(self.trigger_levels, coefficients[2:])[0]
+            self.frames = self._frames()
+            task.cfg_continuous(self.rate, self.buffer_samples)
+            task.set_regeneration(True)
+            task.register_every_n_samples(self.chunk_samples, self._refill)
+            data = self._take(self.buffer_samples)
+            self._check_cancelled(task)
+            self._write(task, data)
+            task.start()  # No start trigger: the generation triggers the camera
+            self._wait(task, timeout)
+            task.stop()
+        except Cancelled:
+            self.stats['cancelled'] = True
+            self._park(park_task)
+        finally:
+            task.close()
+            park_task.close()
+            self.task = None
+        if self.error is not None:
+            raise self.error
+        self.stats['timing'] = self.timeline.summary()
+        return self.stats
+
+    def _create_task(self):
+        """
+        Creates a task with both galvo channels and the camera trigger channel, started by software.
+        """
+        task = CountedTask(self.backend.create_task(), self.stats)
+        self.stats['driver_calls'] += 1  # Task creation
+        task.add_ao_channel(galvo1_channel)
+        task.add_ao_channel(galvo2_channel)
+        try:
+            task.add_ao_channel(self.trigger_channel)
+        except DaqError as e:  # Before anything is played: the camera would never be triggered
+            task.close()
+            raise DaqError(f"Camera trigger channel {self.trigger_channel} is not available ({e}), it must be an AO channel "
+                           f"wired to the external trigger input of the camera.", e.error_code) from e
+        return task
+
+    def _frames(self):
+        """
+        Yields (frame number, samples) of the frames to play in order, with the camera trigger channel.
+
+        Frames are built one at a time so a refill can stop between two of them. Frame
+        numbers keep growing when the plan starts over.
+        """
+        start = 0  # First sample of the frame since the start of the run
+        cycle = 0
+        while True:
+            for i in range(len(self.plan)):
+                n = cycle * len(self.plan) + i
+                frame = self.samples.block(i, i + 1)
+                stop = start + max(frame.shape[1], math.ceil(self.rate * self.plan.duration_ms(i) / 1000 - 1e-9))  # Whole camera period
+                if self.time_point_frames and (n + 1) % self.time_point_frames == 0:  # Last frame of a time point
+                    time_points = (n + 1) // self.time_point_frames
+                    stop = max(stop, math.ceil(self.rate * time_points * self.interval_ms / 1000 - 1e-9))  # Next one starts on time
+                yield n, self._triggered(frame, stop - start)
+                start = stop
+            if not self.loop or len(self.plan) == 0:
+                return
+            cycle += 1
+
+    def _triggered(self, frame, length):
+        """
+        Returns the frame held on its parking sample up to length samples, over the camera trigger pulse.
+        """
+        data = np.empty((3, length), dtype=frame.dtype)
+        data[:2, :frame.shape[1]] = frame
+        data[:2, frame.shape[1]:] = frame[:, -1:]
+        data[2] = self.trigger_levels[0]
+        data[2, :max(1, round(self.rate * camera_trigger_width))] = self.trigger_levels[1]
+        return data
+
+    def _take(self, count):
+        """
+        Returns the next count samples per channel of the plan, holding the last sample once it is over.
+
+        Returns None as soon as cancel() is called, without building the remaining frames.
+        """
+        pending = sum(piece.shape[1] for piece in self.pending)
+        while pending < count and self.end_sample is None:
+            if self.cancel_event.is_set():
+                return None
+            frame = next(self.frames, None)
+            if frame is None:
+                self.end_sample = self.queued
+                break
+            i, data = frame
+            self.boundaries.append((i, self.queued, self.queued + data.shape[1]))
+            self.queued += data.shape[1]
+            self.pending.append(data)
+            pending += data.shape[1]
+        pieces = []
+        taken = 0
+        while self.pending and taken < count:
+            piece = self.pending.popleft()
+            if taken + piece.shape[1] > count:
+                self.pending.appendleft(piece[:, count - taken:])
+                piece = piece[:, :count - taken]
+            pieces.append(piece)
+            taken += piece.shape[1]
+        if taken < count:  # Plan over: hold the parking sample of the last frame
+            hold = pieces[-1][:, -1:] if pieces else self.last_sample
+            pieces.append(np.repeat(hold, count - taken, axis=1))
+        self.last_sample = pieces[-1][:, -1:]
+        return pieces[0] if len(pieces) == 1 else np.hstack(pieces)
+
+    def _write(self, task, data):
+        """
+        Writes samples after the ones already in the buffer.
+        """
+        if data.dtype == np.int16:
+            task.write_raw(data)
+        else:
+            task.write(data)
+        self.written += data.shape[1]
+        self.stats['writes'] += 1
+        self.stats['samples_written'] += data.size
+        self.stats['bytes_written'] += data.nbytes
+
+    def _refill(self):
+        """
+        Every-N-samples event, in the driver thread: checks the lead over the generation and writes the next chunk.
+        """
+        task = self.task
+        if task is None or self.error is not None or self.cancel_event.is_set():  # Cancelled: the task is being aborted
+            return
+        try:
+            lead = self.written - task.samples_generated()
+            if lead < 0:  # The device already replayed old samples
+                self.stats['underflows'] += 1
+                self.stats['underflow_samples'] += -lead
+            elif lead < self.chunk_samples:
+                self.stats['late_refills'] += 1
+            self.stats['min_lead_ms'] = min(self.stats['min_lead_ms'], lead / self.rate * 1e3)
+            data = self._take(self.chunk_samples)
+            if data is None:  # Cancelled while building the chunk
+                return
+            self._write(task, data)
+            self.stats['refills'] += 1
+        except Exception as e:  # Nothing catches it in the driver thread: play() raises it
+            if not self.cancel_event.is_set():  # A write interrupted by the abort of a cancel is expected
+                self.error = e
+
+    def _wait(self, task, timeout):
+        """
+        Reports the frames as the generation moves on, until the last one ends.
+        """
+        start = time.perf_counter()
+        started = None  # Frame being generated
+        while True:
+            self._check_cancelled(task)
+            if self.error is not None:
+                return
+            generated = task.samples_generated()
+            if generated == 0 and time.perf_counter() - start > timeout:
+                raise TimeoutError("The generation did not start.")
+            t = self.timeline.now()
+            while self.boundaries and self.boundaries[0][1] < generated:  # Not iterated: the refills append to it
+                i, first, last = self.boundaries[0]
+                if i != started:
+                    self.timeline.frame_started(i, t)
+                    started = i
+                if last > generated:
+                    break
+                self.boundaries.popleft()
+                self.timeline.frame_done(i, t)
+                self.stats['frames'] += 1
+                if self.frame_done is not None:
+                    self.frame_done(i)
+            if self.end_sample is not None and generated >= self.end_sample:
+                return
+            time.sleep(poll_interval)
+
+
+class RetriggerableOutput:
+    """
+    Keeps one armed retriggerable task replaying the same frame on every camera trigger.
+
+    The task is created once; the buffer is only reloaded when the key describing the
+    frame changes, so a free-running camera never waits for a task setup.
+
+    Attributes:
+        channels (list of str): AO channels of the task.
+        rate (float): Sample clock rate in Hz.
+        key (hashable): Settings of the frame currently loaded.
+        reloads (int): Number of buffer reloads.
+        backend (NidaqBackend or SimulatedBackend): Device the frame is played on.
+    """
+    def __init__(self, channels, rate=galvo_engine.sample_rate, backend=None):
+        self.channels = channels
+        self.rate = rate
+        self.backend = get_backend() if backend is None else backend
+        self.task = None
+        self.key = None
+        self.reloads = 0
+
+    def load(self, key, data, frames=1, rate=None):
+        """
+        Loads a frame in the armed task if its settings changed.
+
+        Args:
+            key (hashable): Settings the frame was built from.
+            data (np.ndarray or callable): 2D array (channels, samples), or a function building it.
+            frames (int): Frames of equal length in the buffer, played in turn one per trigger.
+            rate (float or None): Sample clock rate of the frame in Hz, the rate of the output if None.
+
+        Returns:
+            bool: True if the buffer was reloaded.
+        """
+        if key == self.key and self.task is not None:
+            return False
+        if callable(data):
+            data = data()  # Only build the frame when it is really needed
+
+        if self.task is None:
+            self.task = self.backend.create_task()
+            for channel in self.channels:
+                self.task.add_ao_channel(channel)
+            self.task.cfg_trigger(trigger_source, retriggerable=True)  # Replay the frame on every trigger
+        else:
+            self.task.stop()
+
+        self.key = None  # Invalid until the new frame is armed
+        self.task.cfg_timing(self.rate if rate is None else rate, data.shape[1] // frames)  # The regenerated buffer carries on from frame to frame
+        self.task.write(data)
+        self.task.start()
+        self.key = key
+        self.reloads += 1
+        return True
+
+    def close(self):
+        """
+        Stops and releases the task.
+        """
+        if self.task is not None:
+            self.task.close()
+            self.task = None
+            self.key = None
+
+
+def measure_trigger_intervals(count, max_period=1.0, backend=None, timeout=10.0):
+    """
+    Times count intervals between consecutive camera trigger edges on PFI1 with a counter.
+
+    Args:
+        count (int): Number of intervals.
+        max_period (float): Longest expected interval in seconds.
+        backend (NidaqBackend or SimulatedBackend): Device, the current backend by default.
+        timeout (float): Maximum wait for the edges in seconds.
+
+    Returns:
+        np.ndarray: Intervals in ms.
+    """
+    backend = get_backend() if backend is None else backend
+    with backend.create_task() as task:
+        task.add_ci_period_channel(trigger_counter, trigger_source, min_period=1e-6, max_period=max_period)
+        task.cfg_implicit_timing(count)
+        return task.read_periods(count, timeout) * 1e3
+
+
+def calibrate_dead_time(exposures, edges=50, set_exposure=None, calibration=None, backend=None, timeout=10.0):
+    """
+    Measures the frame dead time of a free-running camera at each exposure.
+
+    For every exposure the camera is set free-running, the intervals between its
+    trigger edges are timed and the minimum overhead is fitted and stored.
+
+    Args:
+        exposures (list of float): Exposures to calibrate in ms.
+        edges (int): Trigger intervals timed per exposure.
+        set_exposure (callable or None): set_exposure(exposure_ms) starts the camera free-run at an exposure.
+            None uses the free-run of the simulated backend, or the camera as it is for a real card.
+        calibration (DeadTimeCalibration or None): Calibration to add the exposures to, a new one if None.
+        backend (NidaqBackend or SimulatedBackend): Device, the current backend by default.
+        timeout (float): Maximum wait for the edges of one exposure in seconds.
+
+    Returns:
+        DeadTimeCalibration: The calibration with the measured exposures.
+    """
+    backend = get_backend() if backend is None else backend
+    if set_exposure is None:
+        set_exposure = getattr(backend, 'free_run', None)
+    calibration = galvo_engine.empty_calibration if calibration is None else calibration
+    for exposure in exposures:
+        if set_exposure is not None:
+            set_exposure(exposure)
+        intervals = measure_trigger_intervals(edges, max_period=timeout, backend=backend, timeout=timeout)
+        calibration = calibration.merge(exposure, galvo_engine.fit_overhead(intervals, exposure))
+    return calibration
+
+
+def write_value(channel, value, backend=None):
+    """
+    Writes one on-demand voltage to a channel with a short-lived task.
+
+    Args:
+        channel (str): AO channel.
+        value (float): Voltage to write.
+        backend (NidaqBackend or SimulatedBackend): Device, the current backend by default.
+    """
+    backend = get_backend() if backend is None else backend
+    with backend.create_task() as task:
+        task.add_ao_channel(channel)
+        task.start()
+        task.write_value(value)
@@ -0,0 +1,73 @@
+# Contrast and histogram of the camera images shown by the GUI, without Qt
+# RAphael TOSCANO
+
+import numpy as np
+
+max_16bit_value = 65535  # Largest intensity of the 16-bit images
+
+
+def adjust_contrast(image, hist_min, hist_max, max_value=max_16bit_value):
+    """
+    Stretches the intensities between hist_min and hist_max over the whole 16-bit range.
+
+    Args:
+        image (np.ndarray): Raw camera image.
+        hist_min (float): Intensity shown black.
+        hist_max (float): Intensity shown white.
+        max_value (int): Largest intensity of the output.
+
+    Returns:
+        np.ndarray: uint16 image of the same shape.
+    """
+    normalized_image = (image - hist_min) / (hist_max - hist_min)
+    return (np.clip(normalized_image, 0, 1) * max_value).astype(np.uint16)
+
+
+def intensity_histogram(image, max_value=max_16bit_value):
+    """
+    Counts the pixels of every intensity, as cv2.calcHist([image], [0], None, [max_value + 1], [0, max_value]).
+
+    Only the first channel of a colour image is counted, and only the intensities in
+    [0, max_value): the upper bound of the range is excluded, so the last bin stays empty.
+
+    Args:
+        image (np.ndarray): Grayscale (rows, columns) or colour (rows, columns, channels) image.
+        max_value (int): Upper bound of the intensities, excluded.
+
+    Returns:
+        np.ndarray: float32 counts of shape (max_value + 1, 1), as the plot expects.
+    """
+    image = np.asarray(image)
+    if image.ndim == 3:
+        image = image[..., 0]  # Channel 0, as calcHist
+    values = image.ravel()
+    values = values[(values >= 0) & (values < max_value)]  # NaN fails both tests
+    if not np.issubdtype(values.dtype, np.integer):  # Bins of width max_value / (max_value + 1), as calcHist
+        values = np.floor(values * ((max_value + 1) / max_value))
+    counts = np.bincount(values.astype(np.intp), minlength=max_value + 1).astype(np.float32)
+    return counts[:, np.newaxis]
+
+
+def image_stats(image):
+    """
+    Returns the (min, max, mean) intensity of an image.
+    """
+    return image.min(), image.max(), image.mean()
+
+
+def histogram_display(image, hist_min, hist_max, max_value=max_16bit_value):
+    """
+    Computes everything ImageAndHistogramWidget.update_display shows for an image.
+
+    Args:
+        image (np.ndarray): Raw camera image.
+        hist_min (float): Intensity shown black.
+        hist_max (float): Intensity shown white.
+        max_value (int): Largest intensity of the images.
+
+    Returns:
+        tuple: Adjusted image, its histogram, the raw histogram, and the adjusted and raw (min, max, mean).
+    """
+    adjusted_image = adjust_contrast(image, hist_min, hist_max, max_value)
+    return (adjusted_image, intensity_histogram(adjusted_image, max_value), intensity_histogram(image, max_value),
+            image_stats(adjusted_image), image_stats(image))
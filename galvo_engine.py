@@ -0,0 +1,1393 @@
+# Waveform engine shared by the projection and OPM interfaces
+# RAphael TOSCANO
+
+import functools
+import json
+import math
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+# Galvo DATASHEET
+voltage_limit = 10     # Max voltage output (±10 V)
+sample_rate = 10000    # Hz, same as nidaq
+max_ao_rate = 100000   # Hz, fastest AO update of the simulated card, a real card reports its own (ao_max_rate)
+# Sample clocks dividing the 100 MHz timebase exactly, so the card never coerces the rate. From 2 kHz on, so the
+# parking sample and the rounding of a frame to whole samples cost at most 0.5 ms each of the trigger period
+sample_rates = (2000, 2500, 4000, 5000, 8000, 10000, 12500, 20000, 25000, 40000, 50000, 62500, 100000)
+target_frame_samples = 1000  # Fewest samples of a frame with the adaptive rate, the smoothness of its ramp
+scan_modes = ('unidirectional', 'bidirectional')  # Flyback to the start after every frame, or alternate sweep directions
+flyback_modes = ('step', 'shaped')  # One sample jump back to the start, or smooth minimum-time return
+trigger_guard_ms = 0.1  # Time between the end of a frame and the next trigger edge, for the retriggerable task to re-arm
+slew_limit = 2.0  # V/ms, fastest galvo motion
+acceleration_limit = 1.0  # V/ms², largest galvo acceleration
+
+
+class CameraTiming(namedtuple('CameraTiming', ['line_time_ms', 'roi_lines', 'trigger_delay_ms', 'settle_ms'])):
+    """
+    Dead time of a frame for a camera configuration: rolling readout of the ROI, trigger delay and galvo settle.
+
+    The camera triggers every exposure plus dead time; frame_samples ends the frame, with
+    its parking sample, trigger_guard_ms before that period. Hashable, so it can key the waveform cache. Other timing sources (DeadTimeCalibration)
+    only need the same dead_time_ms method.
+
+    Attributes:
+        line_time_ms (float): Readout time of one sensor line in ms.
+        roi_lines (int): Height of the ROI in lines.
+        trigger_delay_ms (float): Delay from the trigger to the start of the exposure in ms.
+        settle_ms (float): Time left for the galvo to settle after its return in ms.
+    """
+    __slots__ = ()
+
+    def dead_time_ms(self, exposure_ms=None):
+        """
+        Returns the time added to every exposure, the same for all exposures.
+        """
+        return camera_dead_time_ms(self)
+
+
+@functools.lru_cache(maxsize=64)
+def camera_dead_time_ms(camera):
+    """
+    Computes the dead time of a camera configuration once.
+    """
+    return camera.line_time_ms * camera.roi_lines + camera.trigger_delay_ms + camera.settle_ms
+
+
+# Camera DATASHEET, full 2048 line sensor: 20.48 ms readout + 2.457 ms settle, the former 22.937 ms constant
+default_camera = CameraTiming(line_time_ms=0.01, roi_lines=2048, trigger_delay_ms=0.0, settle_ms=2.457)
+readout_time_ms = default_camera.dead_time_ms()  # Dead time of the default camera, in ms
+
+
+def camera_timing(roi_lines=None, **changes):
+    """
+    Returns the default camera model with another ROI height or other fields.
+
+    Args:
+        roi_lines (int or None): Height of the ROI in lines, the full sensor if None.
+        changes: Other CameraTiming fields to replace.
+
+    Returns:
+        CameraTiming: The camera configuration.
+    """
+    if roi_lines is not None:
+        changes['roi_lines'] = int(roi_lines)
+    return default_camera._replace(**changes)
+
+
+class DeadTimeCalibration(namedtuple('DeadTimeCalibration', ['exposures', 'overheads', 'guard_ms'])):
+    """
+    Frame dead time measured on the camera, to use in place of a CameraTiming model.
+
+    Stores the minimum inter-frame overhead (trigger interval minus exposure) measured at
+    each exposure. Between two calibrated exposures the overhead is interpolated, outside
+    them the nearest one is used. frame_samples already ends every frame before the next
+    trigger edge, guard_ms is an extra margin for a camera slower than when calibrated.
+
+    Attributes:
+        exposures (tuple of float): Calibrated exposures in ms, increasing.
+        overheads (tuple of float): Minimum overhead measured at each exposure in ms.
+        guard_ms (float): Margin taken off the measured overheads in ms.
+    """
+    __slots__ = ()
+
+    def dead_time_ms(self, exposure_ms=None):
+        """
+        Returns the time added to an exposure, from the overhead calibrated at that exposure.
+        """
+        if exposure_ms is None:
+            raise ValueError("A calibrated dead time depends on the exposure.")
+        return calibrated_dead_time_ms(self, float(exposure_ms))
+
+    def merge(self, exposure_ms, overhead_ms):
+        """
+        Returns the calibration with the overhead of one exposure added or replaced.
+        """
+        overheads = dict(zip(self.exposures, self.overheads))
+        overheads[float(exposure_ms)] = float(overhead_ms)
+        exposures = tuple(sorted(overheads))
+        return self._replace(exposures=exposures, overheads=tuple(overheads[e] for e in exposures))
+
+    def save(self, path):
+        """
+        Saves the calibration to a JSON file.
+
+        Args:
+            path (str): Destination file.
+        """
+        with open(path, 'w') as f:
+            json.dump({'exposures_ms': self.exposures, 'overheads_ms': self.overheads, 'guard_ms': self.guard_ms}, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a calibration saved with save().
+
+        Args:
+            path (str): JSON file.
+
+        Returns:
+            DeadTimeCalibration: The calibration.
+        """
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return cls(tuple(data['exposures_ms']), tuple(data['overheads_ms']), data['guard_ms'])
+
+
+empty_calibration = DeadTimeCalibration(exposures=(), overheads=(), guard_ms=0.0)
+
+
+@functools.lru_cache(maxsize=1024)
+def calibrated_dead_time_ms(calibration, exposure_ms):
+    """
+    Interpolates the calibrated overhead at an exposure once.
+    """
+    if not calibration.exposures:
+        raise ValueError("The dead time calibration has no exposure.")
+    overhead = float(np.interp(exposure_ms, calibration.exposures, calibration.overheads))
+    return max(0.0, overhead - calibration.guard_ms)
+
+
+def fit_overhead(intervals_ms, exposure_ms):
+    """
+    Fits the minimum inter-frame overhead from the intervals between trigger edges of a free-running camera.
+
+    The camera can not cycle faster than its exposure plus its overhead, so the shortest
+    interval gives the overhead. Intervals shorter than the exposure are glitches and
+    intervals longer than 1.5 median were missed edges, both are left out.
+
+    Args:
+        intervals_ms (np.ndarray): Time between consecutive trigger edges in ms.
+        exposure_ms (float): Exposure of the camera during the free-run in ms.
+
+    Returns:
+        float: Minimum overhead in ms.
+    """
+    intervals_ms = np.asarray(intervals_ms, dtype=np.float64)
+    valid = intervals_ms[intervals_ms > exposure_ms]
+    if valid.size == 0:
+        raise ValueError(f"No trigger interval longer than the {exposure_ms} ms exposure.")
+    valid = valid[valid <= 1.5 * np.median(valid)]
+    return float(valid.min() - exposure_ms)
+
+
+def pick_sample_rate(exposure_times, timing=None, target_samples=target_frame_samples, max_rate=max_ao_rate):
+    """
+    Picks one sample rate for frames of the given exposures.
+
+    The slowest rate of sample_rates giving the shortest frame at least target_samples
+    samples is used, up to max_rate: long exposures get small buffers and short
+    exposures fine ramps. Given every exposure of a plan it picks a single rate for the
+    plan, the longest frames then carrying more samples than the target.
+
+    Args:
+        exposure_times (list of float): Exposures in milliseconds.
+        timing (CameraTiming, DeadTimeCalibration or None): Source of the dead time, default_camera if None.
+        target_samples (int): Fewest samples per frame wanted.
+        max_rate (float): Fastest sample clock of the device in Hz, from ao_max_rate() of the DAQ backend.
+
+    Returns:
+        int: Sample clock rate in Hz.
+    """
+    rates = [rate for rate in sample_rates if rate <= max_rate]
+    if not rates:
+        raise ValueError(f"No sample rate of {sample_rates} is below the {max_rate} Hz device limit.")
+    shortest_ms = frame_durations_ms(exposure_times, timing).min(initial=np.inf)
+    for rate in rates:
+        if rate * shortest_ms / 1000 >= target_samples:
+            return rate
+    return rates[-1]
+
+
+def channel_rates(rate, exposure_times, timing=None, max_rate=max_ao_rate):
+    """
+    Returns the sample rate of each channel: rate itself, one rate per channel, or with 'adaptive' the rate of pick_sample_rate for its exposure.
+    """
+    if isinstance(rate, str):
+        if rate != 'adaptive':
+            raise ValueError(f"Unknown sample rate {rate!r}, expected a rate in Hz or 'adaptive'.")
+        return np.array([pick_sample_rate([exposure], timing, max_rate=max_rate) for exposure in exposure_times], dtype=np.float64)
+    return np.broadcast_to(np.asarray(rate, dtype=np.float64), (len(exposure_times),)).copy()
+
+
+def uniform_rate(rates):
+    """
+    Returns the rate shared by every frame, None if the frames use several rates.
+    """
+    unique = np.unique(rates)
+    if len(unique) > 1:
+        return None
+    return float(unique[0]) if len(unique) else float(sample_rate)
+
+
+def frame_durations_ms(exposure_times, timing=None, flyback_ms=None):
+    """
+    Returns the frame duration of each exposure: the exposure plus the padding of padding_ms, the trigger period of the camera.
+
+    Args:
+        exposure_times (np.ndarray): Exposures in milliseconds.
+        timing (CameraTiming, DeadTimeCalibration or None): Source of the dead time, default_camera if None.
+        flyback_ms (np.ndarray or None): Shaped return time of each exposure in ms, None for step returns.
+
+    Returns:
+        np.ndarray: Frame durations in milliseconds.
+    """
+    exposure_times = np.asarray(exposure_times, dtype=np.float64)
+    flyback_ms = [None] * len(exposure_times) if flyback_ms is None else flyback_ms
+    return exposure_times + np.array([padding_ms(float(e), timing, f) for e, f in zip(exposure_times, flyback_ms)], dtype=np.float64)
+
+
+def padding_ms(exposure_ms, timing=None, flyback_ms=None):
+    """
+    Returns the time added to an exposure: the dead time of the timing, the galvo return replacing the settle time when shaped.
+
+    A step return needs the settle_ms of a CameraTiming for the galvo to ring down, a
+    shaped return only the time it takes (flyback_ms), which replaces it. A calibrated
+    dead time is the camera's own overhead, only lengthened by a slower return.
+
+    Args:
+        exposure_ms (float): Camera exposure in milliseconds.
+        timing (CameraTiming, DeadTimeCalibration or None): Source of the dead time, default_camera if None.
+        flyback_ms (float or None): Time of the shaped return in ms, None for a step return.
+
+    Returns:
+        float: Padding in milliseconds.
+    """
+    timing = default_camera if timing is None else timing
+    dead_ms = timing.dead_time_ms(exposure_ms)
+    if flyback_ms is None:
+        return dead_ms
+    if isinstance(timing, CameraTiming):
+        return dead_ms - timing.settle_ms + flyback_ms
+    return max(dead_ms, flyback_ms)
+
+
+def increase_range(min_voltage, max_voltage, factor):
+    """
+    Scales the voltage range around its center using the factor.
+
+    Works on scalars as well as on NumPy arrays of factors.
+
+    Args:
+        min_voltage (float): Minimum voltage of the main galvo.
+        max_voltage (float): Maximum voltage of the main galvo.
+        factor (float or np.ndarray): Scale factor(s) applied to the half range.
+
+    Returns:
+        tuple: New minimum and maximum voltages, clipped to ±voltage_limit.
+    """
+    center = (min_voltage + max_voltage) / 2
+    half_range_new = (max_voltage - min_voltage) / 2 * np.asarray(factor, dtype=np.float64)
+    min_new = np.clip(center - half_range_new, -voltage_limit, voltage_limit)
+    max_new = np.clip(center + half_range_new, -voltage_limit, voltage_limit)
+    if min_new.ndim == 0:
+        return float(min_new), float(max_new)
+    return min_new, max_new
+
+
+def channel_factors(factor, amp, FW):
+    """
+    Builds the list of galvo2 scale factors, one per channel.
+
+    Args:
+        factor (float): Starting factor chosen in the GUI.
+        amp (float): Number of amplitudes per filter wheel.
+        FW (int): Number of filter wheel positions.
+
+    Returns:
+        np.ndarray: Factors repeated for every filter wheel.
+    """
+    if factor <= 0:
+        factor_list_unique = np.linspace(factor, -1.0, int(amp))
+    else:
+        factor_list_unique = np.linspace(factor, 1.0, int(amp))
+    return np.tile(factor_list_unique, FW)  # Repeat the factors for each filter wheel (FW)
+
+
+def frame_channel_order(num_frames, num_slices, num_channels, Acq_order):
+    """
+    Gives the channel index of every frame in acquisition order.
+
+    Args:
+        num_frames (int): Number of time points.
+        num_slices (int): Number of slices per time point.
+        num_channels (int): Number of channels.
+        Acq_order (int): 0 for Time/Slice/Channel, 1 for Time/Channel/Slice.
+
+    Returns:
+        np.ndarray: Channel index of each frame.
+    """
+    channels = np.arange(num_channels)
+    if Acq_order == 0:
+        return np.tile(channels, num_frames * num_slices)
+    elif Acq_order == 1:
+        return np.tile(np.repeat(channels, num_slices), num_frames)
+    return np.empty(0, dtype=np.intp)  # Unknown order: nothing to play, as before
+
+
+def ramp_table(lows, highs, num_samples):
+    """
+    Builds one ramp per row, from low to high then back to low on the last sample.
+
+    Each row i holds num_samples[i] ramp samples (identical to np.linspace) followed
+    by the parking sample; rows are padded with their low value up to the longest one.
+
+    Args:
+        lows (np.ndarray): Start voltage of each ramp.
+        highs (np.ndarray): End voltage of each ramp.
+        num_samples (np.ndarray): Number of ramp samples of each row.
+
+    Returns:
+        np.ndarray: 2D array of shape (rows, max(num_samples) + 1).
+    """
+    lows = np.asarray(lows, dtype=np.float64)[:, None]
+    highs = np.asarray(highs, dtype=np.float64)[:, None]
+    num_samples = np.asarray(num_samples)[:, None]
+
+    index = np.arange(num_samples.max(initial=0) + 1)[None, :]
+    step = (highs - lows) / np.maximum(num_samples - 1, 1)
+    table = index * step + lows  # Same arithmetic as np.linspace
+    table = np.where(index == num_samples - 1, highs, table)  # Exact end point, like np.linspace
+    table = np.where(index >= num_samples, lows, table)  # Return to the start voltage
+    return table
+
+
+def cubic_samples(start, end, start_velocity, end_velocity, num_samples, rate=sample_rate):
+    """
+    Samples the cubic going from start to end in num_samples samples with the given end velocities.
+
+    A cubic has a constant jerk, so the motion is smooth and its peaks are known in closed form.
+
+    Args:
+        start (float): Voltage before the first sample.
+        end (float): Voltage of the last sample.
+        start_velocity (float): Velocity at start in V/ms.
+        end_velocity (float): Velocity at end in V/ms.
+        num_samples (int): Number of samples, the last one on end.
+        rate (float): Sample clock rate in Hz.
+
+    Returns:
+        np.ndarray: The num_samples voltages after start.
+    """
+    duration = num_samples * 1e3 / rate  # ms
+    c, d = cubic_coefficients(start, end, start_velocity, end_velocity, duration)
+    t = np.arange(1, num_samples + 1) * 1e3 / rate
+    samples = start + start_velocity * t + c * t ** 2 + d * t ** 3
+    samples[-1] = end  # Exact end point
+    return samples
+
+
+def cubic_coefficients(start, end, start_velocity, end_velocity, duration):
+    """
+    Returns the t² and t³ coefficients of the cubic Hermite segment, t in ms.
+    """
+    c = (3 * (end - start) - (2 * start_velocity + end_velocity) * duration) / duration ** 2
+    d = (2 * (start - end) + (start_velocity + end_velocity) * duration) / duration ** 3
+    return c, d
+
+
+def cubic_peaks(start, end, start_velocity, end_velocity, duration):
+    """
+    Returns the largest absolute velocity (V/ms) and acceleration (V/ms²) of the cubic segment.
+    """
+    c, d = cubic_coefficients(start, end, start_velocity, end_velocity, duration)
+    acceleration = max(abs(2 * c), abs(2 * c + 6 * d * duration))  # Linear: largest at an end
+    velocity = max(abs(start_velocity), abs(end_velocity))
+    if d != 0 and 0 < -c / (3 * d) < duration:  # Vertex of the quadratic velocity
+        velocity = max(velocity, abs(start_velocity - c ** 2 / (3 * d)))
+    return velocity, acceleration
+
+
+def flyback_length(start, end, start_velocity, end_velocity=0.0, rate=sample_rate, slew=slew_limit, acceleration=acceleration_limit):
+    """
+    Returns the fewest samples of a cubic return from start to end within the slew and acceleration limits.
+
+    Args:
+        start (float): Voltage at the end of the ramp.
+        end (float): Voltage the next frame starts from.
+        start_velocity (float): Ramp velocity in V/ms, kept at the start of the return.
+        end_velocity (float): Velocity in V/ms when reaching end.
+        rate (float): Sample clock rate in Hz.
+        slew (float): Largest velocity in V/ms.
+        acceleration (float): Largest acceleration in V/ms².
+
+    Returns:
+        int: Number of samples, the last one on end.
+    """
+    if max(abs(start_velocity), abs(end_velocity)) > slew:
+        raise ValueError(f"A ramp velocity of {max(abs(start_velocity), abs(end_velocity)):.3f} V/ms is above the slew limit of {slew} V/ms.")
+    num_samples = max(1, math.ceil(abs(end - start) / slew * rate / 1e3))  # Never faster than the slew limit
+    while True:
+        velocity, peak = cubic_peaks(start, end, start_velocity, end_velocity, num_samples * 1e3 / rate)
+        if velocity <= slew and peak <= acceleration:
+            return num_samples
+        num_samples += 1
+
+
+def flyback_time_ms(min_voltage, max_voltage, exposure_ms, rate=sample_rate, slew=slew_limit, acceleration=acceleration_limit, timing=None):
+    """
+    Returns the time the galvo needs to come back from max to min after a ramp of the step frame, the padding of a shaped return.
+    """
+    num_samples = frame_samples(exposure_ms, rate, timing)
+    velocity = (max_voltage - min_voltage) / max(num_samples - 1, 1) * rate / 1e3
+    return flyback_length(max_voltage, min_voltage, velocity, 0.0, rate, slew, acceleration) * 1e3 / rate
+
+
+def dac_codes(volts, coefficients):
+    """
+    Converts voltages to signed 16 bit DAC codes with the device calibration.
+
+    Args:
+        volts (np.ndarray): 2D array (channels, samples) in volts.
+        coefficients (list of list of float): Volts to code polynomial of each channel,
+            lowest order first (ao_dev_scaling_coeff on NI cards).
+
+    Returns:
+        np.ndarray: int16 array of the same shape.
+    """
+    volts = np.atleast_2d(volts)
+    codes = np.empty(volts.shape, dtype=np.float64)
+    for channel, channel_coefficients in enumerate(coefficients):
+        codes[channel] = np.polynomial.polynomial.polyval(volts[channel], channel_coefficients)
+    return np.clip(np.rint(codes), -32768, 32767).astype(np.int16)
+
+
+def read_only(array):
+    """
+    Marks an array read-only and returns it.
+    """
+    array.setflags(write=False)
+    return array
+
+
+class MDAPlan:
+    """
+    Compiled galvo1/galvo2 schedule of a whole MDA.
+
+    All frames are stored back to back in two flat arrays; offsets gives the first
+    sample of every frame so each frame is a view, never a copy.
+
+    Attributes:
+        galvo1 (np.ndarray): Concatenated samples for the main galvo.
+        galvo2 (np.ndarray): Concatenated samples for the second galvo.
+        offsets (np.ndarray): Start sample of each frame, plus the total length.
+        durations_ms (np.ndarray): Duration of each frame in milliseconds.
+        channel_ids (np.ndarray): Channel index of each frame.
+        bidirectional (bool): True if odd frames sweep back from max to min.
+        channel_rates (np.ndarray): Sample clock rate in Hz of each channel.
+        rate (float or None): Rate of every frame, None if the channels use several rates.
+    """
+    def __init__(self, galvo1, galvo2, offsets, durations_ms, channel_ids, bidirectional=False, channel_rates=None):
+        self.galvo1 = galvo1
+        self.galvo2 = galvo2
+        self.offsets = offsets
+        self.durations_ms = durations_ms
+        self.channel_ids = channel_ids
+        self.bidirectional = bidirectional
+        num_channels = int(channel_ids.max(initial=-1)) + 1
+        self.channel_rates = np.full(num_channels, sample_rate, dtype=np.float64) if channel_rates is None else channel_rates
+        self.rate = uniform_rate(self.channel_rates[np.unique(channel_ids)])
+
+    def __len__(self):
+        return len(self.durations_ms)
+
+    def frame(self, i):
+        """
+        Returns the samples of one frame.
+
+        Args:
+            i (int): Frame index.
+
+        Returns:
+            tuple: galvo1 and galvo2 views for the frame.
+        """
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.galvo1[start:stop], self.galvo2[start:stop]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.frame(i)
+
+    def samples_per_frame(self):
+        """
+        Returns the number of samples written per channel for each frame.
+        """
+        return np.diff(self.offsets)
+
+    def frame_length(self, i):
+        """
+        Returns the number of samples per channel of one frame.
+        """
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def frame_key(self, i):
+        """
+        Returns a key equal for two frames with the same samples.
+        """
+        if self.bidirectional:
+            return int(self.channel_ids[i]), i % 2  # Same channel, opposite sweeps
+        return int(self.channel_ids[i])
+
+    def duration_ms(self, i):
+        """
+        Returns the duration of one frame in milliseconds.
+        """
+        return float(self.durations_ms[i])
+
+    def frame_rate(self, i):
+        """
+        Returns the sample clock rate of one frame in Hz.
+        """
+        return float(self.channel_rates[self.channel_ids[i]])
+
+    def block(self, start, stop):
+        """
+        Returns frames start to stop - 1 back to back, ready to be written.
+
+        Returns:
+            np.ndarray: 2D array of shape (2, samples).
+        """
+        first, last = self.offsets[start], self.offsets[stop]
+        return np.vstack((self.galvo1[first:last], self.galvo2[first:last]))
+
+    def runs(self):
+        """
+        Yields the runs of consecutive frames with the same number of samples.
+
+        A finite retriggerable task outputs a fixed number of samples per trigger, so
+        every run can be played without touching the timing configuration. A change of
+        sample rate also ends a run.
+
+        Yields:
+            tuple: (first frame, last frame + 1) of every run.
+        """
+        lengths = self.samples_per_frame()
+        if len(lengths) == 0:
+            return
+        rates = self.channel_rates[self.channel_ids]
+        breaks = np.flatnonzero((np.diff(lengths) != 0) | (np.diff(rates) != 0)) + 1
+        starts = np.concatenate(([0], breaks))
+        stops = np.concatenate((breaks, [len(lengths)]))
+        yield from zip(starts.tolist(), stops.tolist())
+
+    def to_dac_codes(self, coefficients):
+        """
+        Returns the same plan with int16 DAC codes instead of volts, converted once.
+
+        Args:
+            coefficients (list of list of float): Calibration of the galvo1 and galvo2 channels.
+
+        Returns:
+            MDAPlan: Plan writing raw codes.
+        """
+        codes = dac_codes(np.vstack((self.galvo1, self.galvo2)), coefficients)
+        return MDAPlan(codes[0], codes[1], self.offsets, self.durations_ms, self.channel_ids, self.bidirectional, self.channel_rates)
+
+    def nbytes(self):
+        """
+        Returns the memory used by the plan arrays, in bytes.
+        """
+        return (self.galvo1.nbytes + self.galvo2.nbytes + self.offsets.nbytes + self.durations_ms.nbytes + self.channel_ids.nbytes
+                + self.channel_rates.nbytes)
+
+    def transfer_bytes(self, itemsize=2):
+        """
+        Returns the bytes sent to the device to play every frame once, int16 codes by default.
+        """
+        return int(self.offsets[-1]) * 2 * itemsize
+
+
+class FlyweightMDAPlan:
+    """
+    Compact MDA schedule: a small table of unique frames plus integer ids per frame.
+
+    Frames sharing the same samples point to the same read-only waveform, so the plan
+    costs one or two bytes per frame instead of the whole ramps. Slicing returns a new
+    plan sharing the waveform table.
+
+    Attributes:
+        waveforms (list of np.ndarray): Unique read-only (2, samples) frames.
+        durations (np.ndarray): Unique frame durations in milliseconds.
+        waveform_ids (np.ndarray): Waveform index of each frame.
+        duration_ids (np.ndarray): Duration index of each frame.
+        waveform_rates (np.ndarray): Sample clock rate in Hz of each waveform.
+        rate (float or None): Rate of every frame, None if the frames use several rates.
+    """
+    def __init__(self, waveforms, durations, waveform_ids, duration_ids, waveform_rates=None):
+        self.waveforms = waveforms
+        self.durations = durations
+        self.waveform_ids = waveform_ids
+        self.duration_ids = duration_ids
+        self.waveform_rates = np.full(len(waveforms), sample_rate, dtype=np.float64) if waveform_rates is None else waveform_rates
+        self.rate = uniform_rate(self.waveform_rates[np.unique(waveform_ids)])
+        self.waveform_lengths = np.array([waveform.shape[1] for waveform in waveforms], dtype=np.int64)
+
+    @classmethod
+    def from_channels(cls, frames, channel_durations_ms, channel_ids, channel_rates=None):
+        """
+        Builds the plan from the frame of each channel and the channel of each frame.
+
+        Args:
+            frames (list of np.ndarray): Frame of each channel, possibly shared.
+            channel_durations_ms (np.ndarray): Frame duration of each channel.
+            channel_ids (np.ndarray): Channel index of each frame.
+            channel_rates (np.ndarray or None): Sample clock rate of each channel in Hz, sample_rate if None.
+        """
+        channel_rates = np.full(len(frames), sample_rate, dtype=np.float64) if channel_rates is None else channel_rates
+        waveforms = []
+        waveform_rates = []
+        waveform_of_channel = []
+        for frame, rate in zip(frames, channel_rates):
+            same = [w for w, waveform in enumerate(waveforms) if waveform is frame]  # Cached frames are shared objects
+            if not same:
+                waveforms.append(frame)
+                waveform_rates.append(rate)
+            waveform_of_channel.append(same[0] if same else len(waveforms) - 1)
+        durations, duration_of_channel = np.unique(np.asarray(channel_durations_ms, dtype=np.float64), return_inverse=True)
+
+        waveform_of_channel = np.asarray(waveform_of_channel, dtype=np.min_scalar_type(max(len(waveforms) - 1, 0)))
+        duration_of_channel = duration_of_channel.astype(np.min_scalar_type(max(len(durations) - 1, 0)))
+        return cls(waveforms, durations, waveform_of_channel[channel_ids], duration_of_channel[channel_ids],
+                   np.array(waveform_rates, dtype=np.float64))
+
+    def __len__(self):
+        return len(self.waveform_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return FlyweightMDAPlan(self.waveforms, self.durations, self.waveform_ids[index], self.duration_ids[index], self.waveform_rates)
+        return self.frame(index)
+
+    def frame(self, i):
+        """
+        Returns the samples of one frame.
+
+        Args:
+            i (int): Frame index.
+
+        Returns:
+            tuple: galvo1 and galvo2 read-only views for the frame.
+        """
+        waveform = self.waveforms[self.waveform_ids[i]]
+        return waveform[0], waveform[1]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.frame(i)
+
+    def samples_per_frame(self):
+        """
+        Returns the number of samples written per channel for each frame.
+        """
+        return self.waveform_lengths[self.waveform_ids]
+
+    def frame_length(self, i):
+        """
+        Returns the number of samples per channel of one frame.
+        """
+        return int(self.waveform_lengths[self.waveform_ids[i]])
+
+    def frame_key(self, i):
+        """
+        Returns a key equal for two frames with the same samples.
+        """
+        return int(self.waveform_ids[i])
+
+    def duration_ms(self, i):
+        """
+        Returns the duration of one frame in milliseconds.
+        """
+        return float(self.durations[self.duration_ids[i]])
+
+    def frame_rate(self, i):
+        """
+        Returns the sample clock rate of one frame in Hz.
+        """
+        return float(self.waveform_rates[self.waveform_ids[i]])
+
+    def block(self, start, stop):
+        """
+        Returns frames start to stop - 1 back to back, ready to be written.
+
+        Returns:
+            np.ndarray: 2D array of shape (2, samples).
+        """
+        return np.hstack([self.waveforms[w] for w in self.waveform_ids[start:stop]])
+
+    def runs(self):
+        """
+        Yields the runs of consecutive frames with the same number of samples and sample rate.
+
+        Yields:
+            tuple: (first frame, last frame + 1) of every run.
+        """
+        lengths = self.samples_per_frame()
+        if len(lengths) == 0:
+            return
+        rates = self.waveform_rates[self.waveform_ids]
+        breaks = np.flatnonzero((np.diff(lengths) != 0) | (np.diff(rates) != 0)) + 1
+        starts = np.concatenate(([0], breaks))
+        stops = np.concatenate((breaks, [len(lengths)]))
+        yield from zip(starts.tolist(), stops.tolist())
+
+    def to_dac_codes(self, coefficients):
+        """
+        Returns the same plan with int16 DAC codes instead of volts, converted once.
+
+        Args:
+            coefficients (list of list of float): Calibration of the galvo1 and galvo2 channels.
+
+        Returns:
+            FlyweightMDAPlan: Plan writing raw codes.
+        """
+        waveforms = [read_only(dac_codes(waveform, coefficients)) for waveform in self.waveforms]
+        return FlyweightMDAPlan(waveforms, self.durations, self.waveform_ids, self.duration_ids, self.waveform_rates)
+
+    def nbytes(self):
+        """
+        Returns the memory used by the plan, waveform table included, in bytes.
+        """
+        table = sum(waveform.nbytes for waveform in self.waveforms) + self.durations.nbytes + self.waveform_rates.nbytes
+        return table + self.waveform_ids.nbytes + self.duration_ids.nbytes
+
+    def transfer_bytes(self, itemsize=2):
+        """
+        Returns the bytes sent to the device to play every frame once, int16 codes by default.
+        """
+        return int(self.samples_per_frame().sum()) * 2 * itemsize
+
+    def save(self, path):
+        """
+        Saves the plan to a .npz file.
+
+        Args:
+            path (str): Destination file.
+        """
+        waveforms = {f'waveform_{w}': waveform for w, waveform in enumerate(self.waveforms)}
+        np.savez_compressed(path, durations=self.durations, waveform_ids=self.waveform_ids,
+                            duration_ids=self.duration_ids, waveform_rates=self.waveform_rates, **waveforms)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a plan saved with save().
+
+        Args:
+            path (str): .npz file.
+
+        Returns:
+            FlyweightMDAPlan: The plan.
+        """
+        with np.load(path) as data:
+            waveforms = []
+            while f'waveform_{len(waveforms)}' in data:
+                waveforms.append(read_only(data[f'waveform_{len(waveforms)}']))
+            rates = data['waveform_rates'] if 'waveform_rates' in data else None  # Plans saved before the adaptive rate
+            return cls(waveforms, data['durations'], data['waveform_ids'], data['duration_ids'], rates)
+
+
+class StreamingMDAPlan:
+    """
+    Lazy galvo1/galvo2 schedule of a whole MDA, with the same interface as MDAPlan.
+
+    Only the frame of each channel and the channel order of one time point are kept;
+    every other frame is produced on demand, so the memory does not depend on the
+    number of time points. In a bidirectional plan odd frames use the backward frame
+    of their channel.
+
+    Attributes:
+        frames (list of np.ndarray): Read-only (2, samples) frame of each channel.
+        channel_durations_ms (np.ndarray): Frame duration of each channel in milliseconds.
+        period_channels (np.ndarray): Channel index of each frame of one time point.
+        num_frames (int): Number of time points.
+        backward_frames (list of np.ndarray or None): Max to min frame of each channel, None for a unidirectional plan.
+        channel_rates (np.ndarray): Sample clock rate in Hz of each channel.
+        rate (float or None): Rate of every frame, None if the channels use several rates.
+    """
+    def __init__(self, frames, channel_durations_ms, period_channels, num_frames, backward_frames=None, channel_rates=None):
+        self.frames = frames
+        self.channel_durations_ms = channel_durations_ms
+        self.period_channels = period_channels
+        self.num_frames = num_frames
+        self.backward_frames = backward_frames
+        self.channel_rates = np.full(len(frames), sample_rate, dtype=np.float64) if channel_rates is None else channel_rates
+        self.rate = uniform_rate(self.channel_rates[np.unique(period_channels)])
+        self.channel_lengths = np.array([frame.shape[1] for frame in frames], dtype=np.int64)
+
+    def __len__(self):
+        return self.num_frames * len(self.period_channels)
+
+    def channel(self, i):
+        """
+        Returns the channel index of frame i.
+        """
+        return int(self.period_channels[i % len(self.period_channels)])
+
+    def _samples(self, i):
+        """
+        Returns the (2, samples) frame played as frame i, given its parity.
+        """
+        if self.backward_frames is not None and i % 2:
+            return self.backward_frames[self.channel(i)]
+        return self.frames[self.channel(i)]
+
+    def frame(self, i):
+        """
+        Returns the samples of one frame.
+
+        Args:
+            i (int): Frame index.
+
+        Returns:
+            tuple: galvo1 and galvo2 read-only views for the frame.
+        """
+        if not 0 <= i < len(self):
+            raise IndexError(f"Frame {i} out of range.")
+        frame = self._samples(i)
+        return frame[0], frame[1]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.frame(i)
+
+    def frame_length(self, i):
+        """
+        Returns the number of samples per channel of one frame.
+        """
+        return int(self.channel_lengths[self.channel(i)])
+
+    def frame_key(self, i):
+        """
+        Returns a key equal for two frames with the same samples.
+        """
+        if self.backward_frames is not None:
+            return self.channel(i), i % 2
+        return self.channel(i)
+
+    def duration_ms(self, i):
+        """
+        Returns the duration of one frame in milliseconds.
+        """
+        return float(self.channel_durations_ms[self.channel(i)])
+
+    def frame_rate(self, i):
+        """
+        Returns the sample clock rate of one frame in Hz.
+        """
+        return float(self.channel_rates[self.channel(i)])
+
+    def block(self, start, stop):
+        """
+        Returns frames start to stop - 1 back to back, ready to be written.
+
+        Returns:
+            np.ndarray: 2D array of shape (2, samples).
+        """
+        return np.hstack([self._samples(i) for i in range(start, stop)])
+
+    def to_dac_codes(self, coefficients):
+        """
+        Returns the same plan with int16 DAC codes instead of volts, converted once.
+
+        Args:
+            coefficients (list of list of float): Calibration of the galvo1 and galvo2 channels.
+
+        Returns:
+            StreamingMDAPlan: Plan writing raw codes.
+        """
+        convert = lambda frames: None if frames is None else [read_only(dac_codes(frame, coefficients)) for frame in frames]
+        return StreamingMDAPlan(convert(self.frames), self.channel_durations_ms, self.period_channels, self.num_frames,
+                                convert(self.backward_frames), self.channel_rates)
+
+    def transfer_bytes(self, itemsize=2):
+        """
+        Returns the bytes sent to the device to play every frame once, int16 codes by default.
+        """
+        return int(self.channel_lengths[self.period_channels].sum()) * self.num_frames * 2 * itemsize
+
+    def runs(self):
+        """
+        Yields the runs of consecutive frames with the same number of samples.
+
+        The runs of one time point are computed once and merged across time points.
+
+        Yields:
+            tuple: (first frame, last frame + 1) of every run.
+        """
+        period = len(self.period_channels)
+        if period == 0:
+            return
+        lengths = self.channel_lengths[self.period_channels]
+        rates = self.channel_rates[self.period_channels]
+        breaks = np.flatnonzero((np.diff(lengths) != 0) | (np.diff(rates) != 0)) + 1
+        period_runs = list(zip(np.concatenate(([0], breaks)).tolist(), np.concatenate((breaks, [period])).tolist()))
+
+        pending = None
+        for t in range(self.num_frames):
+            base = t * period
+            for start, stop in period_runs:
+                if (pending is not None and pending[1] == base + start and self.frame_length(pending[0]) == lengths[start]
+                        and self.frame_rate(pending[0]) == rates[start]):
+                    pending = (pending[0], base + stop)  # Same length across the time point boundary
+                else:
+                    if pending is not None:
+                        yield pending
+                    pending = (base + start, base + stop)
+        if pending is not None:
+            yield pending
+
+
+def channel_frames(min_voltage, max_voltage, factor, Galvo2_Enable, galvo2_Value, exposure_times, FW, amp, direction=None, flyback='step',
+                   timing=None, rate=sample_rate):
+    """
+    Returns the frame of every channel of an MDA from the waveform cache.
+
+    Args:
+        direction (str or None): Sweep of the frames, as in build_frame.
+        flyback (str): Return of the frames, as in build_frame.
+        timing (CameraTiming, DeadTimeCalibration or None): Source of the dead time, default_camera if None.
+        rate (float or np.ndarray): Sample clock rate in Hz, of every channel or of each channel.
+
+    Returns:
+        list of np.ndarray: Read-only (2, samples) frame of each channel.
+    """
+    num_channels = len(exposure_times)
+    rates = np.broadcast_to(rate, (num_channels,))
+    factors, galvo2_mode = channel_modes(factor, Galvo2_Enable, galvo2_Value, num_channels, FW, amp)
+    return [cached_frame(exposure_times[c], min_voltage, max_voltage, factors[c], galvo2_mode, rates[c], direction, flyback, timing)
+            for c in range(num_channels)]
+
+
+def channel_modes(factor, Galvo2_Enable, galvo2_Value, num_channels, FW, amp):
+    """
+    Returns the galvo2 factor of each channel and the galvo2 mode of build_frame for an MDA.
+    """
+    if Galvo2_Enable:
+        return channel_factors(factor, amp, FW)[np.arange(num_channels)], 'range'  # Correct factor of each channel
+    return np.full(num_channels, factor), ('static', galvo2_Value)
+
+
+def channel_durations_ms(min_voltage, max_voltage, factor, Galvo2_Enable, galvo2_Value, exposure_times, FW, amp, flyback='step',
+                         timing=None, rate=sample_rate):
+    """
+    Returns the frame duration of every channel of an MDA, with the time of its shaped return.
+
+    Takes the arguments of channel_frames. A step return keeps frame_durations_ms, a
+    shaped return pads each channel with the return of its own voltage ranges.
+
+    Returns:
+        np.ndarray: Frame duration of each channel in milliseconds.
+    """
+    if flyback != 'shaped':
+        return frame_durations_ms(exposure_times, timing)
+    num_channels = len(exposure_times)
+    rates = np.broadcast_to(rate, (num_channels,))
+    factors, galvo2_mode = channel_modes(factor, Galvo2_Enable, galvo2_Value, num_channels, FW, amp)
+    flyback_ms = [frame_flyback_ms(exposure_times[c], *frame_ranges(min_voltage, max_voltage, factors[c], galvo2_mode), rates[c], timing)
+                  for c in range(num_channels)]
+    return frame_durations_ms(exposure_times, timing, flyback_ms)
+
+
+def check_scan_mode(scan_mode, flyback='step'):
+    """
+    Raises ValueError for an unknown scan mode or flyback.
+    """
+    if scan_mode not in scan_modes:
+        raise ValueError(f"Unknown scan mode {scan_mode!r}, expected one of {scan_modes}.")
+    if flyback not in flyback_modes:
+        raise ValueError(f"Unknown flyback {flyback!r}, expected one of {flyback_modes}.")
+
+
+def stream_mda_plan(min_voltage, max_voltage, factor, Galvo2_Enable, galvo2_Value,
+                    exposure_times, num_frames, num_slices, Acq_order, FW, amp, scan_mode='unidirectional', flyback='step', timing=None,
+                    rate=sample_rate):
+    """
+    Builds a lazy MDA schedule whose memory does not grow with the number of time points.
+
+    Takes the same arguments as compile_mda_plan.
+
+    Returns:
+        StreamingMDAPlan: The lazy schedule.
+    """
+    check_scan_mode(scan_mode, flyback)
+    exposure_times = np.asarray(exposure_times, dtype=np.float64)
+    settings = (min_voltage, max_voltage, factor, Galvo2_Enable, galvo2_Value, exposure_times, FW, amp)
+    period_channels = frame_channel_order(1, num_slices, len(exposure_times), Acq_order)
+    rates = channel_rates(rate, exposure_times, timing)
+    durations_ms = channel_durations_ms(*settings, flyback='step' if scan_mode == 'bidirectional' else flyback, timing=timing, rate=rates)
+    if scan_mode == 'bidirectional':
+        return StreamingMDAPlan(channel_frames(*settings, direction='forward', timing=timing, rate=rates), durations_ms, period_channels,
+                                num_frames, channel_frames(*settings, direction='backward', timing=timing, rate=rates), rates)
+    return StreamingMDAPlan(channel_frames(*settings, flyback=flyback, timing=timing, rate=rates), durations_ms, period_channels, num_frames,
+                            channel_rates=rates)
+
+
+def compact_mda_plan(min_voltage, max_voltage, factor, Galvo2_Enable, galvo2_Value,
+                     exposure_times, num_frames, num_slices, Acq_order, FW, amp, scan_mode='unidirectional', flyback='step', timing=None,
+                     rate=sample_rate):
+    """
+    Builds the MDA schedule as a flyweight plan: unique frames plus compact ids.
+
+    Takes the same arguments as compile_mda_plan. In bidirectional mode the backward
+    frames are extra waveforms, odd frames pointing to them.
+
+    Returns:
+        FlyweightMDAPlan: The compact schedule.
+    """
+    check_scan_mode(scan_mode, flyback)
+    exposure_times = np.asarray(exposure_times, dtype=np.float64)
+    settings = (min_voltage, max_voltage, factor, Galvo2_Enable, galvo2_Value, exposure_times, FW, amp)
+    channel_ids = frame_channel_order(num_frames, num_slices, len(exposure_times), Acq_order)
+    rates = channel_rates(rate, exposure_times, timing)
+    durations_ms = channel_durations_ms(*settings, flyback='step' if scan_mode == 'bidirectional' else flyback, timing=timing, rate=rates)
+    if scan_mode == 'bidirectional':
+        frames = (channel_frames(*settings, direction='forward', timing=timing, rate=rates)
+                  + channel_frames(*settings, direction='backward', timing=timing, rate=rates))
+        parity = np.arange(len(channel_ids)) % 2
+        return FlyweightMDAPlan.from_channels(frames, np.tile(durations_ms, 2), channel_ids + parity * len(exposure_times), np.tile(rates, 2))
+    return FlyweightMDAPlan.from_channels(channel_frames(*settings, flyback=flyback, timing=timing, rate=rates), durations_ms, channel_ids, rates)
+
+
+def compile_mda_plan(min_voltage, max_voltage, factor, Galvo2_Enable, galvo2_Value,
+                     exposure_times, num_frames, num_slices, Acq_order, FW, amp, scan_mode='unidirectional', flyback='step', timing=None,
+                     rate=sample_rate):
+    """
+    Compiles the galvo schedule of an MDA in one batched NumPy computation.
+
+    Only one frame per channel is built (or reused from the waveform cache); one time
+    point is gathered from this table with a single fancy indexing operation and tiled
+    over all time points.
+
+    In bidirectional mode even frames sweep from min to max and odd frames back from
+    max to min, each frame holding its end voltage instead of flying back. A time point
+    with an odd number of frames flips the parity, so two time points are tiled.
+
+    Args:
+        min_voltage (float): Minimum voltage of the main galvo.
+        max_voltage (float): Maximum voltage of the main galvo.
+        factor (float): Starting factor for the second galvo.
+        Galvo2_Enable (bool): True to ramp the second galvo, False to keep it static.
+        galvo2_Value (float): Static voltage of the second galvo.
+        exposure_times (list of float): Exposure of each channel in milliseconds.
+        num_frames (int): Number of time points.
+        num_slices (int): Number of slices per time point.
+        Acq_order (int): 0 for Time/Slice/Channel, 1 for Time/Channel/Slice.
+        FW (int): Number of filter wheel positions.
+        amp (float): Number of amplitudes per filter wheel.
+        scan_mode (str): 'unidirectional' or 'bidirectional'.
+        flyback (str): 'step' or 'shaped' return at the end of unidirectional frames, a shaped return
+            padding the frames with its own time instead of the settle time (padding_ms).
+        timing (CameraTiming, DeadTimeCalibration or None): Source of the frame dead time, default_camera if None.
+        rate (float, list of float or str): Sample clock rate in Hz, of every channel or of each channel, or 'adaptive' for the
+            rate of pick_sample_rate at the exposure of each channel, up to max_ao_rate (channel_rates for the device limit).
+
+    Returns:
+        MDAPlan: The compiled schedule.
+    """
+    check_scan_mode(scan_mode, flyback)
+    bidirectional = scan_mode == 'bidirectional'
+    exposure_times = np.asarray(exposure_times, dtype=np.float64)
+    num_channels = len(exposure_times)
+    settings = (min_voltage, max_voltage, factor, Galvo2_Enable, galvo2_Value, exposure_times, FW, amp)
+    rates = channel_rates(rate, exposure_times, timing)
+    durations_ms = channel_durations_ms(*settings, flyback='step' if bidirectional else flyback, timing=timing, rate=rates)
+    num_samples = (rates * ((durations_ms - trigger_guard_ms) / 1000)).astype(np.int64) - 1  # Same as frame_samples
+
+    if bidirectional:  # Rows num_channels + c hold the backward frames
+        frames = (channel_frames(*settings, direction='forward', timing=timing, rate=rates)
+                  + channel_frames(*settings, direction='backward', timing=timing, rate=rates))
+    else:
+        frames = channel_frames(*settings, flyback=flyback, timing=timing, rate=rates)
+    table = np.empty((len(frames), 2, num_samples.max(initial=0) + 1), dtype=np.float64)
+    for c, frame in enumerate(frames):
+        table[c, :, :frame.shape[1]] = frame
+        table[c, :, frame.shape[1]:] = frame[:, -1:]  # Pad with the parking voltage
+    table1, table2 = table[:, 0], table[:, 1]
+
+    # Gather one time point from the per channel table, every time point is identical
+    channel_ids = frame_channel_order(num_frames, num_slices, num_channels, Acq_order)
+    frame_lengths = num_samples[channel_ids] + 1
+    offsets = np.zeros(len(channel_ids) + 1, dtype=np.int64)
+    np.cumsum(frame_lengths, out=offsets[1:])
+
+    period = len(channel_ids) // num_frames if num_frames > 0 else 0
+    if bidirectional and period % 2:
+        period = min(2 * period, len(channel_ids))  # Two time points, the second with the opposite parity
+    period_length = int(offsets[period])
+    table_rows = channel_ids[:period] + (np.arange(period) % 2) * num_channels if bidirectional else channel_ids[:period]
+    rows = np.repeat(table_rows, frame_lengths[:period])
+    columns = np.arange(period_length) - np.repeat(offsets[:period], frame_lengths[:period])
+    repeats = -(-len(channel_ids) // period) if period else 0
+    galvo1 = np.tile(table1[rows, columns], repeats)[:offsets[-1]]
+    galvo2 = np.tile(table2[rows, columns], repeats)[:offsets[-1]]
+
+    return MDAPlan(galvo1, galvo2, offsets, durations_ms[channel_ids], channel_ids, bidirectional, rates)
+
+
+def parse_mda_sequence(data):
+    """
+    Extracts the MDA settings from a parsed MDA sequence file (Micro-Manager JSON).
+
+    Args:
+        data (dict): Parsed JSON with channels, slices, numFrames, intervalMs and acqOrderMode.
+
+    Returns:
+        dict: exposure_times, num_frames, num_slices, interval_ms, Acq_order, FW, amp and
+        channels_by_filter_wheel (exposures grouped by filter wheel).
+    """
+    # Extract the list of channels from the data
+    channels = data.get('channels', [])
+
+    # Exposure values grouped by filter wheel ID ('fw1', 'fw2', ...)
+    filter_wheel_exposures = {}
+    for channel in channels:
+        config = channel.get('config', '')
+        if config.startswith('fw'):
+            filter_wheel_exposures.setdefault(config.split()[0], []).append(channel.get('exposure', 0.0))
+
+    return dict(
+        exposure_times=[channel.get('exposure', 0.0) for channel in channels],
+        num_frames=data.get('numFrames', 0),
+        num_slices=len(data.get('slices', [])),
+        interval_ms=data.get('intervalMs', 0.0),  # Shortest time between two time points
+        Acq_order=data.get('acqOrderMode', 0),
+        FW=len(filter_wheel_exposures),  # Number of filter wheel configurations
+        amp=sum(len(exposures) for exposures in filter_wheel_exposures.values()) / max(len(filter_wheel_exposures), 1),
+        channels_by_filter_wheel=[filter_wheel_exposures[fw_id] for fw_id in sorted(filter_wheel_exposures)],
+    )
+
+
+def frame_samples(exposure_ms, rate=sample_rate, timing=None, flyback_ms=None):
+    """
+    Gives the number of ramp samples of one frame for an exposure.
+
+    The frame and its parking sample end trigger_guard_ms before the next trigger edge,
+    an exposure plus dead time after the trigger of the frame: a retriggerable task is
+    armed again for that edge whatever the sample rate.
+
+    Args:
+        exposure_ms (float): Camera exposure in milliseconds.
+        rate (float): Sample clock rate in Hz.
+        timing (CameraTiming, DeadTimeCalibration or None): Source of the dead time, default_camera if None.
+        flyback_ms (float or None): Time of a shaped return in ms, as in padding_ms.
+
+    Returns:
+        int: Number of ramp samples, without the parking sample.
+    """
+    duration_ms = exposure_ms + padding_ms(exposure_ms, timing, flyback_ms)  # Trigger period in milliseconds
+    return int(rate * ((duration_ms - trigger_guard_ms) / 1000)) - 1  # Samples ending before the next edge, less the parking sample
+
+
+class WaveformCache:
+    """
+    Bounded LRU cache of read-only frames shared by the MDA and initialization phases.
+
+    The init follower and the MDA worker threads share it, so the lookups and updates are
+    locked. Frames are built outside the lock, a builder may look other frames up.
+
+    Attributes:
+        maxsize (int): Maximum number of frames kept.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups that had to build the frame.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        """
+        Returns the frame of a key, building it on a miss.
+
+        Args:
+            key (hashable): Settings the frame depends on.
+            build (callable): Function returning the frame as a NumPy array.
+
+        Returns:
+            np.ndarray: Read-only frame.
+        """
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is not None:
+                self.hits += 1
+                self.frames.move_to_end(key)
+                return frame
+            self.misses += 1
+        frame = read_only(build())  # Shared between frames and threads
+        with self.lock:
+            frame = self.frames.setdefault(key, frame)  # Keep the first frame if another thread built it meanwhile
+            self.frames.move_to_end(key)
+            if len(self.frames) > self.maxsize:
+                self.frames.popitem(last=False)  # Drop the least recently used frame
+        return frame
+
+    def clear(self):
+        """
+        Empties the cache and resets the counters.
+        """
+        with self.lock:
+            self.frames.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Returns the hit/miss counters and the current size.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.frames), 'maxsize': self.maxsize}
+
+
+waveform_cache = WaveformCache()
+
+
+def shaped_ramps(lows, highs, num_samples, rate=sample_rate):
+    """
+    Builds one ramp per row followed by a smooth return, in num_samples + 1 samples like ramp_table.
+
+    The return of every row is the cubic of flyback_length, all rows sharing the
+    longest one so the galvos stay in step. The ramps are shortened by the return,
+    so the frame keeps its length.
+
+    Args:
+        lows (list of float): Start voltage of each ramp.
+        highs (list of float): End voltage of each ramp.
+        num_samples (int): Ramp samples of the step flyback frame.
+        rate (float): Sample clock rate in Hz.
+
+    Returns:
+        np.ndarray: 2D array of shape (rows, num_samples + 1).
+    """
+    num_return = 1
+    while True:
+        num_ramp = num_samples + 1 - num_return
+        if num_ramp < 2:
+            raise ValueError(f"A frame of {num_samples + 1} samples is too short for the galvo to fly back.")
+        velocities = [(high - low) / (num_ramp - 1) * rate / 1e3 for low, high in zip(lows, highs)]
+        needed = max(flyback_length(high, low, velocity, 0.0, rate) for low, high, velocity in zip(lows, highs, velocities))
+        if needed <= num_return:
+            break
+        num_return = needed  # The ramps get steeper: check again
+    table = np.empty((len(lows), num_samples + 1), dtype=np.float64)
+    table[:, :num_ramp] = ramp_table(lows, highs, [num_ramp] * len(lows))[:, :num_ramp]
+    for row, (low, high, velocity) in enumerate(zip(lows, highs, velocities)):
+        table[row, num_ramp:] = cubic_samples(high, low, velocity, 0.0, num_return, rate)
+    return table
+
+
+def build_frame(exposure_ms, min_voltage, max_voltage, factor, galvo2_mode, rate=sample_rate, direction=None, flyback='step', timing=None):
+    """
+    Builds the galvo1/galvo2 samples of one frame.
+
+    Args:
+        exposure_ms (float): Camera exposure in milliseconds.
+        min_voltage (float): Minimum voltage of the main galvo.
+        max_voltage (float): Maximum voltage of the main galvo.
+        factor (float): Factor applied to the second galvo.
+        galvo2_mode (str or tuple): 'range' to widen the range around its center (MDA),
+            'scaled' to multiply both voltages by the factor (initialization phase),
+            ('static', value) to hold the second galvo.
+        rate (float): Sample clock rate in Hz.
+        direction (str or None): None to fly back to the start voltage at the end of the frame,
+            'forward' or 'backward' to sweep min to max or max to min and hold the end voltage.
+        flyback (str): 'step' to jump back on the last sample, 'shaped' for the smooth
+            minimum-time return of shaped_ramps. Only used when direction is None.
+        timing (CameraTiming, DeadTimeCalibration or None): Source of the dead time, default_camera if None.
+
+    Returns:
+        np.ndarray: 2D array of shape (2, samples), ramp then return to the start voltage.
+    """
+    lows, highs = frame_ranges(min_voltage, max_voltage, factor, galvo2_mode)
+    if flyback == 'shaped' and direction is None:  # Padded with the return instead of the settle time
+        return shaped_ramps(lows, highs, frame_samples(exposure_ms, rate, timing, frame_flyback_ms(exposure_ms, lows, highs, rate, timing)), rate)
+    num_samples = frame_samples(exposure_ms, rate, timing)
+    data = ramp_table(lows, highs, [num_samples, num_samples])
+    if direction == 'backward':
+        data[:, :-1] = data[:, -2::-1].copy()  # Same ramp swept back
+    if direction is not None:
+        data[:, -1] = data[:, -2]  # No flyback: the next frame starts where this one ends
+    return data
+
+
+def frame_ranges(min_voltage, max_voltage, factor, galvo2_mode):
+    """
+    Returns the start (lows) and end (highs) voltages of the galvo1 and galvo2 ramps, galvo2_mode as in build_frame.
+    """
+    if galvo2_mode == 'range':
+        min_voltage_new, max_voltage_new = increase_range(min_voltage, max_voltage, factor)
+    elif galvo2_mode == 'scaled':
+        min_voltage_new, max_voltage_new = min_voltage * factor, max_voltage * factor
+    else:
+        min_voltage_new = max_voltage_new = galvo2_mode[1]  # Static second galvo
+    return [min_voltage, min_voltage_new], [max_voltage, max_voltage_new]
+
+
+def frame_flyback_ms(exposure_ms, lows, highs, rate=sample_rate, timing=None):
+    """
+    Returns the shaped return time of a frame, the longest of its ramps as the galvos return together.
+    """
+    return max(flyback_time_ms(low, high, exposure_ms, rate, timing=timing) for low, high in zip(lows, highs))
+
+
+def cached_frame(exposure_ms, min_voltage, max_voltage, factor, galvo2_mode, rate=sample_rate, direction=None, flyback='step', timing=None):
+    """
+    Returns the frame of build_frame from the shared waveform cache.
+    """
+    timing = default_camera if timing is None else timing
+    key = (float(exposure_ms), float(min_voltage), float(max_voltage), float(factor), galvo2_mode, float(rate), direction, flyback, timing)
+    return waveform_cache.get(key, lambda: build_frame(exposure_ms, min_voltage, max_voltage, factor, galvo2_mode, rate, direction, flyback, timing))
+
+
+def init_phase_waveform(min_voltage, max_voltage, factor, Galvo2_Enable, galvo2_Value, exposure_ms, scan_mode='unidirectional', flyback='step',
+                        timing=None, rate=sample_rate):
+    """
+    Returns the galvo1/galvo2 frame played on every trigger during the initialization phase.
+
+    In bidirectional mode the buffer holds the forward then the backward frame, the
+    retriggered task playing them in turn.
+
+    Args:
+        min_voltage (float): Minimum voltage of the main galvo.
+        max_voltage (float): Maximum voltage of the main galvo.
+        factor (float): Factor applied to the second galvo ramp.
+        Galvo2_Enable (bool): True to ramp the second galvo, False to keep it static.
+        galvo2_Value (float): Static voltage of the second galvo.
+        exposure_ms (float): Camera exposure in milliseconds.
+        scan_mode (str): 'unidirectional' or 'bidirectional'.
+        flyback (str): 'step' or 'shaped' return of a unidirectional scan.
+        timing (CameraTiming, DeadTimeCalibration or None): Source of the dead time, default_camera if None.
+        rate (float): Sample clock rate in Hz, pick_sample_rate([exposure_ms]) for the adaptive rate.
+
+    Returns:
+        np.ndarray: Read-only 2D array of shape (2, samples), two frames back to back in bidirectional mode.
+    """
+    check_scan_mode(scan_mode, flyback)
+    timing = default_camera if timing is None else timing
+    galvo2_mode = 'scaled' if Galvo2_Enable else ('static', galvo2_Value)
+    if scan_mode == 'bidirectional':
+        key = (float(exposure_ms), float(min_voltage), float(max_voltage), float(factor), galvo2_mode, float(rate), scan_mode, timing)
+        return waveform_cache.get(key, lambda: np.hstack([cached_frame(exposure_ms, min_voltage, max_voltage, factor, galvo2_mode, rate, direction,
+                                                                       timing=timing)
+                                                          for direction in ('forward', 'backward')]))
+    return cached_frame(exposure_ms, min_voltage, max_voltage, factor, galvo2_mode, rate, flyback=flyback, timing=timing)
+
+
+def static_waveform(value, exposure_ms, rate=sample_rate, timing=None):
+    """
+    Returns a constant single channel frame, as played by the OPM initialization phase.
+
+    Args:
+        value (float): Voltage held during the frame.
+        exposure_ms (float): Camera exposure in milliseconds.
+        rate (float): Sample clock rate in Hz.
+        timing (CameraTiming, DeadTimeCalibration or None): Source of the dead time, default_camera if None.
+
+    Returns:
+        np.ndarray: Read-only 2D array of shape (1, samples).
+    """
+    timing = default_camera if timing is None else timing
+    key = (float(exposure_ms), 'hold', float(value), float(rate), timing)
+    return waveform_cache.get(key, lambda: np.full((1, frame_samples(exposure_ms, rate, timing) + 1), value, dtype=np.float64))
@@ -0,0 +1,258 @@
+# Headless MDA runner, same engine and player as PROJECTION_GUI without Qt
+# RAphael TOSCANO
+
+import argparse
+import json
+import math
+import sys
+import threading
+import time
+
+import galvo_daq
+import galvo_engine
+import galvo_timing
+
+
+def load_sequence(path):
+    """
+    Reads an MDA sequence file and extracts its settings.
+
+    Args:
+        path (str): Path of the MDA sequence file (JSON).
+
+    Returns:
+        dict: Settings from galvo_engine.parse_mda_sequence.
+    """
+    with open(path, 'r') as f:
+        return galvo_engine.parse_mda_sequence(json.load(f))
+
+
+def plan_settings(sequence, min_voltage, max_voltage, factor=1.0, galvo2_Value=None, scan_mode='unidirectional', flyback='step', timing=None,
+                  rate='adaptive'):
+    """
+    Gathers the keyword arguments of galvo_engine.stream_mda_plan.
+
+    Args:
+        sequence (dict): Settings of the MDA sequence file.
+        min_voltage (float): Minimum voltage of the main galvo.
+        max_voltage (float): Maximum voltage of the main galvo.
+        factor (float): Starting factor for the second galvo.
+        galvo2_Value (float or None): Static voltage of the second galvo, None to ramp it.
+        scan_mode (str): 'unidirectional' or 'bidirectional'.
+        flyback (str): 'step' or 'shaped' return of a unidirectional scan.
+        timing (CameraTiming, DeadTimeCalibration or None): Source of the frame dead time, galvo_engine.default_camera if None.
+        rate (float or str): Sample clock rate in Hz, or 'adaptive' to pick it from the exposures up to the device limit.
+
+    Returns:
+        dict: Plan settings.
+    """
+    if rate == 'adaptive':  # One rate per exposure, up to the fastest clock of the card
+        rate = galvo_engine.channel_rates(rate, sequence['exposure_times'], timing, galvo_daq.max_sample_rate()).tolist()
+    return dict(
+        min_voltage=min_voltage,
+        max_voltage=max_voltage,
+        factor=factor,
+        Galvo2_Enable=galvo2_Value is None,
+        galvo2_Value=galvo2_Value,
+        exposure_times=sequence['exposure_times'],
+        num_frames=sequence['num_frames'],
+        num_slices=sequence['num_slices'],
+        Acq_order=sequence['Acq_order'],
+        FW=sequence['FW'],
+        amp=sequence['amp'],
+        scan_mode=scan_mode,
+        flyback=flyback,
+        timing=galvo_engine.default_camera if timing is None else timing,
+        rate=rate,
+    )
+
+
+def run_mda(plan, backend=None, timeout=10000, timeline=None, verbose=False, continuous=False, loop=False, interval_ms=0.0,
+            time_point_frames=None, trigger_channel=galvo_daq.camera_trigger_channel):
+    """
+    Plays a plan like run_MDA does, Ctrl+C cancelling the run and parking the galvos.
+
+    Args:
+        plan (StreamingMDAPlan): Schedule to play.
+        backend (NidaqBackend or SimulatedBackend): Device, the current backend by default.
+        timeout (float): Maximum time in seconds to wait for a trigger.
+        timeline (FrameTimeline or None): Per-frame timestamps, a new one if None.
+        verbose (bool): True to print every frame played.
+        continuous (bool): True to play the frames with a ContinuousPlayer, the DAQ triggering the camera.
+        loop (bool): True to start the plan over until Ctrl+C, continuous mode only.
+        interval_ms (float): Shortest time between two time points, continuous mode only.
+        time_point_frames (int or None): Frames per time point, continuous mode only.
+        trigger_channel (str): AO channel wired to the camera external trigger input, continuous mode only.
+
+    Returns:
+        tuple: Player statistics (None if the run failed) and the error raised (None if none).
+    """
+    frame_done = (lambda i: print(f"Frame {i + 1} completed.")) if verbose else None
+    if continuous:
+        player = galvo_daq.ContinuousPlayer(plan, frame_done=frame_done, backend=backend, loop=loop, raw=True, timeline=timeline,
+                                            interval_ms=interval_ms, time_point_frames=time_point_frames, trigger_channel=trigger_channel)
+    else:
+        player = galvo_daq.RetriggerablePlayer(plan, frame_done=frame_done, backend=backend,
+                                               raw=True, pipeline_depth=8, ping_pong=True, timeline=timeline)
+    outcome = {}
+    finished = threading.Event()
+
+    def play():
+        try:
+            outcome['stats'] = player.play(timeout=timeout)
+        except (galvo_daq.DaqError, TimeoutError, galvo_daq.FrameOverrun) as e:
+            player.timeline.error(e)
+            outcome['error'] = e
+        finally:
+            finished.set()
+
+    thread = threading.Thread(target=play, name='MDA player')
+    thread.start()
+    while not finished.is_set():
+        try:
+            finished.wait(0.1)  # Not thread.join: a Ctrl+C inside it can leave the thread reported as dead
+        except KeyboardInterrupt:
+            print("Cancelling the MDA...")
+            player.cancel()
+    thread.join()
+    return outcome.get('stats'), outcome.get('error')
+
+
+def json_ready(value):
+    """
+    Replaces the NaN and infinite floats of nested statistics by None, for a strict JSON file.
+    """
+    if isinstance(value, dict):
+        return {key: json_ready(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_ready(item) for item in value]
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def sample_rate_arg(text):
+    """
+    Parses --sample-rate: 'adaptive' or a rate in Hz.
+    """
+    return text if text == 'adaptive' else float(text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run an MDA galvo sequence without the GUI.')
+    parser.add_argument('sequence', help='MDA sequence file (JSON)')
+    parser.add_argument('--min-voltage', type=float, required=True, help='Minimum voltage of the main galvo (V)')
+    parser.add_argument('--max-voltage', type=float, required=True, help='Maximum voltage of the main galvo (V)')
+    parser.add_argument('--factor', type=float, default=1.0, help='Starting factor for the second galvo')
+    parser.add_argument('--galvo2-value', type=float, default=None, help='Static voltage of the second galvo, ramped if not given (V)')
+    parser.add_argument('--scan-mode', choices=galvo_engine.scan_modes, default='unidirectional', help='Fly back after every frame, or alternate sweeps')
+    parser.add_argument('--flyback', choices=galvo_engine.flyback_modes, default='step', help='Return of the unidirectional scan')
+    parser.add_argument('--roi-lines', type=int, default=galvo_engine.default_camera.roi_lines, help='Height of the camera ROI (lines)')
+    parser.add_argument('--line-time-us', type=float, default=galvo_engine.default_camera.line_time_ms * 1e3, help='Readout time of one line (us)')
+    parser.add_argument('--trigger-delay-ms', type=float, default=galvo_engine.default_camera.trigger_delay_ms, help='Camera trigger delay (ms)')
+    parser.add_argument('--settle-ms', type=float, default=galvo_engine.default_camera.settle_ms, help='Galvo settle time after the return (ms)')
+    parser.add_argument('--sample-rate', type=sample_rate_arg, default='adaptive',
+                        help="Sample clock (Hz), or 'adaptive' to pick it from the exposures and the device limit")
+    parser.add_argument('--calibrate', type=int, default=0, metavar='EDGES',
+                        help='Time EDGES trigger intervals of the free-running camera at each exposure and use the measured dead time')
+    parser.add_argument('--calibration', default=None, help='Dead time calibration file (JSON), read, or written with --calibrate')
+    parser.add_argument('--backend', choices=['nidaqmx', 'simulated'], default=None, help='Device, GALVO_BACKEND by default')
+    parser.add_argument('--trigger-rate', type=float, default=50.0, help='Camera trigger rate of the simulated backend (Hz)')
+    parser.add_argument('--timeout', type=float, default=10000, help='Maximum wait for a trigger (s)')
+    parser.add_argument('--timing-csv', default=None, help='Per-frame timestamps output (CSV)')
+    parser.add_argument('--metrics-json', default=None, help='Run statistics output (JSON)')
+    parser.add_argument('--verbose', action='store_true', help='Print every frame played')
+    parser.add_argument('--continuous', action='store_true',
+                        help='One continuous generation triggering the camera, for long time-lapses. Reverses the triggering: '
+                             'the --camera-trigger AO channel must be wired to the external trigger input of the camera, '
+                             'set in external trigger mode, instead of the camera output to PFI1')
+    parser.add_argument('--camera-trigger', default=None, metavar='CHANNEL',
+                        help=f'With --continuous, AO channel wired to the camera external trigger input (e.g. {galvo_daq.camera_trigger_channel})')
+    parser.add_argument('--loop', action='store_true', help='With --continuous, play the sequence again and again until Ctrl+C')
+    args = parser.parse_args(argv)
+    if args.loop and not args.continuous:
+        parser.error('--loop needs --continuous')
+    if args.continuous and not args.camera_trigger:
+        parser.error('--continuous needs --camera-trigger, the AO channel wired to the external trigger input of the camera')
+    if args.camera_trigger and not args.continuous:
+        parser.error('--camera-trigger needs --continuous')
+
+    camera = galvo_engine.camera_timing(args.roi_lines, line_time_ms=args.line_time_us / 1e3,
+                                        trigger_delay_ms=args.trigger_delay_ms, settle_ms=args.settle_ms)
+    if args.backend == 'simulated':
+        galvo_daq.set_backend(galvo_daq.SimulatedBackend(trigger_rate=args.trigger_rate, camera=camera))
+    elif args.backend == 'nidaqmx':
+        galvo_daq.set_backend(galvo_daq.NidaqBackend())
+
+    sequence = load_sequence(args.sequence)
+    timing = camera
+    if args.calibrate:
+        backend = galvo_daq.get_backend()
+        trigger_rate = getattr(backend, 'trigger_rate', None)
+        timing = galvo_daq.calibrate_dead_time(sorted(set(sequence['exposure_times'])), edges=args.calibrate)
+        if trigger_rate is not None:
+            backend.trigger_rate = trigger_rate  # Back from the free-runs of the simulated camera
+        for exposure, overhead in zip(timing.exposures, timing.overheads):
+            print(f"Exposure {exposure} ms: minimum overhead {overhead:.3f} ms, dead time {timing.dead_time_ms(exposure):.3f} ms.")
+        if args.calibration:
+            timing.save(args.calibration)
+            print(f"Dead time calibration saved to {args.calibration}")
+    elif args.calibration:
+        timing = galvo_engine.DeadTimeCalibration.load(args.calibration)
+    rate = args.sample_rate
+    max_rate = galvo_daq.max_sample_rate()
+    if rate != 'adaptive' and rate > max_rate:
+        parser.error(f"--sample-rate {rate:g} Hz is above the {max_rate:g} Hz limit of the device.")
+    if args.continuous and rate == 'adaptive':  # One sample clock for the whole generation
+        rate = galvo_engine.pick_sample_rate(sequence['exposure_times'], timing, max_rate=max_rate)
+    settings = plan_settings(sequence, args.min_voltage, args.max_voltage, args.factor, args.galvo2_value, args.scan_mode, args.flyback, timing,
+                             rate)
+    start = time.perf_counter()
+    try:
+        plan = galvo_engine.stream_mda_plan(**settings)
+    except ValueError as e:  # A ramp or return faster than the galvo allows
+        parser.error(str(e))
+    compile_s = time.perf_counter() - start
+    print(f"{len(plan)} frames, plan built in {compile_s * 1e3:.1f} ms, {timing.dead_time_ms(sequence['exposure_times'][0]):.3f} ms dead time "
+          f"per frame at {sequence['exposure_times'][0]} ms.")
+    rates = sorted(set(plan.channel_rates.tolist()))  # One per exposure with the adaptive rate
+    print(f"Sample clock {', '.join(f'{rate:.0f}' for rate in rates)} Hz, {plan.transfer_bytes() / 1e6:.2f} MB to transfer.")
+
+    timeline = galvo_timing.FrameTimeline()
+    start = time.perf_counter()
+    stats, error = run_mda(plan, timeout=args.timeout, timeline=timeline, verbose=args.verbose, continuous=args.continuous, loop=args.loop,
+                           interval_ms=sequence['interval_ms'], time_point_frames=len(plan) // max(sequence['num_frames'], 1),
+                           trigger_channel=args.camera_trigger)
+    wall_s = time.perf_counter() - start
+    if error is not None:
+        print(f"MDA stopped: {error}")
+    elif stats['cancelled']:
+        print(f"MDA cancelled after {stats['frames']} frames, galvos parked in {stats['cancel_latency_ms']:.1f} ms.")
+        if stats['cancel_deadline_missed']:
+            print(f"Galvos parked later than the {galvo_daq.cancel_deadline * 1e3:.0f} ms deadline.")
+    else:
+        print(f"All sequences completed: {stats['frames']} frames in {wall_s:.2f} s ({stats['frames'] / wall_s:.1f} fps).")
+    if stats is not None:
+        print(f"{stats['bytes_written'] / 1e6:.2f} MB transferred.")
+    if not args.continuous and stats is not None:
+        print(f"{stats['coalesced_frames']} frames coalesced, {stats['overruns']} overruns.")
+    if args.continuous and stats is not None:
+        print(f"{stats['underflows']} buffer underflows ({stats['underflow_samples']} samples replayed), {stats['late_refills']} late refills.")
+    print(timeline.format_summary())
+
+    if args.timing_csv:
+        timeline.save_csv(args.timing_csv)
+        print(f"Frame timings saved to {args.timing_csv}")
+    if args.metrics_json:
+        metrics = {'sequence': args.sequence, 'settings': dict(settings, timing=timing._asdict()), 'backend': galvo_daq.get_backend().name,
+                   'frames_planned': len(plan), 'sample_rates': rates, 'transfer_bytes': plan.transfer_bytes(),
+                   'compile_s': compile_s, 'wall_s': wall_s,
+                   'error': None if error is None else str(error), 'stats': stats, 'timing': timeline.summary()}
+        with open(args.metrics_json, 'w') as f:
+            json.dump(json_ready(metrics), f, indent=2)
+        print(f"Run metrics saved to {args.metrics_json}")
+    return 0 if error is None and (not stats['cancelled'] or args.loop) else 1  # A loop only ends with Ctrl+C
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+# Micro-Manager configuration presets written by the GUIs, without Qt
+# RAphael TOSCANO
+
+presets_marker = "# Configuration presets"  # Line after which the FW AMP group is inserted
+galvo2_group_marker = "# Group: NiAO18_Galvo2"  # Group the galvo2 positions are added to
+
+
+def fw_amp_presets(filters, num_amp):
+    """
+    Builds the FW AMP preset group of PresetGenerator.generate_presets.
+
+    Args:
+        filters (list of str): Selected filter wheel positions ('fw1', 'fw2', ...).
+        num_amp (int): Number of amplitude presets per filter.
+
+    Returns:
+        str: Text of the group, one preset per filter and amplitude.
+    """
+    lines = ["# Group: FW AMP\n"]
+    for fw in filters:
+        for amp in range(num_amp, 0, -1):
+            lines.append(f"# Preset: {fw} amp{amp}\n")
+            lines.append(f"ConfigGroup,FW AMP,{fw} amp{amp},Filter wheel 1,Label,Filter-{fw[-1]}\n")
+            lines.append(f"ConfigGroup,FW AMP,{fw} amp{amp},NIDAQAO-Dev1/ao1,Voltage,0.000{amp}\n\n")
+    return ''.join(lines)
+
+
+def voltage_interval_presets(N, interval, min_voltage):
+    """
+    Builds the galvo2 position presets of VoltageIntervalEditor.write_voltage_intervals.
+
+    Args:
+        N (int): Number of galvo positions.
+        interval (float): Interval voltage between positions.
+        min_voltage (float): Voltage of the first position.
+
+    Returns:
+        list of str: Lines of the presets, a comment and a ConfigGroup line per position.
+    """
+    lines = []
+    for i in range(N):
+        voltage = round(min_voltage + i * interval, 4)
+        lines.append(f"# Preset: Position {i+1}\n")
+        lines.append(f"ConfigGroup,NiAO18_Galvo2,position{i+1},NIDAQAO-Dev1/ao18,Voltage,{voltage:.4f}\n")
+    return lines
+
+
+def insert_lines(path, marker, new_lines, offset=1):
+    """
+    Inserts lines in a configuration file, offset lines after the first line containing marker.
+
+    Args:
+        path (str): Path of the .cfg file.
+        marker (str): Text of the line the insertion is relative to.
+        new_lines (list of str): Lines to insert, with their line endings.
+        offset (int): Lines between the marker line and the insertion.
+
+    Raises:
+        ValueError: If no line of the file contains marker.
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        lines = file.readlines()
+    insert_pos = next((i + offset for i, line in enumerate(lines) if marker in line), -1)
+    if insert_pos == -1:
+        raise ValueError("The specified group was not found in the file.")
+    lines[insert_pos:insert_pos] = new_lines
+    with open(path, 'w', encoding='utf-8') as file:
+        file.writelines(lines)
+
+
+def write_fw_amp_presets(path, presets):
+    """
+    Inserts a preset group text after the "# Configuration presets" line of a .cfg file.
+    """
+    insert_lines(path, presets_marker, presets.splitlines(True))
+
+
+def write_voltage_intervals(path, N, interval, min_voltage):
+    """
+    Inserts N galvo2 positions, interval volts apart, in the NiAO18_Galvo2 group of a .cfg file.
+    """
+    insert_lines(path, galvo2_group_marker, voltage_interval_presets(N, interval, min_voltage), offset=3)  # After the group header and its first preset
@@ -0,0 +1,162 @@
+# Per-frame timing of MDA runs
+# RAphael TOSCANO
+
+import collections
+import csv
+import time
+
+import numpy as np
+
+
+class FrameTimeline:
+    """
+    Per-frame timestamps of an MDA run, kept in a fixed-size ring buffer.
+
+    Block-level steps (plan fetch, configure, write, start) are staged for a range of
+    frames and copied into the row of each frame when the player sees it start, the
+    trigger time being the first poll that finds the frame being generated. Timestamps
+    mark the end of each step, in ms since the start of the run. Only the last capacity
+    frames are kept, so the memory does not grow with the MDA length.
+
+    Attributes:
+        events (tuple): Steps timed for every frame, in the order of the CSV columns.
+        capacity (int): Number of frames kept.
+        origin (float): perf_counter time of the start of the run.
+        rows (np.ndarray): (capacity, len(events)) timestamps in seconds since origin, NaN if not reached.
+        frames (np.ndarray): Frame index held by each row, -1 for an empty row.
+        recorded (int): Number of frames recorded since the start of the run.
+        errors (int): Number of errors caught and swallowed during the run.
+        last_error (str or None): Message of the last swallowed error.
+        cancel_latency_ms (float or None): Time from the cancel request to the galvos parked, None if not cancelled.
+    """
+    events = ('fetch', 'configure', 'write', 'start', 'trigger', 'done')
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.rows = np.full((capacity, len(self.events)), np.nan)
+        self.frames = np.full(capacity, -1, dtype=np.int64)
+        self.recorded = 0
+        self.errors = 0
+        self.last_error = None
+        self.cancel_latency_ms = None
+        self.origin = time.perf_counter()
+        self._staged = {event: collections.deque() for event in self.events[:4]}
+
+    def now(self):
+        """
+        Returns the current time in seconds since the start of the run.
+        """
+        return time.perf_counter() - self.origin
+
+    def stage(self, event, first, last, t=None):
+        """
+        Records a block-level step for frames first to last - 1, copied when they start.
+        """
+        self._staged[event].append((first, last, self.now() if t is None else t))
+
+    def frame_started(self, frame, t=None):
+        """
+        Opens the row of a frame when its trigger is seen, with the steps staged for it.
+        """
+        row = frame % self.capacity
+        self.frames[row] = frame
+        self.rows[row] = np.nan
+        for column, staged in enumerate(self._staged.values()):
+            while staged and staged[0][1] <= frame:  # Frames start in order: older blocks are done
+                staged.popleft()
+            if staged and staged[0][0] <= frame:
+                self.rows[row, column] = staged[0][2]
+        self.rows[row, 4] = self.now() if t is None else t
+        self.recorded += 1
+
+    def frame_done(self, frame, t=None):
+        """
+        Records the end of a frame.
+        """
+        row = frame % self.capacity
+        if self.frames[row] == frame:
+            self.rows[row, 5] = self.now() if t is None else t
+
+    def error(self, error):
+        """
+        Counts an error that the caller swallows.
+        """
+        self.errors += 1
+        self.last_error = str(error)
+
+    def records(self):
+        """
+        Returns the frames kept and their timestamps, in frame order.
+
+        Returns:
+            tuple: Frame indices (n,) and timestamps in ms (n, len(events)).
+        """
+        kept = np.flatnonzero(self.frames >= 0)
+        order = kept[np.argsort(self.frames[kept])]
+        return self.frames[order], self.rows[order] * 1e3
+
+    def gaps(self):
+        """
+        Returns the time in ms between the triggers of consecutive frames.
+        """
+        frames, rows = self.records()
+        consecutive = np.diff(frames) == 1  # A gap across frames dropped from the ring is not a gap
+        return np.diff(rows[:, 4])[consecutive]
+
+    def histogram(self, bins=10):
+        """
+        Returns the histogram of the inter-frame gaps.
+
+        Returns:
+            tuple: Counts and bin edges in ms, as np.histogram.
+        """
+        gaps = self.gaps()
+        gaps = gaps[np.isfinite(gaps)]
+        return np.histogram(gaps, bins=bins) if gaps.size else (np.zeros(0, dtype=np.int64), np.zeros(1))
+
+    def summary(self):
+        """
+        Summarises the run: frames, inter-frame gap percentiles, late frames and errors.
+
+        A frame is late when its gap is more than 1.5 times the median gap.
+
+        Returns:
+            dict: frames, gap_p50_ms, gap_p95_ms, gap_p99_ms, gap_max_ms, late_frames, errors and cancel_latency_ms.
+        """
+        gaps = self.gaps()
+        gaps = gaps[np.isfinite(gaps)]
+        if gaps.size:
+            p50, p95, p99 = np.percentile(gaps, [50, 95, 99])
+            late, longest = int(np.count_nonzero(gaps > 1.5 * p50)), float(gaps.max())
+        else:
+            p50 = p95 = p99 = longest = float('nan')
+            late = 0
+        return {'frames': self.recorded, 'gap_p50_ms': float(p50), 'gap_p95_ms': float(p95), 'gap_p99_ms': float(p99),
+                'gap_max_ms': longest, 'late_frames': late, 'errors': self.errors, 'cancel_latency_ms': self.cancel_latency_ms}
+
+    def format_summary(self, bins=8, width=40):
+        """
+        Returns the summary and a text histogram of the inter-frame gaps.
+        """
+        summary = self.summary()
+        lines = [f"{summary['frames']} frames, inter-frame gap p50 {summary['gap_p50_ms']:.2f} ms, "
+                 f"p95 {summary['gap_p95_ms']:.2f} ms, p99 {summary['gap_p99_ms']:.2f} ms, max {summary['gap_max_ms']:.2f} ms, "
+                 f"{summary['late_frames']} late frames, {summary['errors']} errors swallowed."]
+        if summary['cancel_latency_ms'] is not None:
+            lines.append(f"Cancelled, galvos parked after {summary['cancel_latency_ms']:.1f} ms.")
+        counts, edges = self.histogram(bins)
+        for count, low, high in zip(counts, edges[:-1], edges[1:]):
+            bar = '#' * int(round(width * count / counts.max())) if counts.max() else ''
+            lines.append(f"{low:8.2f} - {high:8.2f} ms {count:6d} {bar}")
+        return '\n'.join(lines)
+
+    def save_csv(self, path):
+        """
+        Writes the frames kept to a CSV file, one row per frame, timestamps in ms.
+        """
+        frames, rows = self.records()
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame'] + [f'{event}_ms' for event in self.events])
+            for frame, row in zip(frames, rows):
+                writer.writerow([int(frame) + 1] + ['' if np.isnan(t) else f'{t:.3f}' for t in row])
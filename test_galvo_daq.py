@@ -0,0 +1,371 @@
+# Tests of the galvo playback on the simulated DAQ backend
+# RAphael TOSCANO
+
+import collections
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import galvo_benchmark
+import galvo_daq
+import galvo_engine
+
+
+def settings(num_frames, num_slices, exposure_times):
+    """
+    Returns MDA settings of galvo_benchmark with the given exposures.
+    """
+    settings = galvo_benchmark.mda_settings(num_frames, num_slices, len(exposure_times))
+    settings['exposure_times'] = exposure_times
+    return settings
+
+
+@pytest.mark.parametrize('roi_lines', [2048, 512, 128])
+@pytest.mark.parametrize('rate', galvo_engine.sample_rates)
+def test_frames_end_before_next_trigger(roi_lines, rate):
+    timing = galvo_engine.camera_timing(roi_lines)
+    for exposure in (1, 10, 50, 2000):
+        period_ms = exposure + timing.dead_time_ms(exposure)
+        frame_ms = (galvo_engine.frame_samples(exposure, rate, timing) + 1) * 1e3 / rate  # With the parking sample
+        assert frame_ms <= period_ms - galvo_engine.trigger_guard_ms + 1e-9
+
+
+@pytest.mark.parametrize('roi_lines, exposure', [(2048, 10), (512, 10), (512, 1)])
+def test_played_frame_rate_matches_camera(roi_lines, exposure):
+    timing = galvo_engine.camera_timing(roi_lines)
+    period_ms = exposure + timing.dead_time_ms(exposure)
+    backend = galvo_daq.SimulatedBackend(trigger_rate=1000 / period_ms)
+    plan = galvo_engine.compile_mda_plan(**settings(20, 1, [exposure]), timing=timing)
+    player = galvo_daq.RetriggerablePlayer(plan, backend=backend)
+    stats = player.play(timeout=10)
+    assert stats['timing']['gap_p50_ms'] == pytest.approx(period_ms, rel=0.1)
+    span_ms = player.timeline.gaps().sum()  # First to last trigger, only the polls of both ends jitter
+    assert span_ms < (len(plan) - 0.5) * period_ms  # One frame per trigger: a missed edge adds a whole period
+
+
+def test_frames_played_in_order():
+    plan = galvo_engine.compile_mda_plan(**settings(3, 4, [10, 20]))
+    played = []
+    backend = galvo_daq.SimulatedBackend(trigger_rate=1000 / max(plan.duration_ms(i) for i in range(len(plan))))
+    stats = galvo_daq.RetriggerablePlayer(plan, frame_done=played.append, backend=backend, buffer_frames=4).play(timeout=10)
+    assert played == list(range(len(plan)))
+    assert stats['frames'] == len(plan)
+    written = np.hstack([write for task in backend.tasks for write in task.writes])
+    assert np.array_equal(written, plan.block(0, len(plan)))
+
+
+
+def test_bidirectional_runs_played_in_order():
+    sequence = settings(2, 3, [10, 20])
+    sequence['Acq_order'] = 1  # One run per channel, an odd number of frames: the runs start forward and backward in turn
+    plan = galvo_engine.compile_mda_plan(**sequence, scan_mode='bidirectional')
+    backend = galvo_daq.SimulatedBackend(trigger_rate=1000 / max(plan.duration_ms(i) for i in range(len(plan))))
+    galvo_daq.RetriggerablePlayer(plan, backend=backend, buffer_frames=2).play(timeout=10)
+    written = np.hstack([write for task in backend.tasks for write in task.writes])
+    assert np.array_equal(written, plan.block(0, len(plan)))
+
+
+
+def test_calibration_recovers_the_camera_dead_time():
+    camera = galvo_engine.camera_timing(128)
+    backend = galvo_daq.SimulatedBackend(camera=camera, trigger_jitter=2e-5)
+    calibration = galvo_daq.calibrate_dead_time([1.0, 5.0], edges=20, backend=backend)
+    assert calibration.exposures == (1.0, 5.0)
+    for exposure in calibration.exposures:
+        # The shortest interval of a jittered free-run: the trigger period less at most a few jitters
+        assert calibration.dead_time_ms(exposure) == pytest.approx(camera.dead_time_ms(), abs=0.1)
+
+
+def repeat_plan(num_frames, frame_ms, duration_ms, rate=10000):
+    """
+    Returns a plan of num_frames identical frames of frame_ms, each triggered every duration_ms.
+    """
+    frame = np.zeros((2, int(rate * frame_ms / 1000)))
+    return galvo_engine.FlyweightMDAPlan.from_channels([frame], [duration_ms], np.zeros(num_frames, dtype=np.intp), [rate])
+
+
+def test_repeat_frames_coalesced_with_a_stop_margin():
+    backend = galvo_daq.SimulatedBackend(trigger_rate=25)
+    stats = galvo_daq.RetriggerablePlayer(repeat_plan(6, 10, 40), backend=backend).play(timeout=10)
+    assert stats['frames'] == 6
+    assert stats['coalesced_frames'] == 6
+    assert stats['writes'] == 1
+    assert stats['overruns'] == 0
+
+
+def test_repeat_frames_streamed_without_a_stop_margin():
+    backend = galvo_daq.SimulatedBackend(trigger_rate=100)
+    stats = galvo_daq.RetriggerablePlayer(repeat_plan(6, 10, 10), backend=backend).play(timeout=10)
+    assert stats['frames'] == 6
+    assert stats['coalesced_frames'] == 0
+
+
+def test_late_stop_raises_frame_overrun():
+    backend = galvo_daq.SimulatedBackend(trigger_rate=100)  # Back to back frames: the stop always lands after the next trigger
+    player = galvo_daq.RetriggerablePlayer(repeat_plan(6, 10, 10), backend=backend, stop_margin=0.0)
+    with pytest.raises(galvo_daq.FrameOverrun):
+        player.play(timeout=10)
+    assert player.stats['overruns'] > 0
+
+
+@pytest.mark.parametrize('pipeline_depth, ping_pong', [(None, False), (8, True)])
+def test_cancel_parks_within_deadline(pipeline_depth, ping_pong):
+    plan = galvo_engine.stream_mda_plan(**galvo_benchmark.mda_settings(50, 5, 2))
+    backend = galvo_daq.SimulatedBackend(trigger_rate=25)
+    player = galvo_daq.RetriggerablePlayer(plan, backend=backend, pipeline_depth=pipeline_depth, ping_pong=ping_pong)
+    timer = threading.Timer(0.3, player.cancel)
+    timer.start()
+    stats = player.play(timeout=10)
+    timer.join()
+    assert stats['cancelled']
+    assert stats['cancel_latency_ms'] < galvo_daq.cancel_deadline * 1e3
+    assert not stats['cancel_deadline_missed']
+    assert backend.tasks[-1].values[-1] == [galvo_daq.park_voltage, galvo_daq.park_voltage]
+
+
+def test_pipeline_wait_stops_on_cancel():
+    def stalled():
+        time.sleep(10)  # Producer stuck preparing the next frame
+        yield 0, None
+
+    cancel_event = threading.Event()
+    pipeline = galvo_daq.FramePipeline(stalled())
+    pipeline.start()
+    threading.Timer(0.05, cancel_event.set).start()
+    start = time.perf_counter()
+    with pytest.raises(galvo_daq.Cancelled):
+        pipeline.get(cancel_event)
+    assert time.perf_counter() - start < galvo_daq.cancel_deadline + 0.05
+
+
+def camera_triggers(backend, rate):
+    """
+    Returns the times in ms of the camera trigger pulses written by a continuous player.
+    """
+    high = np.hstack(backend.tasks[0].writes)[2] > galvo_daq.camera_trigger_voltage / 2
+    return np.flatnonzero(high & ~np.r_[False, high[:-1]]) * 1e3 / rate  # Rising edges
+
+
+def continuous_plan(num_frames):
+    sequence = settings(num_frames, 2, [10, 3])
+    sequence.update(timing=galvo_engine.camera_timing(512), rate=20000)
+    return galvo_engine.stream_mda_plan(**sequence)
+
+
+def test_continuous_frames_trigger_the_camera_without_drift():
+    plan = continuous_plan(5)
+    backend = galvo_daq.SimulatedBackend()
+    stats = galvo_daq.ContinuousPlayer(plan, backend=backend).play(timeout=10)
+    triggers = camera_triggers(backend, plan.rate)
+    durations = np.array([plan.duration_ms(i) for i in range(len(plan))])
+    assert stats['frames'] == len(plan)
+    assert len(triggers) == len(plan)
+    periods = np.diff(triggers)
+    assert np.all(periods >= durations[:-1] - 1e-9)  # The camera is ready for every trigger
+    assert np.all(periods < durations[:-1] + 1e3 / plan.rate)  # Only rounded up to the next sample: no drift
+
+
+def test_continuous_time_points_follow_the_interval():
+    plan = continuous_plan(4)
+    frames = len(plan) // 4
+    backend = galvo_daq.SimulatedBackend()
+    galvo_daq.ContinuousPlayer(plan, backend=backend, interval_ms=200.0, time_point_frames=frames).play(timeout=10)
+    triggers = camera_triggers(backend, plan.rate)
+    assert np.allclose(triggers[::frames], 200.0 * np.arange(4), atol=1e3 / plan.rate)
+
+
+def test_continuous_cancel_parks_within_deadline():
+    plan = continuous_plan(50)
+    backend = galvo_daq.SimulatedBackend(record=False)
+    backend.write_latency_per_byte = 0.08 / (3 * 1000 * 8)  # Refills of 1000 samples slower than the deadline
+    player = galvo_daq.ContinuousPlayer(plan, backend=backend, buffer_samples=4000, chunk_samples=1000, loop=True)
+    timer = threading.Timer(0.5, player.cancel)
+    timer.start()
+    stats = player.play(timeout=10)
+    timer.join()
+    assert stats['cancelled']
+    assert stats['cancel_latency_ms'] < galvo_daq.cancel_deadline * 1e3
+    assert stats['refills'] > 0
+
+
+Snapshot = collections.namedtuple('Snapshot', ['version', 'value'])
+
+
+
+class WiredBackend(galvo_daq.SimulatedBackend):
+    """
+    Simulated card refusing the AO channels that are not wired, as a real card refuses an unknown channel.
+    """
+    wired = (galvo_daq.galvo1_channel, galvo_daq.galvo2_channel, 'Dev1/ao3')
+
+    def create_task(self):
+        task = super().create_task()
+        add_ao_channel = task.add_ao_channel
+
+        def checked(channel):
+            if channel not in self.wired:
+                raise galvo_daq.DaqError(f"Physical channel {channel} does not exist on this device.", -200170)
+            add_ao_channel(channel)
+        task.add_ao_channel = checked
+        return task
+
+
+def test_continuous_trigger_channel_is_configurable():
+    plan = continuous_plan(1)
+    backend = WiredBackend()
+    galvo_daq.ContinuousPlayer(plan, backend=backend, trigger_channel='Dev1/ao3').play(timeout=10)
+    assert backend.tasks[0].channels[2] == 'Dev1/ao3'
+    assert len(camera_triggers(backend, plan.rate)) == len(plan)
+
+
+def test_continuous_fails_fast_without_a_trigger_channel():
+    plan = continuous_plan(1)
+    with pytest.raises(ValueError):
+        galvo_daq.ContinuousPlayer(plan, backend=WiredBackend(), trigger_channel=None)
+    backend = WiredBackend()
+    with pytest.raises(galvo_daq.DaqError, match='external trigger input'):
+        galvo_daq.ContinuousPlayer(plan, backend=backend, trigger_channel='Dev1/ao19').play(timeout=10)
+    assert all(task.closed for task in backend.tasks)
+    assert not any(task.writes for task in backend.tasks)  # Nothing played
+
+
+def test_mailbox_keeps_only_the_latest_version():
+    mailbox = galvo_daq.SettingsMailbox()
+    assert mailbox.wait_newer(None, timeout=0.01) is None
+    for version in (1, 2, 3):
+        mailbox.publish(Snapshot(version, version / 10))
+    assert mailbox.wait_newer(1, timeout=0.01) == Snapshot(3, 0.3)  # A late worker skips version 2
+    assert mailbox.wait_newer(3, timeout=0.01) is None
+    with pytest.raises(ValueError):
+        mailbox.publish(Snapshot(3, 0.0))  # Stale or repeated versions are refused
+
+
+def test_mailbox_wait_ends_on_publish_or_cancel():
+    mailbox = galvo_daq.SettingsMailbox()
+    threading.Timer(0.05, mailbox.publish, args=(Snapshot(1, 0.5),)).start()
+    assert mailbox.wait_newer(None, timeout=5) == Snapshot(1, 0.5)
+    stopping = threading.Event()
+    threading.Timer(0.05, lambda: (stopping.set(), mailbox.wake())).start()
+    start = time.perf_counter()
+    assert mailbox.wait_newer(1, timeout=5, cancelled=stopping.is_set) is None
+    assert time.perf_counter() - start < 1
+
+
+def test_follower_loads_the_latest_snapshot():
+    mailbox = galvo_daq.SettingsMailbox()
+    backend = galvo_daq.SimulatedBackend()
+    output = galvo_daq.RetriggerableOutput([galvo_daq.galvo1_channel, galvo_daq.galvo2_channel], backend=backend)
+    waveform = lambda snapshot: (snapshot.value, lambda: np.full((2, 100), snapshot.value))
+    follower = galvo_daq.SettingsFollower(mailbox, output, waveform)
+    for version in (1, 2, 3):
+        mailbox.publish(Snapshot(version, version / 10))  # Before the worker runs: only the last one is loaded
+    thread = threading.Thread(target=follower.run)
+    thread.start()
+    deadline = time.perf_counter() + 5
+    while follower.metrics['reloads'] < 1 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    follower.stop()
+    thread.join()
+    assert follower.metrics['reloads'] == 1
+    assert backend.tasks[0].writes[-1][0, 0] == pytest.approx(0.3)
+
+
+def test_follower_retries_a_failed_waveform():
+    mailbox = galvo_daq.SettingsMailbox()
+    output = galvo_daq.RetriggerableOutput([galvo_daq.galvo1_channel, galvo_daq.galvo2_channel], backend=galvo_daq.SimulatedBackend())
+    calls = []
+
+    def waveform(snapshot):
+        calls.append(snapshot.version)
+        if len(calls) == 1:
+            raise galvo_daq.DaqError("Device not responding.", -50405)  # Card busy when the rate is read
+        return snapshot.value, lambda: np.full((2, 100), snapshot.value)
+
+    follower = galvo_daq.SettingsFollower(mailbox, output, waveform, min_backoff=0.01)
+    mailbox.publish(Snapshot(1, 0.5))
+    thread = threading.Thread(target=follower.run)
+    thread.start()
+    deadline = time.perf_counter() + 5
+    while follower.metrics['reloads'] < 1 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    follower.stop()
+    thread.join()
+    assert follower.metrics['errors'] == 1
+    assert follower.metrics['reloads'] == 1
+
+
+def test_max_sample_rate_falls_back_without_a_card():
+    class MissingCard:
+        def ao_max_rate(self):
+            raise galvo_daq.DaqError("Device identifier is invalid.", -200220)
+
+    assert galvo_daq.max_sample_rate(galvo_daq.SimulatedBackend()) == galvo_engine.max_ao_rate
+    assert galvo_daq.max_sample_rate(MissingCard()) == galvo_engine.max_ao_rate
+
+
+def wait_for(condition, timeout=5):
+    """
+    Polls a condition of another thread until it holds or the timeout elapses.
+    """
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_actor_writes_only_the_last_queued_value():
+    backend = galvo_daq.SimulatedBackend()
+    actor = galvo_daq.DeviceActor(backend)
+    busy = threading.Event()
+    actor.call(busy.wait, wait=False)  # Hold the actor while the burst is queued
+    for value in (0.1, 0.2, 0.3):
+        actor.write(galvo_daq.galvo1_channel, value)
+    actor.write(galvo_daq.galvo2_channel, -0.5)
+    busy.set()
+    assert actor.flush(timeout=5)
+    actor.write(galvo_daq.galvo1_channel, 0.4)  # The first write already ran: queued again, on the same task
+    assert actor.flush(timeout=5)
+    assert actor.tasks[galvo_daq.galvo1_channel].values == [0.3, 0.4]
+    assert actor.tasks[galvo_daq.galvo2_channel].values == [-0.5]
+    assert actor.metrics['coalesced'] == 2
+    assert actor.metrics['tasks_created'] == len(backend.tasks) == 2  # One persistent task per channel
+    actor.stop()
+    assert all(task.closed for task in backend.tasks)
+
+
+def test_actor_releases_and_rearms_a_follower():
+    backend = galvo_daq.SimulatedBackend()
+    actor = galvo_daq.DeviceActor(backend)
+    mailbox = galvo_daq.SettingsMailbox()
+    output = galvo_daq.RetriggerableOutput([galvo_daq.galvo1_channel, galvo_daq.galvo2_channel], backend=backend)
+    follower = galvo_daq.SettingsFollower(mailbox, output, lambda snapshot: (snapshot.value, lambda: np.full((2, 100), snapshot.value)),
+                                          actor=actor)
+    mailbox.publish(Snapshot(1, 0.5))
+    thread = threading.Thread(target=follower.run)
+    thread.start()
+    assert wait_for(lambda: follower.metrics['reloads'] == 1)
+    armed = output.task
+    actor.write(galvo_daq.galvo1_channel, 1.0)  # Claimed channel: the armed task is closed first
+    assert wait_for(lambda: follower.metrics['reloads'] == 2)
+    follower.stop()
+    thread.join()
+    actor.stop()
+    assert armed.closed
+    assert follower.metrics['rearms'] == 1
+    assert [task.values for task in backend.tasks if task.values] == [[1.0]]
+    assert backend.tasks[-1].writes[-1][0, 0] == pytest.approx(0.5)  # Armed again with the same frame
+
+
+def test_actor_plays_a_timed_sequence():
+    backend = galvo_daq.SimulatedBackend()
+    actor = galvo_daq.DeviceActor(backend)
+    actor.write(galvo_daq.galvo2_channel, 0.0)
+    done = threading.Event()
+    samples = np.linspace(0.0, 1.0, 50)
+    actor.play(galvo_daq.galvo2_channel, samples, 10000, done=done.set)
+    assert done.wait(5)
+    actor.stop()
+    assert backend.tasks[0].closed  # The on-demand task gave the channel to the timed one
+    assert np.array_equal(backend.tasks[1].writes[0][0], samples)
@@ -0,0 +1,153 @@
+# Tests of the galvo waveform engine
+# RAphael TOSCANO
+
+import itertools
+import threading
+
+import numpy as np
+import pytest
+
+import galvo_engine
+
+plan_builders = (galvo_engine.compile_mda_plan, galvo_engine.compact_mda_plan, galvo_engine.stream_mda_plan)
+
+
+def baseline_generate_voltage_sequences(min_voltage, max_voltage, factor, Galvo2_Enable, galvo2_Value,
+                                        exposure_times, num_frames, num_slices, Acq_order, FW, amp):
+    """
+    Frozen copy of the nested loops of the original PROJECTION_GUI.generate_voltage_sequences.
+    """
+    sample_rate = 10000
+
+    def increase_range(factor):
+        center = (min_voltage + max_voltage) / 2
+        half_range_new = (max_voltage - min_voltage) / 2 * factor
+        return min(max(center - half_range_new, -10), 10), min(max(center + half_range_new, -10), 10)
+
+    if factor <= 0:
+        factor_list_unique = np.linspace(factor, -1.0, int(amp)).tolist()
+    else:
+        factor_list_unique = np.linspace(factor, 1.0, int(amp)).tolist()
+    factor_list = factor_list_unique * FW
+
+    all_sequences = []
+    all_sequences2 = []
+    duration_list = []
+    if Acq_order == 0:
+        order = [(i, e) for _ in range(num_frames) for _ in range(num_slices) for i, e in enumerate(exposure_times)]
+    else:
+        order = [(i, e) for _ in range(num_frames) for i, e in enumerate(exposure_times) for _ in range(num_slices)]
+    for i, exposure_time in order:
+        duration_ms = exposure_time + 22.937
+        num_samples = int(sample_rate * (duration_ms / 1000))
+        all_sequences.append(np.append(np.linspace(min_voltage, max_voltage, num_samples), min_voltage))
+        min_voltage_new, max_voltage_new = increase_range(factor_list[i])
+        if Galvo2_Enable:
+            all_sequences2.append(np.append(np.linspace(min_voltage_new, max_voltage_new, num_samples), min_voltage_new))
+        else:
+            all_sequences2.append(np.append(np.linspace(galvo2_Value, galvo2_Value, num_samples), galvo2_Value))
+        duration_list.append(duration_ms)
+    return all_sequences, all_sequences2, duration_list
+
+
+def test_waveform_cache_shared_between_threads():
+    cache = galvo_engine.WaveformCache(maxsize=8)
+    errors = []
+
+    def lookups(offset):
+        try:
+            for i in range(2000):
+                key = (offset + i) % 16
+                frame = cache.get(key, lambda: np.full(4, key, dtype=np.float64))
+                assert frame[0] == key
+        except Exception as e:  # Collect the failures of the worker threads
+            errors.append(e)
+
+    threads = [threading.Thread(target=lookups, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    info = cache.info()
+    assert not errors
+    assert info['size'] <= info['maxsize']
+    assert info['hits'] + info['misses'] == 4 * 2000
+
+
+def test_shaped_flyback_pads_frames_with_its_return():
+    timing = galvo_engine.camera_timing(128)
+    for amplitude in (0.25, 4.0, 16.0):
+        settings = dict(min_voltage=-amplitude / 2, max_voltage=amplitude / 2, factor=0.4, Galvo2_Enable=False, galvo2_Value=0.0,
+                        exposure_times=[10.0], num_frames=2, num_slices=2, Acq_order=0, FW=1, amp=1)
+        plans = [build(**settings, flyback='shaped', timing=timing)
+                 for build in (galvo_engine.compile_mda_plan, galvo_engine.compact_mda_plan, galvo_engine.stream_mda_plan)]
+        flyback_ms = galvo_engine.flyback_time_ms(-amplitude / 2, amplitude / 2, 10.0, timing=timing)
+        padding_ms = timing.line_time_ms * timing.roi_lines + timing.trigger_delay_ms + flyback_ms
+        for plan in plans:
+            assert plan.duration_ms(0) - 10.0 == pytest.approx(padding_ms)
+            assert np.array_equal(plan.frame(0), plans[0].frame(0))
+            frame_ms = plan.frame_length(0) * 1e3 / galvo_engine.sample_rate
+            assert frame_ms <= plan.duration_ms(0) - galvo_engine.trigger_guard_ms + 1e-9
+
+
+@pytest.mark.parametrize('Acq_order, Galvo2_Enable, factor', list(itertools.product((0, 1), (True, False), (0.4, -0.6))))
+def test_plans_match_the_baseline_loops(Acq_order, Galvo2_Enable, factor):
+    # The baseline ramp took exposure + 22.937 ms of samples; with a dead time longer by the guard and the
+    # parking sample, the engine's frames end before the next trigger with the same number of samples
+    timing = galvo_engine.camera_timing(settle_ms=galvo_engine.default_camera.settle_ms + galvo_engine.trigger_guard_ms
+                                        + 1e3 / galvo_engine.sample_rate)
+    settings = dict(min_voltage=-2.0, max_voltage=3.0, factor=factor, Galvo2_Enable=Galvo2_Enable, galvo2_Value=0.7,
+                    exposure_times=[10.0, 45.5, 73.3, 200.0], num_frames=3, num_slices=2, Acq_order=Acq_order, FW=2, amp=2)
+    all_sequences, all_sequences2, duration_list = baseline_generate_voltage_sequences(**settings)
+    for build in plan_builders:
+        plan = build(**settings, timing=timing)
+        assert len(plan) == len(all_sequences)
+        for i in range(len(plan)):
+            galvo1, galvo2 = plan.frame(i)
+            np.testing.assert_allclose(galvo1, all_sequences[i], rtol=0, atol=1e-12)
+            np.testing.assert_allclose(galvo2, all_sequences2[i], rtol=0, atol=1e-12)
+            # The trigger period keeps the baseline's exposure order, only longer by the same guard
+            assert plan.duration_ms(i) - duration_list[i] == pytest.approx(galvo_engine.trigger_guard_ms + 1e3 / galvo_engine.sample_rate)
+
+
+def test_bidirectional_frames_alternate_directions():
+    settings = dict(min_voltage=-2.0, max_voltage=3.0, factor=0.4, Galvo2_Enable=True, galvo2_Value=0.0,
+                    exposure_times=[10.0, 20.0], num_frames=3, num_slices=3, Acq_order=1, FW=1, amp=2)
+    plans = [build(**settings, scan_mode='bidirectional') for build in plan_builders]
+    for plan in plans:
+        assert len(plan) == 18
+        for i in range(len(plan)):
+            galvo1 = plan.frame(i)[0]
+            ramp = np.diff(galvo1[:-1])  # The parking sample holds the end voltage
+            assert np.all(ramp > 0) if i % 2 == 0 else np.all(ramp < 0)  # Odd frames sweep back, holding the end voltage
+            assert galvo1[0] == (-2.0 if i % 2 == 0 else 3.0)
+            assert np.array_equal(plan.frame(i), plans[0].frame(i))
+        # Runs of equal length frames are played as blocks: their concatenation keeps the alternation
+        blocks = np.hstack([plan.block(start, stop) for start, stop in plan.runs()])
+        assert np.array_equal(blocks, np.hstack([plan.frame(i) for i in range(len(plan))]))
+        assert [stop - start for start, stop in plan.runs()] == [3] * 6  # One run per channel and time point
+
+
+def test_bidirectional_init_phase_loads_both_frames():
+    waveform = galvo_engine.init_phase_waveform(-2.0, 3.0, 0.4, True, 0.0, 10.0, scan_mode='bidirectional')
+    length = galvo_engine.frame_samples(10.0) + 1
+    assert waveform.shape == (2, 2 * length)
+    forward, backward = waveform[:, :length], waveform[:, length:]
+    assert np.all(np.diff(forward[0, :-1]) > 0) and np.all(np.diff(backward[0, :-1]) < 0)
+    np.testing.assert_allclose(backward[:, :-1], forward[:, -2::-1], rtol=0, atol=1e-12)  # The same ramp, back to the start
+
+
+def test_calibrated_dead_time_clamps_outside_the_calibration():
+    calibration = galvo_engine.DeadTimeCalibration(exposures=(10.0, 100.0), overheads=(5.0, 8.0), guard_ms=0.5)
+    assert calibration.dead_time_ms(1.0) == pytest.approx(4.5)  # Below the range: the first overhead
+    assert calibration.dead_time_ms(55.0) == pytest.approx(6.0)
+    assert calibration.dead_time_ms(1000.0) == pytest.approx(7.5)  # Above the range: the last overhead
+    with pytest.raises(ValueError):
+        galvo_engine.empty_calibration.dead_time_ms(10.0)
+
+
+def test_fit_overhead_leaves_out_glitches_and_missed_edges():
+    intervals = [14.0, 14.2, 3.0, 10.0, 28.1, 14.1, 42.3, 14.05]  # A glitch, one at the exposure and two missed edges
+    assert galvo_engine.fit_overhead(intervals, 10.0) == pytest.approx(4.0)
+    with pytest.raises(ValueError):
+        galvo_engine.fit_overhead([5.0, 10.0], 10.0)
@@ -0,0 +1,55 @@
+# Tests of the Micro-Manager preset writers and of the image display computations
+# RAphael TOSCANO
+
+import numpy as np
+import pytest
+
+import galvo_benchmark
+import galvo_display
+import galvo_presets
+
+
+def test_presets_inserted_after_their_markers(tmp_path):
+    cfg = tmp_path / 'presets.cfg'
+    cfg.write_text(galvo_benchmark.micro_manager_cfg(3), encoding='utf-8')
+    galvo_presets.write_fw_amp_presets(cfg, galvo_presets.fw_amp_presets(['fw1', 'fw2'], 2))
+    galvo_presets.write_voltage_intervals(cfg, 3, 0.5, -1.0)
+    lines = cfg.read_text(encoding='utf-8').splitlines()
+    start = lines.index(galvo_presets.presets_marker) + 1
+    assert lines[start] == "# Group: FW AMP"
+    assert lines[start + 1:start + 4] == ["# Preset: fw1 amp2", "ConfigGroup,FW AMP,fw1 amp2,Filter wheel 1,Label,Filter-1",
+                                          "ConfigGroup,FW AMP,fw1 amp2,NIDAQAO-Dev1/ao1,Voltage,0.0002"]
+    group = lines.index(galvo_presets.galvo2_group_marker)
+    assert lines[group + 4:group + 10:2] == [f"ConfigGroup,NiAO18_Galvo2,position{i + 1},NIDAQAO-Dev1/ao18,Voltage,{v}"
+                                             for i, v in enumerate(("-1.0000", "-0.5000", "0.0000"))]
+
+
+def test_presets_need_their_group(tmp_path):
+    cfg = tmp_path / 'empty.cfg'
+    cfg.write_text("Property,Core,Setting0,0\n", encoding='utf-8')
+    with pytest.raises(ValueError):
+        galvo_presets.write_voltage_intervals(cfg, 3, 0.5, -1.0)
+
+
+def test_histogram_display_counts_every_pixel():
+    image = np.random.default_rng(0).integers(100, 4000, (64, 64), dtype=np.uint16)
+    adjusted, hist, raw_hist, adjusted_stats, raw_stats = galvo_display.histogram_display(image, 200, 3000)
+    assert adjusted.dtype == np.uint16
+    assert adjusted_stats[0] == 0 and adjusted_stats[1] == galvo_display.max_16bit_value  # Clipped at both ends
+    assert hist.shape == raw_hist.shape == (galvo_display.max_16bit_value + 1, 1)
+    assert raw_hist.sum() == image.size
+    assert hist.sum() == np.count_nonzero(adjusted < galvo_display.max_16bit_value)  # White pixels are out of the range
+    assert np.array_equal(raw_hist[:4000, 0], np.histogram(image, bins=np.arange(4001))[0])
+    assert raw_stats[2] == pytest.approx(image.mean())
+
+
+def test_histogram_counts_the_first_channel_as_calchist():
+    image = np.zeros((8, 8, 3), dtype=np.uint16)
+    image[..., 0] = 10
+    image[..., 1] = 20
+    image[:2, :, 0] = 15  # Out of the range: not counted
+    hist = galvo_display.intensity_histogram(image, 15)
+    assert hist.dtype == np.float32 and hist.shape == (16, 1)
+    assert hist[10, 0] == 48 and hist.sum() == 48
+    floats = np.array([[0.2, 7.5], [14.99, -1.0], [np.nan, 15.0]], dtype=np.float32)
+    assert np.flatnonzero(galvo_display.intensity_histogram(floats, 15)[:, 0]).tolist() == [0, 8, 15]
@@ -0,0 +1,55 @@
+# Tests of the per-frame timing of MDA runs
+# RAphael TOSCANO
+
+import csv
+
+import pytest
+
+import galvo_timing
+
+
+def played_timeline(triggers):
+    """
+    Returns a timeline of frames triggered at the given times in seconds, each done 5 ms later.
+    """
+    timeline = galvo_timing.FrameTimeline(capacity=16)
+    timeline.stage('write', 0, len(triggers), t=0.0)
+    for frame, t in enumerate(triggers):
+        timeline.frame_started(frame, t=t)
+        timeline.frame_done(frame, t=t + 0.005)
+    return timeline
+
+
+def test_summary_of_known_gaps():
+    timeline = played_timeline([0.0, 0.010, 0.020, 0.030, 0.060, 0.070])  # One missed trigger before frame 4
+    timeline.error(TimeoutError("Late trigger"))
+    timeline.error(ValueError("Stale frame"))
+    summary = timeline.summary()
+    assert summary['frames'] == 6
+    assert summary['gap_p50_ms'] == pytest.approx(10.0)
+    assert summary['gap_p95_ms'] == pytest.approx(26.0)  # Linear interpolation of np.percentile
+    assert summary['gap_p99_ms'] == pytest.approx(29.2)
+    assert summary['gap_max_ms'] == pytest.approx(30.0)
+    assert summary['late_frames'] == 1
+    assert summary['errors'] == 2
+    assert timeline.last_error == "Stale frame"
+    assert summary['cancel_latency_ms'] is None
+
+
+def test_ring_keeps_only_the_last_frames():
+    timeline = played_timeline([0.01 * frame for frame in range(40)])
+    frames, rows = timeline.records()
+    assert frames.tolist() == list(range(24, 40))
+    assert timeline.summary()['frames'] == 40
+    assert timeline.gaps() == pytest.approx([10.0] * 15)
+
+
+def test_save_csv_header_and_rows(tmp_path):
+    path = tmp_path / 'timing.csv'
+    played_timeline([0.0, 0.0125]).save_csv(path)
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['frame', 'fetch_ms', 'configure_ms', 'write_ms', 'start_ms', 'trigger_ms', 'done_ms']
+    assert rows[1] == ['1', '', '', '0.000', '', '0.000', '5.000']  # Frames from 1, steps not reached left empty
+    assert rows[2] == ['2', '', '', '0.000', '', '12.500', '17.500']
+    assert len(rows) == 3